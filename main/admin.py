@@ -1,9 +1,11 @@
 from django.contrib import admin
-from .models import Device, LocalData, AggregetedData, RoundResult, PredictResult
+from .models import Device, LocalData, AggregetedData, RoundResult, PredictResult, Checkpoint, RoundSummary
 
 admin.site.register(Device)
 admin.site.register(LocalData)
 admin.site.register(RoundResult)
 admin.site.register(PredictResult)
 admin.site.register(AggregetedData)
+admin.site.register(Checkpoint)
+admin.site.register(RoundSummary)
 # Register your models here.
@@ -0,0 +1,362 @@
+# aggregation.py
+"""
+Потоковый взвешенный FedAvg: каждое обновление сразу складывается в сумму по слоям,
+вес — число примеров, на которых клиент обучался. Память — O(размер модели)
+независимо от числа клиентов; итоговое среднее — одно деление на слой.
+
+AggregationExecutor выносит сложение с event loop и из потока БД: плоские слои режутся
+на примерно равные диапазоны, которые складываются параллельно в пуле потоков
+(numpy отпускает GIL) или процессов (сумма и обновление лежат в multiprocessing.shared_memory).
+
+Со spool-каталогом суммы раунда лежат в memory-mapped файле, а состояние (вклады, веса) —
+в meta.json рядом: после рестарта незавершённый раунд поднимается через FedAvgAccumulator.recover.
+"""
+import asyncio
+import json
+import math
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+ALIGN = 64
+MIN_CHUNK = 1 << 16  # элементов на задачу: мельче — накладные расходы пула дороже сложения
+
+
+def _layout(shapes, dtypes):
+    offsets, pos = [], 0
+    for shape, dtype in zip(shapes, dtypes):
+        pos = (pos + ALIGN - 1) // ALIGN * ALIGN
+        offsets.append(pos)
+        pos += math.prod(shape) * np.dtype(dtype).itemsize
+    return offsets, max(pos, 1)
+
+
+def _views(buf, shapes, dtypes, offsets):
+    return [np.ndarray(tuple(s), dtype=d, buffer=buf, offset=o) for s, d, o in zip(shapes, dtypes, offsets)]
+
+
+class SharedLayers:
+    """Набор слоёв в одном блоке shared memory; в других процессах открывается по spec."""
+
+    def __init__(self, shapes, dtypes, name=None):
+        self.shapes = [tuple(s) for s in shapes]
+        self.dtypes = [np.dtype(d).str for d in dtypes]
+        self.offsets, size = _layout(self.shapes, self.dtypes)
+        self.owner = name is None
+        # воркеры (spawn) делят resource_tracker с родителем, поэтому блок удаляет только создатель
+        self.shm = SharedMemory(create=True, size=size) if self.owner else SharedMemory(name=name)
+        self.layers = _views(self.shm.buf, self.shapes, self.dtypes, self.offsets)
+
+    @property
+    def spec(self):
+        return "shm", self.shm.name, self.shapes, self.dtypes
+
+    def release(self):
+        if self.shm is None:
+            return
+        self.layers = []
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        self.shm = None
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:
+            pass
+
+
+class MappedLayers:
+    """Слои в memory-mapped файле: резидентны только «горячие» страницы, содержимое переживает рестарт."""
+
+    def __init__(self, path, shapes, dtypes, create=True):
+        self.path = path
+        self.shapes = [tuple(s) for s in shapes]
+        self.dtypes = [np.dtype(d).str for d in dtypes]
+        self.offsets, size = _layout(self.shapes, self.dtypes)
+        self.mm = np.memmap(path, dtype=np.uint8, mode="w+" if create else "r+", shape=(size,))
+        self.layers = _views(self.mm, self.shapes, self.dtypes, self.offsets)
+
+    @property
+    def spec(self):
+        return "mmap", self.path, self.shapes, self.dtypes
+
+    def flush(self):
+        if self.mm is not None:
+            self.mm.flush()
+
+    def release(self):
+        if self.mm is None:
+            return
+        self.layers = []
+        self.mm._mmap.close()
+        self.mm = None
+
+
+def _attach(spec):
+    kind, name, shapes, dtypes = spec
+    if kind == "mmap":
+        return MappedLayers(name, shapes, dtypes, create=False)
+    return SharedLayers(shapes, dtypes, name=name)
+
+
+class FedAvgAccumulator:
+    def __init__(self, dtype=np.float64, shared=False, spool=None, round_no=None):
+        self.dtype = np.dtype(dtype)
+        self.round_no = round_no  # раунд, обновления которого копит буфер (None — не привязан)
+        self.shared = shared      # суммы в shared memory — для пула процессов
+        self.spool = spool        # каталог раунда: суммы в mmap-файле + meta.json (переживает рестарт)
+        self.store = None         # SharedLayers / MappedLayers
+        self.tags = {}            # пометки буфера, сохраняются вместе с ним (например, "relative" в async)
+        self.sums = None          # взвешенные суммы по слоям
+        self.total = 0.0          # сумма весов всех клиентов
+        self.base_weight = 0.0    # вес top-k клиентов, чей вклад = база + разреженная поправка
+        self.contributors = set()  # прямые загрузки: устройства и шлюзы
+        self.members = 0           # устройства за ними (шлюз приносит сразу многих)
+
+    def __len__(self):
+        return len(self.contributors)
+
+    def ensure(self, shapes):
+        shapes = [tuple(s) for s in shapes]
+        if self.sums is None:
+            if self.spool:
+                os.makedirs(self.spool, exist_ok=True)
+                self.store = MappedLayers(os.path.join(self.spool, "sums.bin"), shapes, [self.dtype] * len(shapes))
+                self.sums = self.store.layers  # новый файл уже заполнен нулями
+                self._save_meta()
+            elif self.shared:
+                self.store = SharedLayers(shapes, [self.dtype] * len(shapes))
+                self.sums = self.store.layers
+                for acc in self.sums:
+                    acc.fill(0)
+            else:
+                self.sums = [np.zeros(s, dtype=self.dtype) for s in shapes]
+            return
+        if len(shapes) != len(self.sums):
+            raise ValueError(f"Inconsistent number of layers: {len(shapes)} != {len(self.sums)}")
+        for k, (s, acc) in enumerate(zip(shapes, self.sums)):
+            if s != acc.shape:
+                raise ValueError(f"Incompatible shape at layer {k}: {s} != {acc.shape}")
+
+    def begin(self, client_id):
+        # write-ahead: если процесс упадёт посреди сложения, recover увидит pending и не поверит суммам
+        if self.spool:
+            self._save_meta(pending=client_id)
+
+    def commit(self, client_id, num_samples, members=1):
+        self.total += float(num_samples)
+        self.contributors.add(client_id)
+        self.members += int(members)
+        if self.spool:
+            self._save_meta()
+
+    def _save_meta(self, pending=None):
+        meta = {
+            "dtype": self.dtype.str,
+            "round_no": self.round_no,
+            "shapes": [list(a.shape) for a in self.sums],
+            "total": self.total,
+            "base_weight": self.base_weight,
+            "members": self.members,
+            "contributors": [list(c) if isinstance(c, tuple) else c for c in self.contributors],
+            "tags": self.tags,
+            "pending": list(pending) if isinstance(pending, tuple) else pending,
+        }
+        tmp = os.path.join(self.spool, "meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(self.spool, "meta.json"))
+
+    @classmethod
+    def recover(cls, spool):
+        """Поднять буфер раунда из spool-каталога; None — нечего поднимать или сложение было прервано."""
+        try:
+            with open(os.path.join(spool, "meta.json")) as f:
+                meta = json.load(f)
+            if meta.get("pending") is not None:
+                return None
+            acc = cls(meta["dtype"], spool=spool, round_no=meta.get("round_no"))
+            shapes = [tuple(s) for s in meta["shapes"]]
+            acc.store = MappedLayers(os.path.join(spool, "sums.bin"), shapes, [acc.dtype] * len(shapes), create=False)
+        except (OSError, ValueError, KeyError):
+            return None
+        acc.sums = acc.store.layers
+        acc.total = float(meta["total"])
+        acc.base_weight = float(meta["base_weight"])
+        acc.members = int(meta["members"])
+        acc.contributors = {tuple(c) if isinstance(c, list) else c for c in meta["contributors"]}
+        acc.tags = dict(meta.get("tags") or {})
+        return acc
+
+    def add_dense(self, client_id, weights, num_samples=1.0):
+        arrays = [np.asarray(a) for a in weights]
+        self.ensure([a.shape for a in arrays])
+        self.begin(client_id)
+        items = [(k, 0, a.size) for k, a in enumerate(arrays)]
+        _fold_items(self.sums, arrays, items, float(num_samples))
+        self.commit(client_id, num_samples)
+
+    def add_sparse(self, client_id, shapes, update, num_samples=1.0):
+        """update: [(idx, vals)] на слой — поправка к базовой модели раунда."""
+        w = float(num_samples)
+        self.ensure(shapes)
+        self.begin(client_id)
+        for acc, (idx, vals) in zip(self.sums, update):
+            np.add.at(acc.reshape(-1), idx, vals if w == 1.0 else w * vals)
+        self.base_weight += w
+        self.commit(client_id, num_samples)
+
+    def result(self, base=None, dtype=np.float32) -> list:
+        if self.sums is None or self.total <= 0:
+            return None
+        if self.base_weight and base is None:
+            raise ValueError("top-k updates require the round's base model")
+        out = []
+        for k, acc in enumerate(self.sums):
+            layer = acc
+            if self.base_weight:
+                layer = acc + self.base_weight * np.asarray(base[k], dtype=self.dtype)
+            out.append((layer / self.total).astype(dtype, copy=False))
+        return out
+
+    def release(self, keep_spool=False):
+        """Освободить буфер; spool-каталог раунда удаляется, если раунд не нужно поднимать после рестарта."""
+        self.sums = None
+        if self.store is not None:
+            self.store.release()
+            self.store = None
+        if self.spool and not keep_spool:
+            shutil.rmtree(self.spool, ignore_errors=True)
+
+
+# -------------- параллельное сложение --------------
+def _fold_items(sums, arrays, items, weight):
+    """Сложить диапазоны (слой, start, stop) обновления в суммы. Диапазоны разных задач не пересекаются."""
+    for k, start, stop in items:
+        dst = sums[k].reshape(-1)[start:stop]
+        src = arrays[k].reshape(-1)[start:stop]
+        if weight == 1.0:
+            dst += src
+        else:
+            dst += weight * src.astype(dst.dtype, copy=False)
+
+
+def _fold_shared(acc_spec, upd_spec, items, weight):
+    # точка входа процесса-воркера: открываем оба блока по имени/пути, без копирования данных
+    acc = _attach(acc_spec)
+    upd = _attach(upd_spec)
+    try:
+        _fold_items(acc.layers, upd.layers, items, weight)
+    finally:
+        upd.release()
+        acc.release()
+
+
+def _partition(sizes, parts):
+    """Нарезать плоские слои на ``parts`` групп диапазонов примерно равного объёма."""
+    total = sum(sizes)
+    parts = max(1, min(parts, math.ceil(total / MIN_CHUNK) if total else 1))
+    target = math.ceil(total / parts) if total else 0
+    groups, current, filled = [], [], 0
+    for k, size in enumerate(sizes):
+        start = 0
+        while start < size:
+            take = min(size - start, target - filled)
+            current.append((k, start, start + take))
+            start += take
+            filled += take
+            if filled >= target:
+                groups.append(current)
+                current, filled = [], 0
+    if current:
+        groups.append(current)
+    return groups or [[]]
+
+
+class AggregationExecutor:
+    """
+    Пул для агрегации. mode="thread" — потоки (по умолчанию), mode="process" — процессы
+    с суммами и обновлениями в shared memory. Event loop только ждёт future.
+    """
+
+    def __init__(self, workers=None, mode="thread"):
+        self.workers = max(1, int(workers or os.cpu_count() or 1))
+        self.mode = mode
+        self.threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="fl-agg")
+        self.processes = None
+        if mode == "process":
+            self.processes = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context("spawn"))
+
+    def new_accumulator(self, dtype=np.float64, spool=None, round_no=None):
+        return FedAvgAccumulator(dtype, shared=self.processes is not None, spool=spool, round_no=round_no)
+
+    def _submit_fold(self, acc, client_id, arrays, weight):
+        acc.ensure([a.shape for a in arrays])
+        acc.begin(client_id)
+        groups = _partition([a.size for a in arrays], self.workers)
+        if self.processes is None or acc.store is None:
+            return [self.threads.submit(_fold_items, acc.sums, arrays, items, weight) for items in groups], None
+        staged = SharedLayers([a.shape for a in arrays], [a.dtype for a in arrays])
+        for dst, src in zip(staged.layers, arrays):
+            dst[...] = src
+        futures = [self.processes.submit(_fold_shared, acc.store.spec, staged.spec, items, weight) for items in groups]
+        return futures, staged
+
+    async def fold(self, acc, client_id, weights, num_samples=1.0, scale=None, members=1):
+        """
+        Сложить обновление с множителем ``scale`` (по умолчанию — num_samples) и добавить num_samples
+        к знаменателю. Частичная сумма шлюза: scale=1, num_samples — сумма примеров его устройств.
+        """
+        arrays = [np.asarray(a) for a in weights]
+        scale = float(num_samples if scale is None else scale)
+        loop = asyncio.get_running_loop()
+        # ensure/стейджинг — O(модели), тоже не на event loop
+        futures, staged = await loop.run_in_executor(self.threads, self._submit_fold, acc, client_id, arrays, scale)
+        try:
+            await asyncio.gather(*(asyncio.wrap_future(f) for f in futures))
+        finally:
+            if staged is not None:
+                staged.release()
+        acc.commit(client_id, num_samples, members)
+
+    def fold_blocking(self, acc, client_id, weights, num_samples=1.0, scale=None, members=1):
+        """То же для синхронного кода (HTTP-вьюхи)."""
+        arrays = [np.asarray(a) for a in weights]
+        scale = float(num_samples if scale is None else scale)
+        futures, staged = self._submit_fold(acc, client_id, arrays, scale)
+        try:
+            for f in futures:
+                f.result()
+        finally:
+            if staged is not None:
+                staged.release()
+        acc.commit(client_id, num_samples, members)
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.threads, fn, *args)
+
+    def shutdown(self):
+        self.threads.shutdown(wait=False)
+        if self.processes is not None:
+            self.processes.shutdown(wait=False)
+
+
+_executor = None
+
+
+def get_executor() -> AggregationExecutor:
+    """Общий на процесс пул агрегации (FL_AGG_WORKERS, FL_AGG_MODE)."""
+    global _executor
+    if _executor is None:
+        from django.conf import settings
+        _executor = AggregationExecutor(
+            workers=getattr(settings, "FL_AGG_WORKERS", None),
+            mode=getattr(settings, "FL_AGG_MODE", "thread"),
+        )
+    return _executor
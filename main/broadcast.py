@@ -0,0 +1,62 @@
+# broadcast.py
+"""
+Рассылка одного сообщения многим сокетам: сериализуем один раз, шлём один и тот же буфер.
+"""
+import json
+
+
+class Frame:
+    """Готовый WebSocket-кадр: либо text, либо bytes. Неизменяемый — можно слать сколько угодно раз."""
+
+    __slots__ = ("text_data", "bytes_data")
+
+    def __init__(self, text_data: str = None, bytes_data: bytes = None):
+        if (text_data is None) == (bytes_data is None):
+            raise ValueError("Frame needs exactly one of text_data or bytes_data")
+        object.__setattr__(self, "text_data", text_data)
+        object.__setattr__(self, "bytes_data", bytes(bytes_data) if bytes_data is not None else None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Frame is immutable")
+
+    @classmethod
+    def from_message(cls, message: dict) -> "Frame":
+        return cls(text_data=json.dumps(message))
+
+    def __len__(self):
+        return len(self.text_data) if self.text_data is not None else len(self.bytes_data)
+
+    async def send(self, consumer):
+        if self.text_data is not None:
+            await consumer.send(text_data=self.text_data)
+        else:
+            await consumer.send(bytes_data=self.bytes_data)
+
+
+async def fan_out(clients, frame: Frame) -> int:
+    """Отправить кадр всем клиентам; упавшие сокеты пропускаем. Возвращает число доставленных."""
+    sent = 0
+    for client in list(clients):
+        try:
+            await frame.send(client)
+            sent += 1
+        except Exception:
+            continue
+    return sent
+
+
+async def fan_out_variants(clients, variant_of, encode) -> int:
+    """
+    Рассылка, когда клиентам нужны разные представления одного сообщения
+    (например, бинарный кадр и legacy-JSON). Клиенты группируются по ``variant_of(client)``,
+    ``encode(variant)`` (корутина) вызывается один раз на группу.
+    """
+    groups = {}
+    for client in list(clients):
+        groups.setdefault(variant_of(client), []).append(client)
+    sent = 0
+    for variant, members in groups.items():
+        frame = await encode(variant)
+        if frame is not None:
+            sent += await fan_out(members, frame)
+    return sent
@@ -0,0 +1,215 @@
+# checkpoints.py
+"""
+Хранилище чекпоинтов глобальной модели: каждый раунд — контейнер tensors.pack_container,
+адресуемый хешем содержимого (<root>/<hh>/<hash>.<suffix>). Одинаковые модели лежат одним файлом.
+
+Файл бывает двух видов:
+  * ключевой кадр (.bilt) — контейнер как есть; чтение ленивое через np.memmap, слои — представления;
+  * дельта (.bild) — XOR байтов контейнера с базовым чекпоинтом (обычно предыдущий раунд),
+    байты разложены по плоскостям float32 и сжаты deflate. Соседние раунды отличаются в основном
+    младшими битами мантиссы, поэтому знак/экспонента в XOR почти всегда нули и хорошо сжимаются.
+    XOR обратим без потерь (в отличие от арифметической разности float).
+
+Восстановление дельты идёт по цепочке до ключевого кадра или до раунда из LRU-кеша
+недавно собранных контейнеров; длину цепочки ограничивает частота ключевых кадров у вызывающего.
+
+Индекс (какой раунд какого Train в каком файле, база дельты, размер, метрики) — таблица Checkpoint.
+"""
+import hashlib
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from .tensors import pack_container, unpack_container
+
+SUFFIX = ".bilt"
+DELTA_SUFFIX = ".bild"
+DELTA_MAGIC = b"BILD"
+DELTA_VERSION = 1
+DELTA_HEADER = struct.Struct("<4sBB2x16sQ")  # magic, версия, ширина плоскостей, база (digest), длина контейнера
+PLANE = 4  # float32: байты слоёв выровнены по 4 внутри контейнера
+
+
+def _digest(blob) -> str:
+    return hashlib.blake2b(blob, digest_size=16).hexdigest()
+
+
+def _shuffle(x: np.ndarray, width: int) -> np.ndarray:
+    n = len(x) - len(x) % width
+    return np.concatenate([x[:n].reshape(-1, width).T.reshape(-1), x[n:]])
+
+
+def _unshuffle(x: np.ndarray, width: int) -> np.ndarray:
+    n = len(x) - len(x) % width
+    return np.concatenate([x[:n].reshape(width, -1).T.reshape(-1), x[n:]])
+
+
+def encode_delta(blob, base, base_hash: str, level: int = 1) -> bytes:
+    """Дельта-файл: заголовок + deflate(плоскости(blob XOR base)). Контейнеры одной длины."""
+    x = np.frombuffer(blob, dtype=np.uint8) ^ np.frombuffer(base, dtype=np.uint8)
+    header = DELTA_HEADER.pack(DELTA_MAGIC, DELTA_VERSION, PLANE, bytes.fromhex(base_hash), len(blob))
+    return header + zlib.compress(_shuffle(x, PLANE).tobytes(), level)
+
+
+def read_delta_header(buf):
+    """(база, ширина плоскостей, длина контейнера) из заголовка дельты."""
+    magic, version, width, base, length = DELTA_HEADER.unpack_from(buf, 0)
+    if magic != DELTA_MAGIC or version != DELTA_VERSION or width < 1:
+        raise ValueError("not a checkpoint delta")
+    return base.hex(), width, length
+
+
+def apply_delta(delta, base) -> bytes:
+    _, width, length = read_delta_header(delta)
+    x = np.frombuffer(zlib.decompress(memoryview(delta)[DELTA_HEADER.size:]), dtype=np.uint8)
+    if len(x) != length or len(base) != length:
+        raise ValueError("checkpoint delta does not match its base")
+    return (_unshuffle(x, width) ^ np.frombuffer(base, dtype=np.uint8)).tobytes()
+
+
+class CheckpointStore:
+    def __init__(self, root, cache_size: int = 4, level: int = 1):
+        self.root = str(root)
+        self.cache_size = cache_size
+        self.level = level
+        self._cache = OrderedDict()  # hash -> байты контейнера (LRU)
+        self._lock = threading.Lock()
+
+    def path(self, content_hash: str, suffix: str = SUFFIX) -> str:
+        return os.path.join(self.root, content_hash[:2], content_hash + suffix)
+
+    def exists(self, content_hash: str) -> bool:
+        return os.path.exists(self.path(content_hash)) or os.path.exists(self.path(content_hash, DELTA_SUFFIX))
+
+    def put(self, arrays=None, blob=None, base=None):
+        """
+        Записать модель (или готовый контейнер); возвращает (hash, размер на диске, база или None).
+        С ``base`` пишется дельта, если база той же формы и дельта меньше контейнера,
+        иначе ключевой кадр. Повторная запись того же содержимого — no-op.
+        """
+        blob = bytes(blob) if blob is not None else pack_container(arrays)
+        content_hash = _digest(blob)
+        self._remember(content_hash, blob)  # следующий раунд возьмёт его базой без восстановления
+        if self.exists(content_hash):
+            return content_hash, self.stored_size(content_hash), self.base_of(content_hash)
+
+        data, suffix = blob, SUFFIX
+        if base is not None and base != content_hash and self.exists(base):
+            base_blob = self.blob(base)
+            if len(base_blob) == len(blob):
+                delta = encode_delta(blob, base_blob, base, self.level)
+                if len(delta) < len(blob):
+                    data, suffix = delta, DELTA_SUFFIX
+        if suffix == SUFFIX:
+            base = None
+        self._write(self.path(content_hash, suffix), data)
+        return content_hash, len(data), base
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def base_of(self, content_hash: str):
+        """База дельты или None для ключевого кадра."""
+        try:
+            with open(self.path(content_hash, DELTA_SUFFIX), "rb") as f:
+                return read_delta_header(f.read(DELTA_HEADER.size))[0]
+        except FileNotFoundError:
+            return None
+
+    def stored_size(self, content_hash: str) -> int:
+        for suffix in (SUFFIX, DELTA_SUFFIX):
+            try:
+                return os.path.getsize(self.path(content_hash, suffix))
+            except FileNotFoundError:
+                pass
+        return 0
+
+    def blob(self, content_hash: str):
+        """
+        Байты контейнера. Ключевой кадр — memmap; дельта — восстановление по цепочке:
+        идём к базе до кеша или ключевого кадра, затем накладываем дельты вперёд.
+        """
+        chain, h = [], content_hash
+        while True:
+            with self._lock:
+                hit = self._cache.get(h)
+                if hit is not None:
+                    self._cache.move_to_end(h)
+            if hit is not None:
+                buf = hit
+                break
+            if os.path.exists(self.path(h)):
+                buf = np.memmap(self.path(h), dtype=np.uint8, mode="r")
+                break
+            with open(self.path(h, DELTA_SUFFIX), "rb") as f:
+                delta = f.read()
+            chain.append((h, delta))
+            h = read_delta_header(delta)[0]
+        for h, delta in reversed(chain):
+            buf = apply_delta(delta, buf)
+            self._remember(h, buf)
+        return buf
+
+    def _remember(self, content_hash, blob):
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[content_hash] = blob
+            self._cache.move_to_end(content_hash)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def load(self, content_hash: str) -> list:
+        """Слои чекпоинта — read-only представления (над memmap ключевого кадра или собранным контейнером)."""
+        return unpack_container(self.blob(content_hash))
+
+    def delete(self, content_hash: str):
+        with self._lock:
+            self._cache.pop(content_hash, None)
+        for suffix in (SUFFIX, DELTA_SUFFIX):
+            try:
+                os.remove(self.path(content_hash, suffix))
+            except FileNotFoundError:
+                pass
+
+
+def retained_rounds(rows, keep_last, keep_every, keep_best, current=None):
+    """
+    Какие раунды оставить: последние keep_last (0 — всю историю), каждый keep_every-й,
+    лучший по accuracy и текущий (на него указывает Train). rows — [(round_number, accuracy)].
+    """
+    rounds = sorted(r for r, _ in rows)
+    if keep_last <= 0:
+        return set(rounds)
+    keep = set(rounds[-keep_last:])
+    if keep_every > 0:
+        keep.update(r for r in rounds if r % keep_every == 0)
+    if keep_best:
+        scored = [(acc, r) for r, acc in rows if acc is not None]
+        if scored:
+            keep.add(max(scored)[1])
+    if current is not None:
+        keep.add(current)
+    return keep
+
+
+_store = None
+
+
+def get_store() -> CheckpointStore:
+    global _store
+    if _store is None:
+        from django.conf import settings
+        _store = CheckpointStore(
+            getattr(settings, "FL_CHECKPOINT_DIR", "checkpoints"),
+            cache_size=getattr(settings, "FL_CHECKPOINT_CACHE", 4),
+        )
+    return _store
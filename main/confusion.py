@@ -0,0 +1,55 @@
+# confusion.py
+"""
+Сумма confusion/support по участникам раунда. Консьюмер держит по аккумулятору на (train, round)
+в состоянии агрегации и добавляет метрики устройства один раз при получении — UI получает
+онлайн-матрицу из памяти, без повторного разбора всех RoundResult раунда.
+"""
+import numpy as np
+
+
+class ConfusionAccumulator:
+    __slots__ = ("confusion", "support", "classes", "keys")
+
+    def __init__(self):
+        self.confusion = None
+        self.support = None
+        self.classes = None
+        self.keys = set()  # id учтённых RoundResult — повторно не складываются
+
+    @staticmethod
+    def _add(total, value):
+        arr = np.asarray(value, dtype=np.float64)
+        if total is None:
+            return arr.copy()
+        if arr.shape != total.shape:
+            raise ValueError(f"shape {arr.shape} != {total.shape}")
+        total += arr
+        return total
+
+    def add(self, metrics, key=None):
+        """Учесть метрики одного результата; кривая матрица (не та форма/не числа) пропускается."""
+        if key is not None:
+            if key in self.keys:
+                return
+            self.keys.add(key)
+        if not isinstance(metrics, dict):
+            return
+        try:
+            if metrics.get("confusion") is not None:
+                self.confusion = self._add(self.confusion, metrics["confusion"])
+            if metrics.get("support") is not None:
+                self.support = self._add(self.support, metrics["support"])
+        except (TypeError, ValueError):
+            pass
+        if self.classes is None:
+            self.classes = metrics.get("classes")
+
+    def result(self):
+        """{"confusion", "support", "classes"} списками (как отдаёт UI) или None, если матриц не было."""
+        if self.confusion is None:
+            return None
+        return {
+            "confusion": self.confusion.tolist(),
+            "support": self.support.tolist() if self.support is not None else None,
+            "classes": self.classes,
+        }
@@ -3,14 +3,29 @@ from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 
 
-import json, pickle, asyncio, logging
+import json, asyncio, datetime, logging, math, os, random, shutil
 import numpy as np
 from django.utils.timezone import now
 from django.conf import settings
 from cryptography.fernet import Fernet, InvalidToken
 import weakref
 from django.db import transaction
+from django.db.models import BooleanField, ExpressionWrapper, F, Q
 from channels.db import database_sync_to_async
+from .aggregation import FedAvgAccumulator, get_executor
+from .broadcast import Frame, fan_out, fan_out_variants
+from .confusion import ConfusionAccumulator
+from .latency import LatencyTracker
+from .trainstate import trains
+from .uploads import UploadError, UploadRegistry
+from .writebehind import get_prediction_buffer, get_presence_buffer
+from .tensors import (
+    FrameError, StaleBaseError, split_frame, decode_body, encode_frame,
+    decode_legacy_payload, encode_legacy_payload, apply_delta,
+    QUANT_MODES, quantize, dequantize, quantization_error, weights_version,
+    decode_sparse, merge_sparse, topk_split,
+)
+from .checkpoints import get_store
 
 logger = logging.getLogger(__name__)
 
@@ -78,11 +93,7 @@ class DeviceStatusConsumer(AsyncWebsocketConsumer):
         await self.send_error("Unsupported message type")
 
     async def broadcast_all(self, message):
-        for client in list(self.connected_clients):
-            try:
-                await client.send(json.dumps(message))
-            except Exception:
-                continue
+        await fan_out(self.connected_clients, Frame.from_message(message))
 
     async def _handle_prediction(self, data):
         device_token = data.get("device_token")
@@ -113,7 +124,7 @@ class DeviceStatusConsumer(AsyncWebsocketConsumer):
         }
 
         await self._touch_device(device)
-        await self._store_prediction(device, data)
+        self._store_prediction(device, data)
 
         await self.send(json.dumps({"type": "ack", "status": "ok"}))
 
@@ -133,17 +144,15 @@ class DeviceStatusConsumer(AsyncWebsocketConsumer):
         }
         await self.broadcast_all(payload_msg)
 
-    @database_sync_to_async
-    def _touch_device(self, device):
-        device.last_seen = now()
-        device.is_online = True
-        device.save(update_fields=["last_seen", "is_online"])
+    async def _touch_device(self, device):
+        # last_seen/is_online копятся в памяти и пишутся пакетом (PresenceBuffer)
+        get_presence_buffer().touch(device)
 
-    @database_sync_to_async
     def _store_prediction(self, device, payload):
+        # в очередь write-behind: строка попадёт в БД пакетным bulk_create, ack её не ждёт
         from .models import PredictResult
 
-        PredictResult.objects.create(
+        get_prediction_buffer().add(PredictResult(
             device=device,
             results={
                 "prediction": payload.get("prediction"),
@@ -155,7 +164,7 @@ class DeviceStatusConsumer(AsyncWebsocketConsumer):
                 "source": payload.get("source"),
                 "timestamp": payload.get("timestamp"),
             }
-        )
+        ))
 
 
 class DeviceControlConsumer(AsyncWebsocketConsumer):
@@ -320,11 +329,7 @@ class DeviceControlConsumer(AsyncWebsocketConsumer):
         await self.send(json.dumps({"type": "devices_snapshot", "items": summary}))
 
     async def _broadcast_ui(self, message):
-        for client in list(self.ui_clients):
-            try:
-                await client.send(json.dumps(message))
-            except Exception:
-                continue
+        await fan_out(self.ui_clients, Frame.from_message(message))
 
     @classmethod
     async def send_command(cls, device_id, payload):
@@ -347,11 +352,9 @@ class DeviceControlConsumer(AsyncWebsocketConsumer):
             if self.device_clients.get(device_id) is self:
                 self.device_clients.pop(device_id, None)
 
-    @database_sync_to_async
-    def _touch_device(self, device):
-        device.last_seen = now()
-        device.is_online = True
-        device.save(update_fields=["last_seen", "is_online"])
+    async def _touch_device(self, device):
+        # last_seen/is_online копятся в памяти и пишутся пакетом (PresenceBuffer)
+        get_presence_buffer().touch(device)
 
     @database_sync_to_async
     def get_device(self, token):
@@ -376,7 +379,18 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
     aggregations = {}
     agg_init_lock = asyncio.Lock()
 
-    AGG_TIMEOUT_SEC = 20
+    # таймаут раунда, пока нет истории задержек; дальше дедлайн считает _set_round_deadline
+    AGG_TIMEOUT_SEC = getattr(settings, "FL_AGG_TIMEOUT_SEC", 20)
+    # задержки «рассылка -> загрузка» по (модель, устройство) — для адаптивного дедлайна
+    latency = LatencyTracker(
+        decay=getattr(settings, "FL_LATENCY_DECAY", 0.95),
+        min_samples=getattr(settings, "FL_LATENCY_MIN_SAMPLES", 3),
+    )
+    # незавершённые чанковые загрузки весов (переживают переподключение клиента)
+    uploads = UploadRegistry(
+        max_bytes=getattr(settings, "FL_UPLOAD_MAX_BYTES", 512 * 1024 * 1024),
+        ttl=getattr(settings, "FL_UPLOAD_TTL_SEC", 600),
+    )
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -389,6 +403,9 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
         self.train = None
         self.timeout_task = None
         self.is_ui = False
+        self.binary_weights = False  # клиент принимает global_weights бинарным кадром
+        self.quant_modes = []        # поддерживаемые клиентом режимы квантизации (из hello)
+        self.weights_version = None  # версия global_weights, которая уже есть у клиента
 
     # -------------- lifecycle --------------
     async def connect(self):
@@ -408,30 +425,90 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
 
     # -------------- helpers: UI emit + broadcast --------------
     async def ui_message(self, event):
-        # handler для group_send(type="ui.message", ...)
-        await self.send(json.dumps(event["message"]))
+        # handler для group_send(type="ui.message", ...): кадр уже сериализован отправителем
+        if "text" in event:
+            await self.send(event["text"])
+        else:
+            await self.send(json.dumps(event["message"]))
 
-    async def ui_emit(self, message: dict):
+    async def ui_emit(self, message: dict, frame: Frame = None):
         """Отправить только в UI-группу."""
         if self.channel_layer:
-            await self.channel_layer.group_send("ui_training", {"type": "ui.message", "message": message})
+            frame = frame or Frame.from_message(message)
+            await self.channel_layer.group_send("ui_training", {"type": "ui.message", "text": frame.text_data})
 
     async def ui_log(self, text: str):
         await self.ui_emit({"type": "train_log", "text": text})
 
     async def broadcast_all(self, message: dict):
         """Рассылка всем подключенным сокетам (устройствам и UI) + в UI-группу."""
+        frame = Frame.from_message(message)
         # прямые соединения
-        for c in list(self.connected_clients):
-            try:
-                await c.send(json.dumps(message))
-            except Exception:
-                pass
+        await fan_out(self.connected_clients, frame)
         # UI-группа (на случай, если часть UI только в группе)
+        await self.ui_emit(message, frame)
+
+    async def announce_round(self, message: dict):
+        """
+        start_training раунда: при выборке клиентов — выбранным (с "selected": true),
+        остальным устройствам — round_idle; UI получает исходное сообщение.
+        """
+        st = await self._get_agg_state(message["train_id"])
+        selected = st.get("selected")
+        if selected is None:
+            await self.broadcast_all(message)
+            return
+        frames = {
+            "run": Frame.from_message({**message, "selected": True}),
+            "idle": Frame.from_message({"type": "round_idle", "round": message["round"], "train_id": message["train_id"]}),
+        }
+
+        def variant(c):
+            device = getattr(c, "device", None)
+            return "run" if device is None or device.id in selected else "idle"
+
+        async def encode(v):
+            return frames[v]
+
+        await fan_out_variants(self.connected_clients, variant, encode)
+        await self.ui_emit({**message, "selected": len(selected), "target": st.get("target")})
+
+    async def broadcast_weights(self, message: dict, weights):
+        """
+        global_weights: бинарным клиентам — кадр (заголовок + тело), остальным — JSON с hex(pickle),
+        а тем, у кого уже эта версия (message["version"]), — короткое weights_current.
+        Каждый формат кодируется один раз и вне event loop.
+        """
+        model = message.get("model")
+        clients = list(self.connected_clients)
+
+        async def encode(variant):
+            return await asyncio.to_thread(_encode_weights_frame, message, weights, *variant)
+
+        await fan_out_variants(clients, lambda c: _weights_variant(c, model, message.get("version")), encode)
+        for c in clients:
+            if getattr(c, "device", None):
+                c.weights_version = message.get("version")
         await self.ui_emit(message)
 
+    async def send_weights(self, message: dict, weights):
+        variant = _weights_variant(self, message.get("model"), message.get("version"))
+        frame = await asyncio.to_thread(_encode_weights_frame, message, weights, *variant)
+        await frame.send(self)
+        self.weights_version = message.get("version")
+
+    @staticmethod
+    def _report_version(client, data):
+        # клиент сообщает версию global_weights, которая у него уже загружена
+        version = data.get("weights_version")
+        client.weights_version = str(version) if version else None
+
     # -------------- receive --------------
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            await self.receive_frame(bytes_data)
+            return
+
         data = json.loads(text_data or "{}")
         t = data.get("type")
 
@@ -439,23 +516,33 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
             self.device = await self.get_device(data.get("device_token"))
             if not self.device:
                 await self.close(code=4001); return
-
-            # если уже есть активная Train и глобальные веса — отдать
-            if self.train and self.train.get("global_weights"):
-                await self.send(json.dumps({
+            caps = data.get("capabilities") or {}
+            if not isinstance(caps, dict):
+                caps = {}
+            self.binary_weights = bool(caps.get("binary_weights"))
+            self.weights_as_lists = bool(caps.get("weights_as_lists"))
+            modes = caps.get("quantization") or []
+            self.quant_modes = [m for m in (modes if isinstance(modes, list) else [modes]) if m in QUANT_MODES]
+            self._report_version(self, data)
+
+            # если уже есть активная Train и глобальные веса — отдать (или подтвердить, что версия актуальна)
+            if self.train and self.train.get("has_global_weights"):
+                current = await self._current_global()
+                await self.send_weights({
                     "type": "global_weights",
-                    "payload": pickle.dumps(self.train["global_weights"]).hex(),
                     "round":   self.train["round_count"],
                     "accuracy": None,
                     "model": self.train["model_name"],
                     "train_id": self.train["id"],
-                }))
+                    "version": current["version"],
+                }, current["weights"])
             await self.ui_log(f"Подключен {self.device.name}")
 
         elif t == "subscribe":
             self.device = await self.get_device(data.get("device_token"))
             if not self.device:
                 await self.close(code=4001); return
+            self._report_version(self, data)
 
             msg = {
                 "type": "subscribe",
@@ -483,6 +570,9 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
             model = (data.get("model") or "dnn").lower()
             max_rounds = int(data.get("rounds") or 50)
             epochs = int(data.get("epochs") or 10)
+            topk = _topk_fraction(data.get("topk", getattr(settings, "FL_TOPK_FRACTION", None)))
+            async_cfg = _async_config(data)
+            sampling = _sampling_config(data)
 
             self.train = await self.get_or_create_today_train(model, max_rounds, epochs)
             self.current_model = self.train["model_name"]
@@ -491,9 +581,29 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
             agg = await self._get_agg_state(self.train["id"])
             async with agg["lock"]:
                 agg["training_clients"] = {c.device.id for c in self.connected_clients if getattr(c, "device", None)}
-                agg["round_weights"] = {}
-                agg["round_deadline"] = loop.time() + self.AGG_TIMEOUT_SEC
-            await self._schedule_timeout_shared(self.train["id"], self.train["round_count"])
+                agg["sampling"] = None if async_cfg else sampling
+                sampling_note = self._select_round_clients(agg)
+                agg["round_acc"].release()  # сброс раунда: старый буфер (и его spool) больше не нужен
+                agg["round_acc"] = _new_accumulator(self.train["id"], self.train["round_count"])
+                if async_cfg:
+                    # дельты копятся, только если есть глобальная версия, к которой их прибавлять
+                    agg["round_acc"].tags["relative"] = (
+                        agg.get("global_version") is not None or bool(self.train.get("has_global_weights")))
+                agg["round_transport"] = {}
+                agg["residuals"] = {}
+                agg["topk"] = topk
+                agg["async"] = async_cfg
+                agg["history"] = {}
+                agg["applying"] = False
+                agg["staleness"] = []
+                agg["aggregating"] = None
+                agg["round_deadline"] = None
+                deadline_reason = None if async_cfg else self._set_round_deadline(agg)
+                tt = agg.get("timeout_task")
+                if async_cfg and tt and not tt.done():
+                    tt.cancel()  # в асинхронном режиме барьера раунда нет
+            if not async_cfg:
+                await self._schedule_timeout_shared(self.train["id"], self.train["round_count"])
 
             payload_msg = {
                 "type": "start_training",
@@ -502,19 +612,29 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
                 "rounds": self.train["max_rounds"],
                 "train_id": self.train["id"],
             }
-            await self.broadcast_all(payload_msg)
+            if topk:
+                payload_msg["topk"] = topk
+            if async_cfg:
+                # клиенты обучаются непрерывно: шлют обновление с base_round и берут последнюю global_weights
+                payload_msg.update({"mode": "async", "buffer_k": async_cfg["k"]})
+            await self.announce_round(payload_msg)
             await self.ui_log(f"? Старт обучения: {self.current_model}, раунд с {self.train['round_count']}")
+            if sampling_note:
+                await self.ui_log(sampling_note)
+            if deadline_reason:
+                await self.ui_log(deadline_reason)
 
-            if self.train.get("global_weights"):
+            if self.train.get("has_global_weights"):
+                current = await self._current_global()
                 payload_msg = {
                     "type": "global_weights",
-                    "payload": pickle.dumps(self.train["global_weights"]).hex(),
                     "round":   self.train["round_count"],
                     "accuracy": None,
                     "model": self.current_model,
                     "train_id": self.train["id"],
+                    "version": current["version"],
                 }
-                await self.broadcast_all(payload_msg)
+                await self.broadcast_weights(payload_msg, current["weights"])
 
         elif t == "weights":
             # Получены локальные веса/метрики от клиента
@@ -523,56 +643,276 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
             self.train = await self.get_train_by_id(data.get("train_id"))
             await self.process_weights(data)
 
+        elif t == "upload_begin":
+            await self.upload_begin(data)
+
+        elif t == "upload_commit":
+            await self.upload_commit(data)
+
         else:
             await self.close(code=4002)
 
+    async def receive_frame(self, raw: bytes):
+        """Бинарный кадр: JSON-заголовок разбираем здесь, тензоры — в process_weights вне event loop."""
+        try:
+            header, body = split_frame(raw)
+        except FrameError as e:
+            logger.warning("Bad binary frame: %s", e)
+            await self.close(code=4003); return
+
+        if header.get("type") == "upload_chunk":
+            await self.upload_chunk(header, body); return
+        if header.get("type") != "weights":
+            await self.close(code=4002); return
+        # клиент, умеющий слать кадры, умеет и принимать их
+        self.binary_weights = True
+        header["body"] = body
+        self.train = await self.get_train_by_id(header.get("train_id"))
+        await self.process_weights(header)
+
+    # -------------- chunked upload: begin -> chunk x N -> commit --------------
+    UPLOAD_META_KEYS = ("type", "upload_id", "total_size", "crc32", "device_token")
+
+    async def upload_begin(self, data):
+        if not self.device:
+            await self.close(code=4001); return
+        upload_id = str(data.get("upload_id") or "")
+        header = {k: v for k, v in data.items() if k not in self.UPLOAD_META_KEYS}
+        header["type"] = "weights"
+        try:
+            if not upload_id:
+                raise UploadError("upload_id is required")
+            upload = self.uploads.begin(self.device.id, upload_id, header, int(data.get("total_size") or 0), data.get("crc32"))
+        except (UploadError, TypeError, ValueError) as e:
+            await self._upload_error(upload_id, e); return
+        # при возобновлении клиент продолжает с этого offset
+        await self.send(json.dumps({"type": "upload_ack", "upload_id": upload_id, "offset": upload.received}))
+
+    async def upload_chunk(self, header, chunk):
+        if not self.device:
+            await self.close(code=4001); return
+        upload_id = str(header.get("upload_id") or "")
+        try:
+            upload = self.uploads.get(self.device.id, upload_id)
+            received = upload.write(int(header.get("offset", -1)), chunk)
+        except (UploadError, TypeError, ValueError) as e:
+            await self._upload_error(upload_id, e); return
+        await self.send(json.dumps({"type": "upload_ack", "upload_id": upload_id, "offset": received}))
+
+    async def upload_commit(self, data):
+        if not self.device:
+            await self.close(code=4001); return
+        upload_id = str(data.get("upload_id") or "")
+        try:
+            upload = self.uploads.get(self.device.id, upload_id)
+            body = await asyncio.to_thread(upload.body)
+        except UploadError as e:
+            await self._upload_error(upload_id, e); return
+        header = dict(upload.header)
+        header["body"] = body
+        self.train = await self.get_train_by_id(header.get("train_id"))
+        try:
+            await self.process_weights(header)
+        finally:
+            self.uploads.pop(self.device.id, upload_id)
+        await self.send(json.dumps({"type": "upload_done", "upload_id": upload_id}))
+
+    async def _upload_error(self, upload_id, error):
+        upload = self.uploads.items.get((getattr(self.device, "id", None), upload_id))
+        await self.send(json.dumps({
+            "type": "upload_error",
+            "upload_id": upload_id,
+            "message": str(error),
+            "offset": upload.received if upload else 0,
+        }))
+
+    async def _decode_weights(self, data):
+        if data.get("body") is not None:
+            body = data["body"]
+            weights = await asyncio.to_thread(decode_body, data, body, self.uploads.max_bytes)
+        else:
+            weights = await asyncio.to_thread(decode_legacy_payload, data["payload"])
+
+        # encoding=topk: пары (индексы, значения) на слой относительно версии base_round
+        if data.get("encoding") == "topk":
+            base = await self._get_global_base(data.get("base_round"))
+            return await asyncio.to_thread(decode_sparse, weights, [b.shape for b in base])
+
+        # квантованный транспорт: int8 со scale/zero_point по слоям или float16
+        if data.get("quantization"):
+            weights = await asyncio.to_thread(dequantize, weights, data["quantization"], data.get("quant"))
+
+        # encoding=delta: клиент прислал разницу с глобальной версией base_round
+        if data.get("encoding") == "delta":
+            base = await self._get_global_base(data.get("base_round"))
+            weights = await asyncio.to_thread(apply_delta, base, weights)
+        return weights
+
+    async def _current_global(self):
+        """Кешированная глобальная модель текущего раунда {"round", "weights", "version"}; при промахе — из Train."""
+        st = await self._get_agg_state(self.train["id"])
+        cached = st.get("global_version")
+        if (cached is None or cached["round"] != self.train["round_count"]) and self.train.get("has_global_weights"):
+            arrays = await self.load_global_weights(self.train["id"])
+            cached = await self._cache_global(self.train["id"], self.train["round_count"], arrays)
+        return cached
+
+    async def _get_global_base(self, base_round):
+        st = await self._get_agg_state(self.train["id"])
+        cached = st.get("global_version")
+        if cached is None and self.train.get("has_global_weights"):
+            # после рестарта кеша нет — поднимаем из Train
+            cached = await self._current_global()
+        try:
+            base_round = int(base_round)
+        except (TypeError, ValueError):
+            raise StaleBaseError("base_round is required for delta updates")
+        if cached is not None and cached["round"] == base_round:
+            return cached["weights"]
+        if base_round in st["history"]:
+            return st["history"][base_round]
+        raise StaleBaseError(f"base_round {base_round} is not the current global version")
+
+    async def _cache_global(self, train_id, round_no, arrays):
+        version = await asyncio.to_thread(weights_version, arrays)
+        st = await self._get_agg_state(train_id)
+        st["global_version"] = {"round": int(round_no), "weights": arrays, "version": version}
+        trains.update(train_id, version=version)
+        if st.get("async"):
+            # последние версии — база для обновлений, обученных на них (устарелость <= max_staleness)
+            st["history"][int(round_no)] = arrays
+            for r in [r for r in st["history"] if r < int(round_no) - st["async"]["max_staleness"]]:
+                del st["history"][r]
+        return st["global_version"]
+
     # -------------- core per-message --------------
     async def process_weights(self, data):
         if not self.device or not self.train:
             return
 
-        weights  = pickle.loads(bytes.fromhex(data["payload"]))
+        try:
+            partial = _partial_update(data)
+        except ValueError as e:
+            await self.send(json.dumps({"type": "error", "message": f"Invalid partial update: {e}"}))
+            return
+        agg = await self._get_agg_state(self.train["id"])
+        discard = None if agg.get("async") else self._discard_reason(agg, data)
+        if discard:
+            await self.send(json.dumps({
+                "type": "update_discarded", "reason": discard,
+                "round": self.train["round_count"], "train_id": self.train["id"],
+            }))
+            return
+        if agg.get("async") and data.get("encoding") == "topk":
+            await self.send(json.dumps({"type": "error", "message": "top-k updates are not supported in async mode"}))
+            return
+        try:
+            weights = await self._decode_weights(data)
+        except StaleBaseError as e:
+            # дельта от устаревшей версии — просим полные веса
+            await self.send(json.dumps({
+                "type": "resend_full",
+                "reason": str(e),
+                "round": self.train["round_count"],
+                "train_id": self.train["id"],
+            }))
+            return
+        except Exception as e:
+            logger.warning("Rejected weights from %s: %s", getattr(self.device, "name", "?"), e)
+            await self.send(json.dumps({"type": "error", "message": "Invalid weights payload"}))
+            return
         round_no = int(data.get("round") or self.train["round_count"])
+        if agg.get("async"):
+            round_no = self.train["round_count"]  # метрики относим к версии, на которой обновление принято
         metrics  = self._normalize_metrics(data.get("metrics"), round_no)
+        metrics["transport"] = data.get("quantization") or "float32"
 
         print(f"Received weights from {self.device.name} for round {round_no}")
         print(f"Metrics: {metrics}")
         print(f"Weights layers: {len(weights)}")
+        sparse = data.get("encoding") == "topk"
+        num_samples = _num_samples(data)
 
         # 1) сохранить per-device метрики/строку
         local_data = await self.get_or_create_local_data(self.device)
-        await self.save_device_round_result(self.device, local_data, round_no, metrics, train_id=self.train["id"])
+        result_id = await self.save_device_round_result(self.device, local_data, round_no, metrics, train_id=self.train["id"])
 
         # 2) UI: онлайн-обновление графика Loss (если есть)
         if isinstance(metrics, dict) and (metrics.get("loss") is not None):
             await self.ui_emit({"type": "train_loss", "round": round_no, "loss": metrics.get("loss")})
 
+        if agg.get("async"):
+            await self._buffer_async(agg, data, weights, partial, num_samples, metrics)
+            return
+
         # 3) сложить веса в буфер текущего раунда
         have_snapshot = set()
         goal_snapshot = set()
         time_expired = False
         ready = False
-        agg = await self._get_agg_state(self.train["id"])
+        notes = []  # строки UI-лога, которые выводим уже вне lock
         async with agg["lock"]:
-            agg["round_weights"][self.device.id] = [np.asarray(a) for a in weights]
-
-            have = set(agg["round_weights"].keys())
+            # обновление сразу складывается во взвешенную сумму раунда; сами веса не храним
+            acc = agg["round_acc"]
+            if acc.round_no is not None and round_no != acc.round_no:
+                # раунд уже агрегируется (буфер сменён на следующий) — обновление от прошлой версии не берём
+                await self.send(json.dumps({
+                    "type": "update_discarded", "reason": "round_closed",
+                    "round": acc.round_no, "train_id": self.train["id"],
+                }))
+                return
+            try:
+                if self.device.id in acc.contributors:
+                    logger.warning("Duplicate update from %s for round %s ignored", self.device.name, round_no)
+                elif sparse:
+                    await get_executor().run(self._fold_sparse, agg, acc, self.device.id, weights, num_samples)
+                elif partial:
+                    # шлюз: один вклад за всех его устройств, вес — их суммарные примеры
+                    await get_executor().fold(acc, self.device.id, weights, num_samples,
+                                              scale=1.0 if partial["mode"] == "sum" else None,
+                                              members=partial["members"])
+                    notes.append(f"[gateway] {self.device.name}: {partial['members']} устр., {num_samples:g} примеров "
+                                 f"(всего в раунде {acc.members} устр. через {len(acc)} загрузок)")
+                else:
+                    await get_executor().fold(acc, self.device.id, weights, num_samples)
+            except ValueError as e:
+                logger.warning("Rejected weights from %s: %s", self.device.name, e)
+                await self.send(json.dumps({"type": "error", "message": f"Incompatible weights: {e}"}))
+                return
+            if isinstance(metrics.get("accuracy"), (int, float)):
+                agg["round_transport"].setdefault(metrics["transport"], []).append(float(metrics["accuracy"]))
+            if agg.get("round_started") is not None and round_no == self.train["round_count"]:
+                self.latency.observe(self.train["model_name"], self.device.id,
+                                     asyncio.get_running_loop().time() - agg["round_started"], round_no)
+
+            have = _round_participants(agg)
             goal = set(agg.get("training_clients") or [])
             if not goal:
                 goal = {getattr(c.device, "id", None) for c in list(self.connected_clients) if getattr(c, "device", None)}
                 goal.discard(None)
 
             loop = asyncio.get_running_loop()
-            if not agg.get("round_deadline"):
-                agg["round_deadline"] = loop.time() + self.AGG_TIMEOUT_SEC
-                await self._schedule_timeout_shared(self.train["id"], self.train["round_count"])
+            schedule_timeout = not agg.get("round_deadline")
+            if schedule_timeout:
+                notes.append(self._set_round_deadline(agg))
             time_expired = bool(agg.get("round_deadline")) and (loop.time() >= agg["round_deadline"])
             have_snapshot = set(have)
             goal_snapshot = set(goal)
-            ready = (len(goal_snapshot) > 0 and have_snapshot >= goal_snapshot) or time_expired
+            if agg.get("target"):
+                # выборка с запасом: раунд закрывается, как только пришло target обновлений
+                ready = len(have_snapshot) >= agg["target"] or time_expired
+            else:
+                ready = (len(goal_snapshot) > 0 and have_snapshot >= goal_snapshot) or time_expired
+            if ready:
+                ready = self._claim_round(agg, round_no)
+        if schedule_timeout:
+            # вне agg["lock"]: _schedule_timeout_shared берёт тот же (нереентерабельный) lock
+            await self._schedule_timeout_shared(self.train["id"], self.train["round_count"])
+        for line in notes:
+            await self.ui_log(line)
 
         # 4) UI: онлайн-агрегированная confusion по уже полученным устройствам (не ждём FedAvg)
-        aggregated = await self.get_aggregated_confusion(self.train["id"], round_no)
+        aggregated = (await self._round_confusion(agg, round_no, metrics, result_id)).result()
         if aggregated and aggregated.get("confusion"):
             await self.ui_emit({
                 "type": "confusion_matrix",
@@ -585,52 +925,202 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
         if ready:
             if have_snapshot:
                 await self._set_training_clients(self.train["id"], have_snapshot)
-            await self.aggregate_and_broadcast_all(round_no, metrics)
-            # подготовка к следующему сбору
-            agg = await self._get_agg_state(self.train["id"])
-            async with agg["lock"]:
-                agg["round_weights"].clear()
-                agg["round_deadline"] = asyncio.get_running_loop().time() + self.AGG_TIMEOUT_SEC
-            await self._schedule_timeout_shared(self.train["id"], self.train["round_count"])
+            if not await self.aggregate_and_broadcast_all(round_no, metrics):
+                await self._prepare_next_round(self.train["id"])
+
+    async def _buffer_async(self, agg, data, weights, partial, num_samples, metrics):
+        """
+        Асинхронный режим (без барьера раунда): обновление складывается в буфер как дельта к своей
+        базе, умноженная на n * (1 + s)^-alpha, где s — сколько версий вышло после base_round;
+        нормировка — по сумме n без скидки, поэтому устаревшее обновление сдвигает модель меньше свежего.
+        Пока глобальной версии нет, буфер копит полные модели (режим задаётся при смене буфера).
+        Как только в буфере K обновлений — применяем их и сразу рассылаем новую версию.
+        """
+        cfg = agg["async"]
+        current = self.train["round_count"]
+        try:
+            base_round = int(data.get("base_round", data.get("round", current)))
+        except (TypeError, ValueError):
+            base_round = current
+        staleness = current - base_round
+        base = None
+        if agg.get("global_version") is not None or self.train.get("has_global_weights"):
+            try:
+                base = await self._get_global_base(base_round) if staleness >= 0 else None
+            except StaleBaseError:
+                base = None
+            if base is None and base_round > 0:
+                # база слишком старая (вне истории) — клиенту нужно взять текущую версию
+                await self.send(json.dumps({
+                    "type": "stale_update", "staleness": staleness,
+                    "round": current, "train_id": self.train["id"],
+                }))
+                return
+
+        summed = bool(partial) and partial["mode"] == "sum"
+        members = partial["members"] if partial else 1
+        key = (self.device.id, base_round)  # в async устройство может прислать несколько обновлений с разных версий
+        ready = False
+        async with agg["lock"]:
+            acc = agg["round_acc"]
+            if key in acc.contributors:
+                logger.warning("Duplicate update from %s for base %s ignored", self.device.name, base_round)
+                return
+            if not acc.tags.get("relative"):
+                base, discount = None, 1.0  # буфер полных моделей: первая версия — обычное среднее
+            else:
+                if base is None:
+                    # обучено до первой глобальной версии — берём как дельту к текущей
+                    base = (agg.get("global_version") or {}).get("weights")
+                    if base is None:
+                        await self.send(json.dumps({"type": "stale_update", "staleness": staleness,
+                                                    "round": current, "train_id": self.train["id"]}))
+                        return
+                discount = (1.0 + max(staleness, 0)) ** -cfg["alpha"]
+            try:
+                if base is not None:
+                    weights = await get_executor().run(_relative_update, weights, base, num_samples if summed else None)
+                await get_executor().fold(acc, key, weights, num_samples,
+                                          scale=discount if summed else num_samples * discount, members=members)
+            except ValueError as e:
+                logger.warning("Rejected weights from %s: %s", self.device.name, e)
+                await self.send(json.dumps({"type": "error", "message": f"Incompatible weights: {e}"}))
+                return
+            if isinstance(metrics.get("accuracy"), (int, float)):
+                agg["round_transport"].setdefault(metrics["transport"], []).append(float(metrics["accuracy"]))
+            agg["staleness"].append(staleness)
+            if not agg["applying"] and len(acc) >= cfg["k"]:
+                agg["applying"] = ready = True
+                staleness_seen, agg["staleness"] = agg["staleness"], []
+
+        if ready:
+            await self.ui_log(
+                f"[async] версия {current} > {current + 1}: {len(staleness_seen)} обновл., "
+                f"устарелость ср. {sum(staleness_seen) / len(staleness_seen):.1f}, макс. {max(staleness_seen)}"
+            )
+            if not await self.aggregate_and_broadcast_all(current, metrics):
+                await self._prepare_next_round(self.train["id"])
+
+    async def _prepare_next_round(self, train_id):
+        # подготовка к следующему сбору
+        agg = await self._get_agg_state(train_id)
+        async with agg["lock"]:
+            agg["round_transport"].clear()
+            if agg.get("async"):
+                agg["applying"] = False  # барьера и таймера нет — следующий буфер уже копится
+                return
+            reason = self._set_round_deadline(agg)
+        await self._schedule_timeout_shared(train_id, self.train["round_count"])
+        await self.ui_log(reason)
+
+    def _select_round_clients(self, agg):
+        """
+        Выборка участников раунда (FL_PARTICIPATION_*): из подключённых устройств берём долю fraction,
+        с запасом overselect, случайно или пропорционально «мощности» (1 / медианная задержка).
+        Раунд закроется на target = ceil(fraction * N). Вызывается под agg["lock"].
+        """
+        cfg = agg.get("sampling")
+        if not cfg:
+            agg["selected"] = agg["target"] = None
+            return None
+        candidates = sorted({c.device.id for c in list(self.connected_clients) if getattr(c, "device", None)})
+        if not candidates:
+            agg["selected"] = agg["target"] = None
+            return None
+        target = max(1, math.ceil(cfg["fraction"] * len(candidates)))
+        count = min(len(candidates), math.ceil(target * (1.0 + cfg["overselect"])))
+        if cfg["strategy"] == "capacity":
+            model = self.train["model_name"]
+            latency = {d: self.latency.expected(model, d, 0.5)[0] for d in candidates}
+            known = sorted(v for v in latency.values() if v)
+            typical = known[len(known) // 2] if known else 1.0
+            # взвешенная выборка без возвращения (Efraimidis–Spirakis): ключ u ** (1 / w)
+            keys = {d: random.random() ** (latency[d] or typical) for d in candidates}
+            selected = set(sorted(candidates, key=keys.get, reverse=True)[:count])
+        else:
+            selected = set(random.sample(candidates, count))
+        agg["selected"] = selected
+        agg["target"] = min(target, count)
+        agg["training_clients"] = set(selected)
+        return (f"[sampling] раунд {self.train['round_count']}: выбрано {count} из {len(candidates)} "
+                f"({cfg['strategy']}), раунд закроется на {agg['target']}")
+
+    def _discard_reason(self, agg, data):
+        """Почему обновление не берём в раунд: устройство не выбрано или опоздало к уже закрытому раунду."""
+        selected = agg.get("selected")
+        if selected is not None and self.device.id not in selected:
+            return "not_selected"
+        try:
+            round_no = int(data["round"])
+        except (KeyError, TypeError, ValueError):
+            return None
+        if round_no < self.train["round_count"]:
+            return "round_closed"
+        return None
+
+    def _set_round_deadline(self, agg):
+        """
+        Старт раунда: запоминаем время рассылки и ставим дедлайн по гистограммам задержек
+        ожидаемых участников (FL_DEADLINE_*). Вызывается под agg["lock"]; возвращает строку для UI-лога.
+        """
+        now_ = asyncio.get_running_loop().time()
+        expected = set(agg.get("training_clients") or ())
+        if not expected:
+            expected = {c.device.id for c in list(self.connected_clients) if getattr(c, "device", None)}
+        seconds, reason = self.latency.deadline(
+            self.train["model_name"], sorted(expected),
+            q=getattr(settings, "FL_DEADLINE_PERCENTILE", 0.9),
+            margin=getattr(settings, "FL_DEADLINE_MARGIN", 0.25),
+            margin_sec=getattr(settings, "FL_DEADLINE_MARGIN_SEC", 1.0),
+            floor=getattr(settings, "FL_DEADLINE_MIN_SEC", 2.0),
+            ceiling=getattr(settings, "FL_DEADLINE_MAX_SEC", 600.0),
+            default=self.AGG_TIMEOUT_SEC,
+        )
+        agg["round_started"] = now_
+        agg["round_deadline"] = now_ + seconds
+        return f"[deadline] раунд {self.train['round_count']}: {seconds:.1f}s — {reason}"
 
     async def aggregate_and_broadcast_all(self, round_num, metrics):
         """
         FedAvg буфера > обновляем Train, пишем историю, шлём global_weights и UI-метрики.
+        True — следующий раунд уже объявлен (дедлайн и таймер выставлены), _prepare_next_round не нужен.
         """
         print(f"Aggregating weights for round {round_num}...")
         if not self.train:
             return
 
-        # 1) FedAvg
-        new_weights = await self.fedavg_current_round()
+        # 1) FedAvg (float32-слои)
+        new_weights = await self.fedavg_current_round(round_num)
         if new_weights is None:
             await self.ui_log("? Нет валидных весов для агрегации"); return
 
-        # 2) агрегированная матрица за раунд (если есть)
-        aggregated = await self.get_aggregated_confusion(self.train["id"], round_num)
-        new_global_confusion = aggregated if aggregated else None
-
-        # 3) Обновим Train (веса + счётчик + глобальная матрица)
-        self.train = await self.update_train_after_agg(self.train["id"], new_weights, new_global_confusion)
-
-        # 4) Средняя accuracy по раунду (из RoundResult per-device)
-        avg_accuracy = await self.get_average_accuracy(self.train["id"], round_num)
+        # 2-3) сводка раунда (RoundSummary): средняя accuracy и сумма confusion по участникам
+        agg = await self._get_agg_state(self.train["id"])
+        summary = await self.summarize_round(self.train["id"], round_num, await self._round_confusion(agg, round_num))
+        new_global_confusion = summary.get_confusion()
+        avg_accuracy = summary.acc_mean if summary.acc_mean is not None else 0.0
         avg_loss = metrics.get("loss") if isinstance(metrics, dict) else None
         print(f"Aggregated round {round_num}: avg_accuracy={avg_accuracy}, avg_loss={avg_loss}")
 
-        # 5) История — опционально (оставлено как в исходнике)
-        await self.save_round_history(
-            train_id=self.train["id"],
-            round_number=self.train["round_count"],
-            avg_accuracy=avg_accuracy,
-            avg_loss=avg_loss,
-            snapshot_weights=new_weights
-        )
+        # 4) Фиксация раунда — один условный UPDATE; если раунд уже продвинул другой процесс — выходим
+        state = await self.update_train_after_agg(self.train["id"], self.train["round_count"], new_global_confusion)
+        if state is None:
+            logger.warning("Round %s of train %s was already committed elsewhere", round_num, self.train["id"])
+            self.train = await self._load_train(self.train["id"], reconcile=False)  # чекпоинт пишет тот процесс
+            return
+        self.train = state
+
+        # 5) Чекпоинт (файл + индекс + ссылка из Train) пишется в фоне, по порядку раундов;
+        #    следующему раунду веса отдаются из памяти (_cache_global)
+        st = await self._get_agg_state(self.train["id"])
+        st["persist"] = asyncio.create_task(self._persist_round(
+            st.get("persist"), self.train["id"], self.train["round_count"], avg_accuracy, avg_loss, new_weights))
 
-        # 6) Разослать обновлённые веса и метрики
+        # 6) Разослать обновлённые веса и метрики (и запомнить их как базу для дельт)
+        current = await self._cache_global(self.train["id"], self.train["round_count"], new_weights)
         payload_msg = {
             "type": "global_weights",
-            "payload": pickle.dumps(new_weights).hex(),
+            "version": current["version"],
             "round":   self.train["round_count"],
             "accuracy": avg_accuracy,
             "model": self.train["model_name"],
@@ -642,7 +1132,8 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
                 "classes": new_global_confusion.get("classes"),
                 "support": new_global_confusion.get("support"),
             })
-        await self.broadcast_all(payload_msg)
+        await self.broadcast_weights(payload_msg, new_weights)
+        await self._report_quantization(round_num, new_weights)
         # Обновить loss-график для UI, если значение есть
         if avg_loss is not None:
             await self.ui_emit({"type": "train_loss", "round": self.train["round_count"], "loss": avg_loss})
@@ -679,13 +1170,59 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
             await self.ui_log("? Обучение завершено")
             return
 
+        st = await self._get_agg_state(self.train["id"])
+        if st.get("async"):
+            return  # в async новая global_weights и есть сигнал продолжать
+
         # следующий раунд
-        await self.broadcast_all({
+        next_msg = {
             "type": "start_training",
             "round": self.train["round_count"],
             "model": self.train["model_name"],
             "train_id": self.train["id"],
-        })
+        }
+        if st.get("topk"):
+            next_msg["topk"] = st["topk"]
+        async with st["lock"]:
+            sampling_note = self._select_round_clients(st)
+            st["round_transport"].clear()
+            # отсчёт задержек — до рассылки, как в start_training: быстрый клиент ответит раньше, чем мы вернёмся
+            deadline_reason = self._set_round_deadline(st)
+        await self._schedule_timeout_shared(self.train["id"], self.train["round_count"])
+        await self.announce_round(next_msg)
+        if sampling_note:
+            await self.ui_log(sampling_note)
+        await self.ui_log(deadline_reason)
+        return True
+
+    async def _report_quantization(self, round_num, arrays):
+        """
+        Отчёт по квантизации за раунд: ошибка восстановления глобальной модели для
+        используемых режимов + средняя accuracy клиентов по режиму транспорта.
+        """
+        model = self.train["model_name"]
+        modes = {_weights_variant(c, model)[1] for c in list(self.connected_clients)}
+        st = await self._get_agg_state(self.train["id"])
+        by_transport = {m: list(v) for m, v in st["round_transport"].items()}
+        modes.update(m for m in by_transport if m in QUANT_MODES)
+        modes.discard(None)
+        if not modes and len(by_transport) <= 1:
+            return
+        report = {}
+        for mode in sorted(modes):
+            report[mode] = await asyncio.to_thread(quantization_error, arrays, mode)
+        for mode, accs in by_transport.items():
+            report.setdefault(mode, {}).update({"clients": len(accs), "avg_accuracy": sum(accs) / len(accs)})
+        await self.ui_emit({"type": "quantization_report", "round": round_num, "model": model, "modes": report})
+        parts = []
+        for mode, r in report.items():
+            line = mode
+            if "rel_l2" in r:
+                line += f" err={r['rel_l2']:.2e}"
+            if "avg_accuracy" in r:
+                line += f" acc={r['avg_accuracy']:.4f} ({r['clients']})"
+            parts.append(line)
+        await self.ui_log(f"[quant] Раунд {round_num} [{model}]: " + "; ".join(parts))
 
     # -------------- shared timeout (как было) --------------
     async def _get_agg_state(self, train_id: int):
@@ -695,14 +1232,42 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
             st = self.aggregations.get(train_id)
             if st:
                 return st
+            # после рестарта незавершённый раунд поднимается из spool (FL_ROUND_SPOOL_DIR)
+            round_no = self.train["round_count"] if self.train and self.train["id"] == train_id else None
+            acc = await asyncio.to_thread(_recover_accumulator, train_id, round_no)
             self.aggregations[train_id] = {
                 "lock": asyncio.Lock(),
                 "training_clients": set(),
-                "round_weights": {},
+                "round_acc": acc,       # потоковая взвешенная сумма обновлений раунда
+                "residuals": {},        # device_id -> [(idx, vals)] непримененный остаток top-k по устройству
+                "topk": None,           # доля элементов слоя для top-k режима (None — плотные веса)
+                "round_transport": {},  # режим транспорта -> accuracy клиентов за раунд
                 "round_deadline": None,
+                "round_started": None,  # loop.time() рассылки весов раунда — начало отсчёта задержек
+                "sampling": None,       # {"fraction", "overselect", "strategy"} — выборка участников раунда
+                "selected": None,       # выбранные на текущий раунд устройства (None — все)
+                "target": None,         # сколько обновлений закрывает раунд при выборке
                 "timeout_task": None,
+                "global_version": None,  # {"round", "weights", "version"} — база для delta и skip-if-current
+                "async": None,          # {"k", "alpha", "max_staleness"} — буферизованный асинхронный режим
+                "history": {},          # round -> веса последних версий (база устаревших обновлений в async)
+                "applying": False,      # буфер уже отдан на применение (async)
+                "staleness": [],        # устарелость обновлений текущего буфера (для лога)
+                "persist": None,        # фоновая запись последнего чекпоинта (_persist_round)
+                "aggregating": None,    # раунд, который сейчас агрегируется (загрузкой или таймаутом)
+                "confusion": {},        # round -> задача -> ConfusionAccumulator (онлайн-матрица для UI и сводки)
             }
-            return self.aggregations[train_id]
+        if len(acc):
+            await self.ui_log(f"[spool] Раунд {round_no} восстановлен после рестарта: {len(acc)} обновлений уже учтено")
+        return self.aggregations[train_id]
+
+    @staticmethod
+    def _claim_round(st, round_no):
+        """Раунд агрегирует кто-то один: загрузка после дедлайна и таймаут не стартуют его дважды. Под st["lock"]."""
+        if st.get("aggregating") == round_no:
+            return False
+        st["aggregating"] = round_no
+        return True
 
     async def _set_training_clients(self, train_id: int, client_ids):
         st = await self._get_agg_state(train_id)
@@ -713,25 +1278,33 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
         st = await self._get_agg_state(train_id)
         async with st["lock"]:
             tt = st.get("timeout_task")
-            if tt and not tt.done():
+            # из самого таймаута (агрегация по таймеру) себя не отменяем
+            if tt and not tt.done() and tt is not asyncio.current_task():
                 tt.cancel()
             st["timeout_task"] = asyncio.create_task(self._timeout_trigger_shared(train_id, round_no))
 
     async def _timeout_trigger_shared(self, train_id: int, round_no: int):
+        st = await self._get_agg_state(train_id)
+        deadline = st.get("round_deadline")
+        delay = self.AGG_TIMEOUT_SEC if deadline is None else max(0.0, deadline - asyncio.get_running_loop().time())
         try:
-            await asyncio.sleep(self.AGG_TIMEOUT_SEC)
+            await asyncio.sleep(delay)
         except asyncio.CancelledError:
             return
-        st = await self._get_agg_state(train_id)
         current_round = self.train["round_count"] if self.train else None
         if current_round != round_no:
             return
-        if st["round_weights"]:
-            have = set(st["round_weights"].keys())
-            if have:
-                await self._set_training_clients(train_id, have)
-            await self.ui_log(f"[timeout] Aggregating on timeout for round {round_no}. Collected: {len(st['round_weights'])} clients")
-            await self.aggregate_and_broadcast_all(round_no, {"timeout": True})
+        async with st["lock"]:
+            if st.get("timeout_task") is asyncio.current_task():
+                st["timeout_task"] = None  # агрегацию по таймеру перепланирование раунда уже не отменит
+            have = _round_participants(st)
+            claimed = bool(have) and self._claim_round(st, round_no)
+        if claimed:
+            await self._set_training_clients(train_id, have)
+            await self.ui_log(f"[timeout] Aggregating on timeout for round {round_no}. Collected: {len(have)} clients")
+            announced = await self.aggregate_and_broadcast_all(round_no, {"timeout": True})
+            if not announced and self.train and self.train["round_count"] < self.train["max_rounds"]:
+                await self._prepare_next_round(train_id)
 
     # -------------- DB/helpers (как у вас, с правками сигнатур) --------------
     @database_sync_to_async
@@ -744,34 +1317,36 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
         except Exception:
             return None
 
+    async def get_train_by_id(self, train_id):
+        """Состояние Train для маршрутизации сообщения: из кеша процесса, в БД — только при промахе."""
+        return trains.get(train_id) or await self._load_train(train_id)
+
     @database_sync_to_async
-    def get_train_by_id(self, train_id):
+    def _load_train(self, train_id, reconcile=True):
         from .models import Train
         try:
-            obj = Train.objects.get(id=train_id)
-            return {
-                "id": obj.id,
-                "date": obj.date.isoformat(),
-                "model_name": obj.model_name,
-                "round_count": obj.round_count,
-                "max_rounds": obj.max_rounds,
-                "epochs": obj.epochs,
-                "global_weights": obj.global_weights,
-                "is_active": obj.is_active,
-                "ready": getattr(obj, "ready", False),
-                "created": False,
-                "global_confusion": getattr(obj, "global_confusion", None),
-            }
-        except Train.DoesNotExist:
+            # веса сюда не грузим: они нужны только при промахе кеша (_current_global)
+            obj = _trains().get(id=train_id)
+        except (Train.DoesNotExist, TypeError, ValueError):
             return None
+        if reconcile and not self._persist_pending(obj.id):
+            obj = _reconcile_round(obj)
+        return trains.put(_train_state(obj))
+
+    def _persist_pending(self, train_id):
+        # чекпоинт ещё пишется этим процессом — отставание указателя от round_count ожидаемо
+        task = self.aggregations.get(train_id, {}).get("persist")
+        return task is not None and not task.done()
 
     @database_sync_to_async
     def get_or_create_today_train(self, model_name: str, max_rounds: int, epochs: int):
         from .models import Train
         today = now().date()
         try:
-            obj = Train.objects.select_for_update().get(date=today, model_name=model_name)
+            obj = _trains().select_for_update().get(date=today, model_name=model_name)
             created = False
+            if not self._persist_pending(obj.id):
+                obj = _reconcile_round(obj)
         except Train.DoesNotExist:
             obj = Train(
                 date=today, model_name=model_name,
@@ -787,19 +1362,7 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
         if not obj.is_active: obj.is_active = True; changed_fields.append("is_active")
         if changed_fields: obj.save(update_fields=changed_fields)
 
-        return {
-            "id": obj.id,
-            "date": obj.date.isoformat(),
-            "model_name": obj.model_name,
-            "round_count": obj.round_count,
-            "max_rounds": obj.max_rounds,
-            "epochs": obj.epochs,
-            "global_weights": obj.global_weights,
-            "is_active": obj.is_active,
-            "ready": getattr(obj, "ready", False),
-            "created": created,
-            "global_confusion": getattr(obj, "global_confusion", None),
-        }
+        return trains.put(_train_state(obj, created))
 
     @database_sync_to_async
     def get_or_create_local_data(self, device):
@@ -809,31 +1372,54 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
     @database_sync_to_async
     def save_device_round_result(self, device, local_data, rnd, metrics, train_id=None):
         from .models import RoundResult
-        RoundResult.objects.create(
+        return RoundResult.objects.create(
             train_id=train_id, device=device, local_data=local_data,
             round_number=rnd, result=metrics
-        )
+        ).id
 
     @database_sync_to_async
-    def update_train_after_agg(self, train_id, new_weights, new_global_confusion):
+    def update_train_after_agg(self, train_id, expected_round, new_global_confusion):
+        """
+        Фиксация раунда одним UPDATE ... WHERE round_count = expected_round: счётчик через F(),
+        глобальная confusion (если рассчитана). Два процесса не продвинут один раунд дважды —
+        проигравший получает None. Веса пишет _persist_round.
+        """
         from .models import Train
-        tr = Train.objects.get(pk=train_id)
-        tr.global_weights = new_weights
-        # сохраняем глобальную confusion, если рассчитана
+        fields = {"round_count": F("round_count") + 1, "updated_at": now()}
         if new_global_confusion is not None:
-            tr.global_confusion = new_global_confusion
-            tr.save(update_fields=["global_weights", "round_count", "global_confusion"])
-        else:
-            tr.save(update_fields=["global_weights", "round_count"])
-        tr.round_count = tr.round_count + 1
-        tr.save(update_fields=["round_count"])
-        return dict(
-            id=tr.id, date=str(tr.date), model_name=tr.model_name,
-            round_count=tr.round_count, max_rounds=tr.max_rounds,
-            epochs=tr.epochs, global_weights=tr.global_weights,
-            is_active=tr.is_active, ready=getattr(tr, "ready", False),
-            global_confusion=getattr(tr, "global_confusion", None)
-        )
+            fields["global_confusion"] = new_global_confusion
+        if not Train.objects.filter(pk=train_id, round_count=expected_round).update(**fields):
+            return None
+        _clear_spool(train_id, keep_round=expected_round + 1)
+        state = {**self.train, "round_count": expected_round + 1, "has_global_weights": True, "created": False}
+        if new_global_confusion is not None:
+            state["global_confusion"] = new_global_confusion
+        return trains.put(state)
+
+    async def _persist_round(self, previous, train_id, round_number, avg_accuracy, avg_loss, weights):
+        """Фоновая запись чекпоинта раунда; ждёт предыдущую запись, чтобы база дельты уже была в индексе."""
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        try:
+            checkpoint_id = await self.save_round_history(train_id, round_number, avg_accuracy, avg_loss, weights)
+            await self._point_train_at(train_id, round_number, checkpoint_id)
+            await self.prune_checkpoints(train_id)
+        except Exception:
+            logger.exception("Failed to persist checkpoint for train %s round %s", train_id, round_number)
+
+    @database_sync_to_async
+    def _point_train_at(self, train_id, round_number, checkpoint_id):
+        """Train -> чекпоинт раунда (если не указывает уже на более поздний); старые копии весов сбрасываются."""
+        from .models import Train
+        Train.objects.filter(pk=train_id).exclude(checkpoint__round_number__gt=round_number).update(
+            checkpoint_id=checkpoint_id, global_blob=None, global_weights=None)
+
+    @database_sync_to_async
+    def load_global_weights(self, train_id):
+        from .models import Train
+        tr = Train.objects.select_related("checkpoint").only(
+            "checkpoint__content_hash", "global_blob", "global_weights").get(pk=train_id)
+        return tr.get_global_weights()
 
     @database_sync_to_async
     def mark_train_finished(self, train_id):
@@ -842,87 +1428,122 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
         tr.is_active = False
         tr.ready = True
         tr.save(update_fields=["is_active","ready"])
+        trains.update(tr.id, is_active=False, ready=True)
+
+    async def save_round_history(self, train_id, round_number, avg_accuracy, avg_loss, snapshot_weights):
+        """
+        Глобальная модель раунда — в CheckpointStore (вне event loop), в индекс — строка Checkpoint.
+        Каждый FL_CHECKPOINT_KEYFRAME_EVERY-й раунд — ключевой кадр, остальные — дельта к предыдущему.
+        Возвращает id строки.
+        """
+        base = await self._checkpoint_base(train_id, round_number)
+        content_hash, size, base = await get_executor().run(get_store().put, snapshot_weights, None, base)
+        return await self._index_checkpoint(train_id, round_number, content_hash, base, size, avg_accuracy, avg_loss)
 
     @database_sync_to_async
-    def save_round_history(self, train_id, round_number, avg_accuracy, avg_loss, snapshot_weights):
-        # Оставлено выключенным (как в исходнике)
-        return None
+    def _checkpoint_base(self, train_id, round_number):
+        from .models import Checkpoint
+        every = getattr(settings, "FL_CHECKPOINT_KEYFRAME_EVERY", 10)
+        if every <= 1 or (round_number - 1) % every == 0:
+            return None
+        return Checkpoint.objects.filter(train_id=train_id, round_number=round_number - 1) \
+            .values_list("content_hash", flat=True).first()
 
     @database_sync_to_async
-    def get_average_accuracy(self, train_id, round_num):
-        from .models import RoundResult
-        accs = []
-        qs = RoundResult.objects.filter(train_id=train_id, round_number=round_num)
-        for r in qs:
-            m = r.result or {}
-            if isinstance(m, str):
-                try:
-                    import json as _json
-                    m = _json.loads(m)
-                except Exception:
-                    m = {}
-            val = None
-            if isinstance(m, dict):
-                val = m.get("accuracy") or m.get("val_accuracy") or m.get("acc")
-            if isinstance(val, (int, float)):
-                accs.append(float(val))
-        return sum(accs) / len(accs) if accs else 0.0
+    def _index_checkpoint(self, train_id, round_number, content_hash, base_hash, size, avg_accuracy, avg_loss):
+        from .models import Checkpoint
+        row, _ = Checkpoint.objects.update_or_create(
+            train_id=train_id, round_number=round_number,
+            defaults={"content_hash": content_hash, "base_hash": base_hash or "", "size": size,
+                      "avg_accuracy": avg_accuracy, "avg_loss": avg_loss},
+        )
+        return row.id
 
     @database_sync_to_async
-    def get_aggregated_confusion(self, train_id, round_num):
-        from .models import RoundResult
-        import numpy as _np
-        qs = RoundResult.objects.filter(train_id=train_id, round_number=round_num)
-        confusion_sum = None
-        support_sum = None
-        classes = None
-        for r in qs:
-            m = r.result or {}
-            if isinstance(m, str):
-                try:
-                    import json as _json
-                    m = _json.loads(m)
-                except Exception:
-                    m = {}
-            conf = m.get("confusion")
-            supp = m.get("support")
-            cls = m.get("classes")
-            if conf is not None:
-                try:
-                    arr = _np.array(conf, dtype=float)
-                    confusion_sum = arr if confusion_sum is None else (confusion_sum + arr)
-                except Exception:
-                    pass
-            if supp is not None:
-                try:
-                    arrs = _np.array(supp, dtype=float)
-                    support_sum = arrs if support_sum is None else (support_sum + arrs)
-                except Exception:
-                    pass
-            if cls is not None and classes is None:
-                classes = cls
-        if confusion_sum is None:
-            return None
-        return {"confusion": confusion_sum.tolist(),
-                "support": support_sum.tolist() if support_sum is not None else None,
-                "classes": classes}
+    def prune_checkpoints(self, train_id):
+        from .models import Checkpoint, Train
+        return Checkpoint.prune(
+            Train.objects.only("id", "checkpoint").get(pk=train_id),
+            keep_last=getattr(settings, "FL_CHECKPOINT_KEEP_LAST", 5),
+            keep_every=getattr(settings, "FL_CHECKPOINT_KEEP_EVERY", 10),
+            keep_best=getattr(settings, "FL_CHECKPOINT_KEEP_BEST", True),
+        )
 
     @database_sync_to_async
-    def fedavg_current_round(self):
-        import numpy as np
-        st = self.aggregations.get(self.train["id"]) if self.train else None
-        weights = [w for w in (st["round_weights"].values() if st else self.round_weights.values())]
-        if not weights:
+    def summarize_round(self, train_id, round_num, confusion=None):
+        from .models import RoundSummary
+        return RoundSummary.build(train_id, round_num, confusion=confusion)
+
+    async def _round_confusion(self, agg, round_no, metrics=None, result_id=None):
+        """
+        ConfusionAccumulator раунда из состояния агрегации; metrics устройства добавляются один раз.
+        Первый доступ к раунду в процессе (в т.ч. после рестарта) поднимает сумму из RoundResult;
+        загрузка — общая задача для одновременных обращений, повтор по id результата отсекается.
+        """
+        task = agg["confusion"].get(round_no)
+        if task is None:
+            task = asyncio.ensure_future(self.load_round_confusion(self.train["id"], round_no))
+            agg["confusion"] = {r: t for r, t in agg["confusion"].items() if r >= round_no - 1}
+            agg["confusion"][round_no] = task
+        acc = await task
+        if metrics is not None:
+            acc.add(metrics, result_id)
+        return acc
+
+    @database_sync_to_async
+    def load_round_confusion(self, train_id, round_num):
+        from .models import RoundResult, result_metrics
+        acc = ConfusionAccumulator()
+        for pk, raw in RoundResult.objects.filter(train_id=train_id, round_number=round_num).values_list("id", "result"):
+            acc.add(result_metrics(raw), pk)
+        return acc
+
+    async def fedavg_current_round(self, round_num):
+        """
+        Итог раунда из потокового аккумулятора; буфер сразу заменяется пустым для следующего раунда.
+        Меняем только буфер именно этого, ещё не закрытого раунда — иначе None (раунд уже агрегирован).
+        """
+        if not self.train:
             return None
-        num_layers = len(weights[0])
-        for w in weights:
-            if len(w) != num_layers:
-                raise ValueError("Inconsistent number of layers across clients")
-        agg = []
-        for k in range(num_layers):
-            layer_stack = np.stack([w[k] for w in weights], axis=0)
-            agg.append(layer_stack.mean(axis=0).tolist())
-        return agg
+        st = await self._get_agg_state(self.train["id"])
+        async with st["lock"]:
+            acc = st["round_acc"]
+            # round_no is None — буфер не привязан к раунду (поднят без Train), принимаем как текущий
+            if acc.round_no not in (None, round_num) or round_num != self.train["round_count"] or not len(acc):
+                return None
+            st["round_acc"] = _new_accumulator(self.train["id"], round_num + 1)
+            base = (st.get("global_version") or {}).get("weights")
+            if st.get("async"):
+                if acc.tags.get("relative"):
+                    acc.base_weight = acc.total  # в буфере дельты: новая версия = база + их взвешенное среднее
+                # после этой агрегации глобальная версия есть — следующий буфер копит дельты к ней
+                st["round_acc"].tags["relative"] = bool(len(acc)) or base is not None
+        try:
+            return await get_executor().run(acc.result, base)
+        finally:
+            # spool закрытого раунда удалит update_train_after_agg, когда новый round_count уже в БД
+            acc.release(keep_spool=True)
+
+    def _fold_sparse(self, st, acc, device_id, update, num_samples):
+        shapes = [b.shape for b in st["global_version"]["weights"]]
+        acc.add_sparse(device_id, shapes, self._error_feedback(st, device_id, update), num_samples)
+
+    def _error_feedback(self, st, device_id, update):
+        """
+        Error feedback на сервере: к присланному top-k добавляем накопленный остаток устройства,
+        в раунд берём k наибольших по модулю, остальное оставляем в аккумуляторе.
+        """
+        base = st["global_version"]["weights"]
+        residual = st["residuals"].get(device_id) or [(np.empty(0, np.int64), np.empty(0, np.float32))] * len(update)
+        fraction = st.get("topk") or 1.0
+        applied, rest = [], []
+        for layer, upd, res in zip(base, update, residual):
+            k = max(1, int(np.ceil(fraction * layer.size)))
+            kept, left = topk_split(*merge_sparse(res, upd), k)
+            applied.append(kept)
+            rest.append(left)
+        st["residuals"][device_id] = rest
+        return applied
 
     # ---------- нормализация метрик ----------
     def _normalize_metrics(self, metrics, round_no):
@@ -953,4 +1574,233 @@ class TrainModelConsumer(AsyncWebsocketConsumer):
         return out
 
 
-
+def _as_float_arrays(weights):
+    # глобальная модель везде — float32-массивы; без копии, если уже они
+    return [np.asarray(w, dtype=np.float32) for w in weights]
+
+
+def _trains():
+    """Train без тяжёлых полей весов; есть ли веса — флагом из того же запроса."""
+    from .models import Train
+    has_weights = Q(checkpoint__isnull=False) | Q(global_blob__isnull=False) | Q(global_weights__isnull=False)
+    return Train.objects.defer("global_blob", "global_weights").annotate(
+        has_weights=ExpressionWrapper(has_weights, output_field=BooleanField()),
+        checkpoint_round=F("checkpoint__round_number"))
+
+
+def _reconcile_round(obj):
+    """
+    Раунд фиксируется раньше, чем в фоне пишется его чекпоинт. Если процесс упал между ними,
+    Train указывает на чекпоинт прошлого раунда при новом round_count — откатываем счётчик
+    к раунду весов, иначе старая модель раздавалась бы под номером новой (раунд пройдёт заново).
+    Чекпоинт может ещё писаться другим процессом, поэтому откатываем только раунд, зафиксированный
+    раньше FL_ROUND_COMMIT_GRACE_SEC назад: к этому времени запись уже закончилась или не состоится.
+    """
+    from .models import Train
+    ckpt_round = getattr(obj, "checkpoint_round", None)
+    if ckpt_round is None or ckpt_round >= obj.round_count:
+        return obj
+    grace = datetime.timedelta(seconds=getattr(settings, "FL_ROUND_COMMIT_GRACE_SEC", 600))
+    if obj.updated_at is None or now() - obj.updated_at < grace:
+        return obj
+    if Train.objects.filter(pk=obj.pk, round_count=obj.round_count, checkpoint_id=obj.checkpoint_id,
+                            updated_at=obj.updated_at).update(round_count=ckpt_round, updated_at=now()):
+        logger.warning("Train %s: checkpoint of rounds %s..%s was not written, round_count rolled back to %s",
+                       obj.pk, ckpt_round + 1, obj.round_count, ckpt_round)
+        obj.round_count = ckpt_round
+    return obj
+
+
+def _train_state(obj, created=False):
+    """Train как dict для консьюмера; сами веса — через _current_global (кеш) / load_global_weights."""
+    has_weights = getattr(obj, "has_weights", None)
+    if has_weights is None:
+        has_weights = obj.has_global_weights
+    return {
+        "id": obj.id,
+        "date": obj.date.isoformat(),
+        "model_name": obj.model_name,
+        "round_count": obj.round_count,
+        "max_rounds": obj.max_rounds,
+        "epochs": obj.epochs,
+        "has_global_weights": has_weights,
+        "is_active": obj.is_active,
+        "ready": getattr(obj, "ready", False),
+        "created": created,
+        "global_confusion": getattr(obj, "global_confusion", None),
+        "version": None,  # версия глобальной модели; заполняет _cache_global
+    }
+
+
+def _round_participants(st):
+    # устройства, чьи обновления уже сложены в аккумулятор раунда (плотные и top-k)
+    return set(st["round_acc"].contributors)
+
+
+def _new_accumulator(train_id=None, round_no=None):
+    return get_executor().new_accumulator(getattr(settings, "FL_ACCUMULATOR_DTYPE", "float64"),
+                                          spool=_spool_path(train_id, round_no), round_no=round_no)
+
+
+def _spool_path(train_id, round_no):
+    root = getattr(settings, "FL_ROUND_SPOOL_DIR", None)
+    if not root or train_id is None or round_no is None:
+        return None
+    return os.path.join(root, f"train_{train_id}", f"round_{round_no}")
+
+
+def _clear_spool(train_id, keep_round=None):
+    """Удалить spool-каталоги раундов train, кроме keep_round."""
+    keep = _spool_path(train_id, keep_round)
+    parent = _spool_path(train_id, 0)
+    if parent is None:
+        return
+    parent = os.path.dirname(parent)
+    for name in os.listdir(parent) if os.path.isdir(parent) else ():
+        path = os.path.join(parent, name)
+        if path != keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _recover_accumulator(train_id, round_no):
+    path = _spool_path(train_id, round_no)
+    acc = FedAvgAccumulator.recover(path) if path else None
+    if acc is None and path:
+        shutil.rmtree(path, ignore_errors=True)  # сложение было прервано посередине — суммам не верим
+    if path:
+        _clear_spool(train_id, keep_round=round_no)
+    return acc or _new_accumulator(train_id, round_no)
+
+
+def _num_samples(data):
+    """Вес клиента в FedAvg — число примеров из сообщения или metrics; по умолчанию 1."""
+    metrics = data.get("metrics") if isinstance(data.get("metrics"), dict) else {}
+    for value in (data.get("num_samples"), metrics.get("num_samples"), metrics.get("samples")):
+        try:
+            n = float(value)
+        except (TypeError, ValueError):
+            continue
+        if n > 0:
+            return n
+    return 1.0
+
+
+def _partial_update(data):
+    """
+    Предагрегированное обновление от шлюза: {"partial": "sum"|"mean", "num_samples": S, "members": [...] | N}.
+    "sum" — слои = sum(n_i * w_i) по устройствам шлюза, "mean" — их взвешенное среднее (допускает delta).
+    """
+    mode = data.get("partial")
+    if not mode:
+        return None
+    if mode not in ("sum", "mean"):
+        raise ValueError("partial must be 'sum' or 'mean'")
+    if data.get("encoding") == "topk" or (mode == "sum" and data.get("encoding")):
+        raise ValueError(f"encoding {data.get('encoding')!r} is not supported for partial={mode}")
+    metrics = data.get("metrics") if isinstance(data.get("metrics"), dict) else {}
+    if data.get("num_samples") is None and metrics.get("num_samples") is None:
+        raise ValueError("num_samples is required")
+    members = data.get("members")
+    if isinstance(members, list):
+        members = len(members)
+    try:
+        members = max(1, int(members or 1))
+    except (TypeError, ValueError):
+        raise ValueError("members must be a list or a count")
+    return {"mode": mode, "members": members}
+
+
+def _async_config(data):
+    """Параметры асинхронного режима из start_training / настроек; None — обычные раунды с барьером."""
+    mode = data.get("mode") or getattr(settings, "FL_TRAINING_MODE", "sync")
+    if mode != "async":
+        return None
+    try:
+        k = max(1, int(data.get("buffer_k") or getattr(settings, "FL_ASYNC_BUFFER_K", 3)))
+    except (TypeError, ValueError):
+        k = 3
+    return {
+        "k": k,
+        "alpha": float(getattr(settings, "FL_ASYNC_STALENESS_ALPHA", 0.5)),
+        "max_staleness": int(getattr(settings, "FL_ASYNC_MAX_STALENESS", 8)),
+    }
+
+
+def _sampling_config(data):
+    """Выборка клиентов на раунд из start_training / настроек; None — участвуют все подключённые."""
+    try:
+        fraction = float(data.get("fraction") or getattr(settings, "FL_PARTICIPATION_FRACTION", 1.0))
+        overselect = float(data.get("overselect", getattr(settings, "FL_PARTICIPATION_OVERSELECT", 0.3)))
+    except (TypeError, ValueError):
+        return None
+    if not 0.0 < fraction < 1.0:
+        return None
+    strategy = data.get("sampling") or getattr(settings, "FL_PARTICIPATION_SAMPLING", "random")
+    return {
+        "fraction": fraction,
+        "overselect": max(0.0, overselect),
+        "strategy": strategy if strategy in ("random", "capacity") else "random",
+    }
+
+
+def _relative_update(weights, base, num_samples=None):
+    """Дельта обновления к его базе; для частичной суммы шлюза база берётся с весом num_samples."""
+    out = []
+    for k, (w, b) in enumerate(zip(weights, base)):
+        w = np.asarray(w, dtype=np.float32)
+        if w.shape != b.shape:
+            raise ValueError(f"Incompatible shape at layer {k}: {w.shape} != {b.shape}")
+        out.append(w - (b if num_samples is None else np.float32(num_samples) * b))
+    if len(weights) != len(base):
+        raise ValueError(f"Inconsistent number of layers: {len(weights)} != {len(base)}")
+    return out
+
+
+def _topk_fraction(value):
+    try:
+        fraction = float(value)
+    except (TypeError, ValueError):
+        return None
+    return fraction if 0.0 < fraction < 1.0 else None
+
+
+def _weights_variant(client, model, version=None):
+    """
+    (формат, режим квантизации) для клиента. Формат: "current" — версия у клиента уже есть,
+    "binary" — бинарный кадр, "json" — legacy hex(pickle) float32-массивов, "lists" — hex(pickle)
+    списков для старых клиентов, явно попросивших weights_as_lists. Режим — из настроек модели, иначе первый из hello.
+    """
+    if version and getattr(client, "weights_version", None) == version:
+        return "current", None
+    if getattr(client, "weights_as_lists", False):
+        return "lists", None
+    modes = getattr(client, "quant_modes", None) or []
+    preferred = getattr(settings, "FL_WEIGHTS_QUANTIZATION", {}) or {}
+    if model in preferred:
+        mode = preferred[model] if preferred[model] in modes else None
+    else:
+        mode = modes[0] if modes else None
+    return ("binary" if getattr(client, "binary_weights", False) else "json"), mode
+
+
+def _encode_weights_frame(message, weights, kind, quant=None):
+    if kind == "current":
+        return Frame.from_message({
+            "type": "weights_current",
+            "version": message.get("version"),
+            "round": message.get("round"),
+            "model": message.get("model"),
+            "train_id": message.get("train_id"),
+        })
+    if quant:
+        arrays, params = quantize(_as_float_arrays(weights), quant)
+        message = {**message, "quantization": quant}
+        if params is not None:
+            message["quant"] = params
+    elif kind == "lists":
+        arrays = [np.asarray(w).tolist() for w in weights]
+    else:
+        arrays = _as_float_arrays(weights)
+    if kind == "binary":
+        return Frame(bytes_data=encode_frame(message, arrays))
+    return Frame.from_message({**message, "payload": encode_legacy_payload(arrays)})
@@ -0,0 +1,95 @@
+# latency.py
+"""
+Гистограммы задержки «рассылка глобальных весов -> загрузка обновления» по устройствам и моделям.
+Из них считается дедлайн раунда: pXX ожидаемых участников + запас.
+
+Корзины логарифмические (шаг 25%, от 50 мс до ~1.5 ч), счётчики с экспоненциальным забыванием,
+чтобы гистограмма следовала за изменением сети/нагрузки. Память — O(число корзин) на ключ.
+"""
+import bisect
+import math
+
+EDGES = [0.05 * 1.25 ** i for i in range(60)]
+
+
+class LatencyHistogram:
+    __slots__ = ("counts", "total", "samples")
+
+    def __init__(self):
+        self.counts = [0.0] * (len(EDGES) + 1)
+        self.total = 0.0   # сумма весов с забыванием — для квантилей
+        self.samples = 0   # сколько замеров было на самом деле — для порога min_samples
+
+    def observe(self, seconds: float, decay: float = 1.0):
+        if decay < 1.0:
+            self.counts = [c * decay for c in self.counts]
+            self.total *= decay
+        self.counts[bisect.bisect_left(EDGES, max(0.0, seconds))] += 1.0
+        self.total += 1.0
+        self.samples += 1
+
+    def quantile(self, q: float):
+        """Верхняя граница корзины, в которую попадает q-квантиль (оценка сверху)."""
+        if self.total <= 0:
+            return None
+        target, seen = q * self.total, 0.0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return EDGES[i] if i < len(EDGES) else EDGES[-1]
+        return EDGES[-1]
+
+
+class LatencyTracker:
+    def __init__(self, decay: float = 0.95, min_samples: int = 3):
+        self.decay = decay
+        self.min_samples = min_samples
+        self.devices = {}  # (model, device_id) -> LatencyHistogram
+        self.models = {}   # model -> LatencyHistogram
+        self.rounds = {}   # (model, device_id) -> раунд последнего замера
+
+    def observe(self, model, device_id, seconds: float, round_no=None):
+        """Учесть замер; повторная загрузка того же раунда (дубль, переотправка) не считается."""
+        if round_no is not None:
+            if self.rounds.get((model, device_id)) == round_no:
+                return False
+            self.rounds[(model, device_id)] = round_no
+        self.devices.setdefault((model, device_id), LatencyHistogram()).observe(seconds, self.decay)
+        self.models.setdefault(model, LatencyHistogram()).observe(seconds, self.decay)
+        return True
+
+    def expected(self, model, device_id, q):
+        """(pXX, источник): своя гистограмма устройства, если данных хватает, иначе общая по модели."""
+        own = self.devices.get((model, device_id))
+        if own is not None and own.samples >= self.min_samples:
+            return own.quantile(q), "device"
+        shared = self.models.get(model)
+        if shared is not None and shared.samples >= self.min_samples:
+            return shared.quantile(q), "model"
+        return None, None
+
+    def deadline(self, model, device_ids, q, margin, margin_sec, floor, ceiling, default):
+        """
+        Дедлайн раунда в секундах и пояснение для UI-лога. Берём pXX каждого ожидаемого участника,
+        из них — тот же квантиль по участникам, затем * (1 + margin) + margin_sec в пределах [floor, ceiling].
+        """
+        estimates, sources = [], {"device": 0, "model": 0}
+        for device_id in device_ids:
+            value, source = self.expected(model, device_id, q)
+            if value is not None:
+                estimates.append(value)
+                sources[source] += 1
+        pct = f"p{round(q * 100)}"
+        if not estimates:
+            return float(default), f"нет истории задержек для {model} — базовый таймаут {default:g}s"
+        estimates.sort()
+        base = estimates[min(len(estimates) - 1, max(0, math.ceil(q * len(estimates)) - 1))]
+        seconds = min(max(base * (1.0 + margin) + margin_sec, floor), ceiling)
+        reason = (
+            f"{pct} задержки {model} по {len(estimates)}/{len(device_ids)} участникам "
+            f"(своих гистограмм {sources['device']}, по модели {sources['model']}) = {base:.1f}s, "
+            f"+{margin:.0%} +{margin_sec:g}s -> {seconds:.1f}s"
+        )
+        if seconds != base * (1.0 + margin) + margin_sec:
+            reason += f" (ограничено [{floor:g}, {ceiling:g}]s)"
+        return seconds, reason
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from main.models import RoundResult, RoundSummary
+
+
+class Command(BaseCommand):
+    help = "Построить RoundSummary для истории: по сводке на каждую пару (train, round) из RoundResult."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--train", type=int, default=None, help="только этот Train")
+        parser.add_argument("--force", action="store_true", help="пересчитать и уже существующие сводки")
+
+    def handle(self, *args, **opts):
+        pairs = RoundResult.objects.filter(train__isnull=False)
+        if opts["train"] is not None:
+            pairs = pairs.filter(train_id=opts["train"])
+        pairs = pairs.values_list("train_id", "round_number").distinct().order_by("train_id", "round_number")
+
+        existing = set()
+        if not opts["force"]:
+            existing = set(RoundSummary.objects.values_list("train_id", "round_number"))
+
+        built = skipped = 0
+        for train_id, round_number in pairs:
+            if (train_id, round_number) in existing:
+                skipped += 1
+                continue
+            RoundSummary.build(train_id, round_number)
+            built += 1
+        self.stdout.write(f"built {built}, skipped {skipped} (already summarised)")
@@ -0,0 +1,65 @@
+import os
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from main.aggregation import AggregationExecutor
+
+
+class Command(BaseCommand):
+    help = "Бенчмарк пула агрегации: время сложения N клиентов в зависимости от числа воркеров и режима."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--params", type=int, default=20_000_000, help="число параметров модели")
+        parser.add_argument("--layers", type=int, default=8)
+        parser.add_argument("--clients", type=int, default=8)
+        parser.add_argument("--workers", default=None, help="список через запятую, по умолчанию 1,2,4..ядра")
+        parser.add_argument("--modes", default="thread,process")
+
+    def handle(self, *args, **opts):
+        cores = os.cpu_count() or 1
+        if opts["workers"]:
+            counts = [int(x) for x in opts["workers"].split(",")]
+        else:
+            counts, n = [], 1
+            while n < cores:
+                counts.append(n)
+                n *= 2
+            counts.append(cores)
+
+        per_layer = max(1, opts["params"] // opts["layers"])
+        rng = np.random.default_rng(0)
+        clients = [[rng.standard_normal(per_layer, dtype=np.float32) for _ in range(opts["layers"])]
+                   for _ in range(opts["clients"])]
+        expected = [np.mean([c[k] for c in clients], axis=0) for k in range(opts["layers"])]
+        mb = per_layer * opts["layers"] * 4 / 2**20
+        self.stdout.write(f"model {mb:.0f} MB ({opts['layers']} layers), {opts['clients']} clients, {cores} cores")
+
+        for mode in opts["modes"].split(","):
+            base = None
+            for workers in counts:
+                executor = AggregationExecutor(workers=workers, mode=mode)
+                try:
+                    self._run(executor, clients[:1])  # прогрев пула (spawn процессов)
+                    elapsed, result = self._run(executor, clients)
+                finally:
+                    executor.shutdown()
+                ok = all(np.allclose(r, e, atol=1e-5) for r, e in zip(result, expected))
+                base = base or elapsed
+                self.stdout.write(
+                    f"{mode:8s} workers={workers:<3d} {elapsed * 1000:8.1f} ms  "
+                    f"{mb * len(clients) / elapsed:8.0f} MB/s  x{base / elapsed:4.2f}" + ("" if ok else "  MISMATCH")
+                )
+
+    @staticmethod
+    def _run(executor, clients):
+        acc = executor.new_accumulator()
+        try:
+            t0 = time.perf_counter()
+            for i, weights in enumerate(clients):
+                executor.fold_blocking(acc, i, weights)
+            result = acc.result()
+            return time.perf_counter() - t0, result
+        finally:
+            acc.release()
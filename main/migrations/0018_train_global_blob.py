@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 03:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0017_train_global_confusion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='train',
+            name='global_blob',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
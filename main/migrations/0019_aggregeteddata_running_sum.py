@@ -0,0 +1,28 @@
+# Generated by Django 5.1.4 on 2026-10-18 03:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0018_train_global_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aggregeteddata',
+            name='folded',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='aggregeteddata',
+            name='running_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='aggregeteddata',
+            name='running_sum',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.4 on 2026-10-18 03:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0019_aggregeteddata_running_sum'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Checkpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('round_number', models.IntegerField()),
+                ('content_hash', models.CharField(db_index=True, max_length=64)),
+                ('size', models.BigIntegerField(default=0)),
+                ('avg_accuracy', models.FloatField(blank=True, null=True)),
+                ('avg_loss', models.FloatField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('train', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='main.train')),
+            ],
+            options={
+                'verbose_name': 'Чекпоинт',
+                'verbose_name_plural': 'Чекпоинты',
+                'ordering': ['train', 'round_number'],
+            },
+        ),
+        migrations.AddField(
+            model_name='train',
+            name='checkpoint',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='main.checkpoint'),
+        ),
+        migrations.AddConstraint(
+            model_name='checkpoint',
+            constraint=models.UniqueConstraint(fields=('train', 'round_number'), name='uniq_checkpoint_train_round'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 03:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0020_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='checkpoint',
+            name='base_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+    ]
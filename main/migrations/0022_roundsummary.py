@@ -0,0 +1,38 @@
+# Generated by Django 5.1.4 on 2026-10-18 03:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0021_checkpoint_base_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoundSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('round_number', models.IntegerField()),
+                ('participants', models.IntegerField(default=0)),
+                ('acc_mean', models.FloatField(blank=True, null=True)),
+                ('acc_min', models.FloatField(blank=True, null=True)),
+                ('acc_max', models.FloatField(blank=True, null=True)),
+                ('loss_mean', models.FloatField(blank=True, null=True)),
+                ('loss_min', models.FloatField(blank=True, null=True)),
+                ('loss_max', models.FloatField(blank=True, null=True)),
+                ('confusion', models.BinaryField(blank=True, null=True)),
+                ('classes', models.JSONField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('train', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='round_summaries', to='main.train')),
+            ],
+            options={
+                'verbose_name': 'Сводка раунда',
+                'verbose_name_plural': 'Сводки раундов',
+                'ordering': ['train', 'round_number'],
+                'constraints': [models.UniqueConstraint(fields=('train', 'round_number'), name='uniq_round_summary_train_round')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 04:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0022_roundsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='train',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -6,10 +6,13 @@ from django.conf import settings
 from cryptography.fernet import Fernet
 import json
 import base64
-import pickle
 from django.contrib.auth import get_user_model
 from django.db import models
 from django.utils.timezone import now
+from .aggregation import get_executor
+from .checkpoints import get_store, retained_rounds
+from .confusion import ConfusionAccumulator
+from .tensors import pack_container, unpack_container, is_container, safe_unpickle_weights
 
 
 User = get_user_model()
@@ -76,11 +79,20 @@ class PredictResult(models.Model):
 class LocalData(models.Model):
     device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='local_datas')
     created_at = models.DateField(auto_now_add=True)
-    # Store base64(pickle(weights)) as text for performance/compatibility
+    # base64(контейнер tensors.pack_container); старые записи — base64(pickle(weights))
     data = models.TextField(blank=True, null=True)
 
     def __str__(self):
         return f'Local data from {self.created_at} of {self.device}'
+
+    def set_weights(self, arrays):
+        self.data = base64.b64encode(pack_container(arrays)).decode("ascii")
+
+    def get_weights(self):
+        raw = base64.b64decode((self.data or "").encode())
+        if is_container(raw):
+            return unpack_container(raw)
+        return safe_unpickle_weights(raw)
     
     def get_local_rounds_result(self):
         rounds_result = self.round_results.filter(device=self.device)
@@ -102,12 +114,16 @@ class Train(models.Model):
     max_rounds   = models.IntegerField(default=50)
     epochs       = models.IntegerField(default=10)
 
-    # текущие глобальные веса (последний снимок) — список списков чисел
+    # текущие глобальные веса — указатель на чекпоинт последнего раунда (файл в CheckpointStore);
+    # global_blob (контейнер) и global_weights (списки) — только у старых записей, новые туда не пишутся
+    checkpoint = models.ForeignKey('Checkpoint', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    global_blob = models.BinaryField(blank=True, null=True)
     global_weights = models.JSONField(blank=True, null=True)
 
     is_active    = models.BooleanField(default=True)
     ready        = models.BooleanField(default=False)
     created_at   = models.DateTimeField(auto_now_add=True)
+    updated_at   = models.DateTimeField(auto_now=True)  # и при фиксации раунда (update_train_after_agg)
     global_confusion = models.JSONField(blank=True, null=True)
 
     class Meta:
@@ -122,6 +138,98 @@ class Train(models.Model):
     def __str__(self):
         return f"Train {self.date} [{self.model_name}] r={self.round_count}/{self.max_rounds}"
 
+    @property
+    def has_global_weights(self):
+        return self.checkpoint_id is not None or bool(self.global_blob) or bool(self.global_weights)
+
+    def get_global_weights(self):
+        """Слои float32 (лениво, views над файлом чекпоинта) или None."""
+        if self.checkpoint_id is not None:
+            return get_store().load(self.checkpoint.content_hash)
+        if self.global_blob:
+            return unpack_container(bytes(self.global_blob))
+        if self.global_weights:
+            return [np.asarray(w, dtype=np.float32) for w in self.global_weights]
+        return None
+
+    def get_global_weights_lists(self):
+        # для legacy-читателей, которым нужен JSON
+        weights = self.get_global_weights()
+        return [w.tolist() for w in weights] if weights is not None else None
+
+
+class Checkpoint(models.Model):
+    """
+    Индекс чекпоинтов: глобальная модель Train после раунда — файл в CheckpointStore по хешу.
+    base_hash пуст у ключевого кадра, у дельты — хеш базы; size — байт на диске.
+    """
+    train        = models.ForeignKey('Train', on_delete=models.CASCADE, related_name='checkpoints')
+    round_number = models.IntegerField()
+    content_hash = models.CharField(max_length=64, db_index=True)
+    base_hash    = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    size         = models.BigIntegerField(default=0)
+    avg_accuracy = models.FloatField(blank=True, null=True)
+    avg_loss     = models.FloatField(blank=True, null=True)
+    created_at   = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Чекпоинт'
+        verbose_name_plural = 'Чекпоинты'
+        ordering = ['train', 'round_number']
+        constraints = [
+            models.UniqueConstraint(fields=['train', 'round_number'], name='uniq_checkpoint_train_round'),
+        ]
+
+    def __str__(self):
+        return f"Checkpoint {self.train_id} r={self.round_number} {self.content_hash[:12]}"
+
+    def load(self):
+        return get_store().load(self.content_hash)
+
+    @classmethod
+    def delete_unreferenced(cls, hashes):
+        """
+        Удалить файлы, на которые больше не ссылается ни один чекпоинт (файлы общие по хешу).
+        Живыми считаются и базы живых дельт; после удаления дельты проверяется её база.
+        """
+        store = get_store()
+        candidates = set(hashes)
+        while candidates:
+            alive = set(cls.objects.filter(content_hash__in=candidates).values_list('content_hash', flat=True))
+            alive |= set(cls.objects.filter(base_hash__in=candidates).values_list('base_hash', flat=True))
+            frontier = set(alive)
+            while frontier:
+                frontier = {store.base_of(h) for h in frontier} & candidates - alive
+                alive |= frontier
+            bases = set()
+            for h in candidates - alive:
+                base = store.base_of(h)
+                store.delete(h)
+                if base:
+                    bases.add(base)
+            candidates = bases - alive
+
+    @classmethod
+    def prune(cls, train, keep_last, keep_every, keep_best):
+        """
+        Политика хранения по Train: последние N, каждый K-й, лучший по accuracy и текущий —
+        плюс их базы по цепочке дельт до ключевого кадра.
+        """
+        rows = list(cls.objects.filter(train=train).values_list(
+            'id', 'round_number', 'avg_accuracy', 'content_hash', 'base_hash'))
+        current = next((r for pk, r, _, _, _ in rows if pk == train.checkpoint_id), None)
+        keep = retained_rounds([(r, acc) for _, r, acc, _, _ in rows], keep_last, keep_every, keep_best, current)
+        by_hash = {h: (r, base) for _, r, _, h, base in rows}
+        for r, base in [(r, base) for _, r, _, _, base in rows if r in keep]:
+            while base and base in by_hash and by_hash[base][0] not in keep:
+                r, base = by_hash[base]
+                keep.add(r)
+        drop = [(pk, h) for pk, r, _, h, _ in rows if r not in keep]
+        if drop:
+            cls.objects.filter(id__in=[pk for pk, _ in drop]).delete()
+            cls.delete_unreferenced(h for _, h in drop)
+        return len(drop)
+
 
 class RoundResult(models.Model):
     # История раундов. Связываем с Train (можно оставить null=True, если будут старые записи без Train)
@@ -156,12 +264,123 @@ class RoundResult(models.Model):
         ]
 
 
+def result_metrics(result):
+    """result клиента как dict (в старых строках — JSON-строкой)."""
+    if isinstance(result, str):
+        try:
+            result = json.loads(result)
+        except ValueError:
+            return {}
+    return result if isinstance(result, dict) else {}
+
+
+class RoundSummary(models.Model):
+    """
+    Сводка раунда Train, заполняется при агрегации (история — командой backfill_round_summaries):
+    число участников, accuracy/loss (среднее, мин, макс) и сумма confusion/support.
+    Обзорные эндпоинты читают её одной выборкой вместо разбора всех RoundResult.
+    """
+    train        = models.ForeignKey('Train', on_delete=models.CASCADE, related_name='round_summaries')
+    round_number = models.IntegerField()
+    participants = models.IntegerField(default=0)
+    acc_mean     = models.FloatField(blank=True, null=True)
+    acc_min      = models.FloatField(blank=True, null=True)
+    acc_max      = models.FloatField(blank=True, null=True)
+    loss_mean    = models.FloatField(blank=True, null=True)
+    loss_min     = models.FloatField(blank=True, null=True)
+    loss_max     = models.FloatField(blank=True, null=True)
+    # [confusion] или [confusion, support] (float64) в контейнере tensors.pack_container
+    confusion    = models.BinaryField(blank=True, null=True)
+    classes      = models.JSONField(blank=True, null=True)
+    updated_at   = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Сводка раунда'
+        verbose_name_plural = 'Сводки раундов'
+        ordering = ['train', 'round_number']
+        constraints = [
+            models.UniqueConstraint(fields=['train', 'round_number'], name='uniq_round_summary_train_round'),
+        ]
+
+    def __str__(self):
+        return f"Summary {self.train_id} r={self.round_number} n={self.participants}"
+
+    @staticmethod
+    def _stats(values):
+        if not values:
+            return None, None, None
+        return sum(values) / len(values), min(values), max(values)
+
+    @classmethod
+    def compute(cls, train_id, round_number, results=None, confusion=None):
+        """
+        Несохранённая сводка по result клиентов раунда (по умолчанию — из RoundResult).
+        confusion — уже заполненный ConfusionAccumulator раунда, если он есть у вызывающего.
+        """
+        if results is None:
+            results = RoundResult.objects.filter(train_id=train_id, round_number=round_number) \
+                .values_list('result', flat=True)
+        summary = cls(train_id=train_id, round_number=round_number)
+        accs, losses = [], []
+        fill = confusion is None
+        if fill:
+            confusion = ConfusionAccumulator()
+        for raw in results:
+            m = result_metrics(raw)
+            summary.participants += 1
+            val = m.get('accuracy') or m.get('val_accuracy') or m.get('acc')
+            if isinstance(val, (int, float)):
+                accs.append(float(val))
+            val = m.get('loss') if m.get('loss') is not None else m.get('val_loss')
+            if isinstance(val, (int, float)):
+                losses.append(float(val))
+            if fill:
+                confusion.add(m)
+        summary.acc_mean, summary.acc_min, summary.acc_max = cls._stats(accs)
+        summary.loss_mean, summary.loss_min, summary.loss_max = cls._stats(losses)
+        summary.set_confusion(confusion.confusion, confusion.support, confusion.classes)
+        return summary
+
+    @classmethod
+    def build(cls, train_id, round_number, results=None, confusion=None):
+        """Пересчитать и сохранить сводку раунда (upsert по train+round)."""
+        summary = cls.compute(train_id, round_number, results, confusion)
+        fields = {f.attname: getattr(summary, f.attname) for f in cls._meta.concrete_fields
+                  if f.attname not in ('id', 'train_id', 'round_number', 'updated_at')}
+        row, _ = cls.objects.update_or_create(train_id=train_id, round_number=round_number, defaults=fields)
+        return row
+
+    def set_confusion(self, confusion, support=None, classes=None):
+        if confusion is None:
+            self.confusion, self.classes = None, None
+            return
+        arrays = [np.asarray(confusion, dtype=np.float64)]
+        if support is not None:
+            arrays.append(np.asarray(support, dtype=np.float64))
+        self.confusion = pack_container(arrays)
+        self.classes = classes
+
+    def get_confusion(self):
+        """{"confusion", "support", "classes"} списками (как отдаёт UI) или None."""
+        if not self.confusion:
+            return None
+        arrays = unpack_container(bytes(self.confusion))
+        return {
+            'confusion': arrays[0].tolist(),
+            'support': arrays[1].tolist() if len(arrays) > 1 else None,
+            'classes': self.classes,
+        }
 
 
 class AggregetedData(models.Model): 
     created_at = models.DateField(auto_now_add=True)
     local_datas = models.ManyToManyField(LocalData, related_name='aggregated_datas')
+    # legacy: усреднённые веса списками; новые строки держат бегущую сумму ниже, списки — через get_data()
     data = models.JSONField(blank=True, null=True)
+    # бегущая сумма весов по LocalData (контейнер tensors.pack_container, float64) и число слагаемых
+    running_sum = models.BinaryField(blank=True, null=True)
+    running_count = models.IntegerField(default=0)
+    folded = models.JSONField(default=list, blank=True)  # id LocalData, уже учтённых в running_sum
     is_active = models.BooleanField(default=False, verbose_name='Статус активности')
     ready = models.BooleanField(default=False, verbose_name='Готовность данных')
     subscribed_devices = models.ManyToManyField(Device, related_name='subscribed_devices')
@@ -178,74 +397,94 @@ class AggregetedData(models.Model):
             models.Index(fields=["is_active", "-created_at"]),
         ]
 
+    def _load_running(self):
+        if not self.running_sum:
+            return None
+        # копия: views над bytes только для чтения, а сумму будем менять
+        return [np.array(a, dtype=np.float64) for a in unpack_container(bytes(self.running_sum))]
+
+    def _store_running(self, sums, count, folded):
+        self.running_sum = pack_container(sums) if sums is not None else None
+        self.running_count = count
+        self.folded = sorted(folded)
+
+    def rebuild_running(self):
+        """Полный пересчёт суммы по всем LocalData — только для строк, созданных до бегущей суммы."""
+        executor = get_executor()
+        acc = executor.new_accumulator()
+        folded = []
+        try:
+            for local in self.local_datas.all():
+                try:
+                    w = local.get_weights()
+                    if not isinstance(w, (list, tuple)) or not w:
+                        raise TypeError("weights should be list/tuple of arrays")
+                    executor.fold_blocking(acc, local.pk, w)
+                    folded.append(local.pk)
+                except Exception as e:
+                    print(f"[WARN] Skipping corrupted weight for device {getattr(local, 'device_id', None)}: {e}")
+            self._store_running([np.array(a) for a in acc.sums] if acc.sums is not None else None, len(folded), folded)
+        finally:
+            acc.release()
+
+    def fold_local_data(self, local, weights=None, previous=None):
+        """
+        Учесть новые веса LocalData ровно один раз: + новые, - прежние (если эта LocalData уже
+        в сумме — за день устройство перезаписывает свою LocalData). Один decode на загрузку вместо N.
+        local должна быть уже сохранена и привязана к local_datas.
+        """
+        folded = set(self.folded or [])
+        if self.running_sum is None or (local.pk in folded and previous is None):
+            # суммы ещё нет (строка до этого поля) или прежний вклад не вычесть — один пересчёт с нуля
+            self.rebuild_running()
+            return
+        weights = [np.asarray(a) for a in (weights if weights is not None else local.get_weights())]
+        sums = self._load_running()
+        if len(weights) != len(sums):
+            raise ValueError(f"Inconsistent number of layers: {len(weights)} != {len(sums)}")
+        for k, (acc, a) in enumerate(zip(sums, weights)):
+            if a.shape != acc.shape:
+                raise ValueError(f"Incompatible shape at layer {k}: {a.shape} != {acc.shape}")
+            acc += a
+        count = self.running_count
+        if local.pk in folded:
+            for acc, a in zip(sums, previous):
+                acc -= np.asarray(a)
+        else:
+            folded.add(local.pk)
+            count += 1
+        self._store_running(sums, count, folded)
+
+    def get_weights(self):
+        """Усреднённые веса (float32-массивы) или None."""
+        sums = self._load_running()
+        if sums is None or not self.running_count:
+            return None
+        return [(a / self.running_count).astype(np.float32) for a in sums]
+
+    def get_data(self):
+        # для legacy-читателей (JSON): списки, как раньше лежали в data
+        weights = self.get_weights()
+        if weights is None:
+            return self.data
+        return [a.tolist() for a in weights]
+
     def aggregate_data(self):
-        import base64, pickle, numpy as np
-        from django.utils.timezone import now
-
-        # 1) Собираем LocalData, по возможности ограничив по дате (если поле есть)
-        lds_qs = self.local_datas.all()
-        # Если у LocalData есть created_at (date), можно сузить:
-        # lds_qs = lds_qs.filter(created_at=now().date())
-
-        local_weights = []
-        bad = 0
-        for local in lds_qs:
-            try:
-                raw = base64.b64decode((local.data or "").encode())
-                w = pickle.loads(raw)
-                # Ожидаем список/кортеж numpy-массивов
-                if not isinstance(w, (list, tuple)) or not w:
-                    raise TypeError("weights should be list/tuple of arrays")
-                local_weights.append([np.asarray(a) for a in w])
-            except Exception as e:
-                bad += 1
-                print(f"[WARN] Skipping corrupted weight for device {getattr(local, 'device_id', None)}: {e}")
-
-        if not local_weights:
+        if self.running_sum is None:
+            self.rebuild_running()
+        data = self.get_data()
+        if not data:
             raise ValueError("No valid local weights found for aggregation.")
-
-        # 2) Если только один клиент — просто вернём его веса (FedAvg == идентичности)
-        if len(local_weights) == 1:
-            single = local_weights[0]
-            # Приведём к list of lists (если вы так храните), иначе можно вернуть как есть
-            return [arr.tolist() for arr in single]
-
-        # 3) Проверка совместимости слоёв
-        num_layers = len(local_weights[0])
-        for i, w in enumerate(local_weights):
-            if len(w) != num_layers:
-                raise ValueError(f"Inconsistent number of layers: sample 0 has {num_layers}, sample {i} has {len(w)}")
-
-        ref_shapes = [arr.shape for arr in local_weights[0]]
-        for i, w in enumerate(local_weights[1:], start=1):
-            for k, (a, s) in enumerate(zip(w, ref_shapes)):
-                if a.shape != s:
-                    raise ValueError(f"Incompatible shape at client {i}, layer {k}: {a.shape} != {s}")
-
-        # 4) Усреднение через stack (надёжнее, чем mean по списку объектов)
-        aggregated = []
-        for layer_idx in range(num_layers):
-            try:
-                layer_stack = np.stack([w[layer_idx] for w in local_weights], axis=0)  # (N, ...)
-                layer_mean  = layer_stack.mean(axis=0)
-                aggregated.append(layer_mean.tolist())
-            except Exception as e:
-                # fallback: нули той же формы, но логируем
-                print(f"[WARN] Aggregation failed at layer {layer_idx}: {e}. Filling zeros.")
-                aggregated.append(np.zeros(ref_shapes[layer_idx], dtype=np.float32).tolist())
-
-        return aggregated
+        return data
 
     def save(self, aggregate=False, *args, **kwargs):
         if aggregate:
-            aggregated_data = self.aggregate_data()
-            if aggregated_data:
-                self.data = aggregated_data 
-                super().save(*args, **kwargs)
-            else:
+            # бегущая сумма обновляется в fold_local_data; здесь — только для строк без неё
+            if self.running_sum is None:
+                self.rebuild_running()
+            if not self.running_count:
                 raise ValueError("Failed to aggregate data")
-        else:
-            super().save(*args, **kwargs)
+        super().save(*args, **kwargs)
  
 
 
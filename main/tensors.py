@@ -0,0 +1,399 @@
+# tensors.py
+"""
+Бинарный формат весов модели: транспорт по WebSocket (bytes_data) и хранение.
+
+Контейнер (без pickle, самоописывающий):
+    b"BILT" | u8 версия | 3 байта резерв | u32 LE длина манифеста | манифест (JSON) | выравнивание | данные
+Манифест: {"layers": [{"dtype": "<f4", "shape": [...], "offset": N, "nbytes": M}, ...]},
+offset считается от начала области данных, каждый слой выровнен на ALIGN байт.
+Чтение — np.frombuffer-представления поверх исходного буфера, без копий.
+
+Кадр WebSocket: [u32 BE длина заголовка][JSON-заголовок][контейнер].
+Заголовок — обычное JSON-сообщение протокола (type, train_id, round, metrics, ...).
+Старый вариант кадра (``layers`` в заголовке и слои подряд в теле) по-прежнему принимается.
+"""
+import hashlib
+import io
+import json
+import pickle
+import struct
+import zlib
+
+import numpy as np
+
+HEADER_LEN = struct.Struct(">I")
+
+CONTAINER_MAGIC = b"BILT"
+CONTAINER_VERSION = 1
+CONTAINER_PREFIX = struct.Struct("<4sB3xI")
+ALIGN = 64
+MAX_LAYERS = 4096
+MAX_INFLATED = 512 * 1024 * 1024  # предел распакованного тела кадра (zlib-бомба не раздует память)
+# только числовые little-endian типы; всё остальное (object, структуры, строки) отклоняем до аллокаций
+ALLOWED_DTYPES = frozenset(np.dtype(t).str for t in (
+    "<f2", "<f4", "<f8", "|i1", "|u1", "<i2", "<u2", "<i4", "<u4", "<i8", "<u8", "|b1",
+))
+
+
+class FrameError(ValueError):
+    """Кадр повреждён или не соответствует заявленному заголовку."""
+
+
+def _contiguous(a):
+    # np.ascontiguousarray превращает 0-d в 1-d, поэтому копируем только при необходимости
+    a = np.asarray(a)
+    if a.dtype.byteorder == ">":
+        a = a.astype(a.dtype.newbyteorder("<"))
+    return a if a.flags.c_contiguous else a.copy(order="C")
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _layer_dtype(spec, i):
+    try:
+        name = spec["dtype"]
+    except (KeyError, TypeError):
+        raise FrameError(f"bad layer spec #{i}: dtype is required")
+    if name not in ALLOWED_DTYPES:
+        raise FrameError(f"layer #{i}: dtype {name!r} is not allowed")
+    return np.dtype(name)
+
+
+def _layer_shape(spec, i):
+    shape = spec.get("shape")
+    if not isinstance(shape, list) or not all(isinstance(d, int) and d >= 0 for d in shape):
+        raise FrameError(f"layer #{i}: bad shape")
+    return tuple(shape)
+
+
+def pack_container(arrays, prefix: bytes = b"") -> bytes:
+    """Упаковать слои в контейнер; ``prefix`` (заголовок кадра) пишется в тот же буфер перед ним."""
+    arrays = [_contiguous(a) for a in arrays]
+    for i, a in enumerate(arrays):
+        if a.dtype.str not in ALLOWED_DTYPES:
+            raise FrameError(f"layer #{i}: dtype {a.dtype.str!r} is not allowed")
+    layers = []
+    offset = 0
+    for a in arrays:
+        offset = _align(offset)
+        layers.append({"dtype": a.dtype.str, "shape": list(a.shape), "offset": offset, "nbytes": a.nbytes})
+        offset += a.nbytes
+    manifest = json.dumps({"layers": layers}).encode("utf-8")
+    data_start = _align(CONTAINER_PREFIX.size + len(manifest))
+
+    base = len(prefix)
+    out = bytearray(base + data_start + offset)
+    out[:base] = prefix
+    CONTAINER_PREFIX.pack_into(out, base, CONTAINER_MAGIC, CONTAINER_VERSION, len(manifest))
+    out[base + CONTAINER_PREFIX.size:base + CONTAINER_PREFIX.size + len(manifest)] = manifest
+    for a, spec in zip(arrays, layers):
+        dst = np.frombuffer(out, dtype=np.uint8, count=spec["nbytes"], offset=base + data_start + spec["offset"])
+        dst[:] = a.reshape(-1).view(np.uint8)
+    return bytes(out)
+
+
+def is_container(buf) -> bool:
+    return bytes(memoryview(buf)[:4]) == CONTAINER_MAGIC
+
+
+def unpack_container(buf) -> list:
+    """
+    Слои контейнера как представления np.frombuffer поверх ``buf``.
+    Манифест полностью проверяется (тип, форма, границы) до создания массивов.
+    """
+    view = memoryview(buf).cast("B")
+    if len(view) < CONTAINER_PREFIX.size:
+        raise FrameError("container too short")
+    magic, version, manifest_len = CONTAINER_PREFIX.unpack_from(view)
+    if magic != CONTAINER_MAGIC:
+        raise FrameError("not a weights container")
+    if version != CONTAINER_VERSION:
+        raise FrameError(f"unsupported container version {version}")
+    manifest_end = CONTAINER_PREFIX.size + manifest_len
+    if manifest_end > len(view):
+        raise FrameError("manifest exceeds container size")
+    try:
+        manifest = json.loads(bytes(view[CONTAINER_PREFIX.size:manifest_end]).decode("utf-8"))
+        layers = manifest["layers"]
+    except (UnicodeDecodeError, json.JSONDecodeError, KeyError, TypeError) as e:
+        raise FrameError(f"invalid manifest: {e}")
+    if not isinstance(layers, list) or len(layers) > MAX_LAYERS:
+        raise FrameError("invalid manifest: layers")
+
+    data_start = _align(manifest_end)
+    data_len = len(view) - data_start
+    specs = []
+    for i, spec in enumerate(layers):
+        if not isinstance(spec, dict):
+            raise FrameError(f"bad layer spec #{i}")
+        dtype = _layer_dtype(spec, i)
+        shape = _layer_shape(spec, i)
+        count = 1
+        for d in shape:
+            count *= d
+        offset, nbytes = spec.get("offset"), spec.get("nbytes")
+        if not isinstance(offset, int) or offset < 0 or nbytes != count * dtype.itemsize:
+            raise FrameError(f"layer #{i}: bad offset/nbytes")
+        if offset + nbytes > data_len:
+            raise FrameError(f"layer #{i} exceeds container")
+        specs.append((dtype, shape, count, data_start + offset))
+    return [np.frombuffer(view, dtype=dtype, count=count, offset=offset).reshape(shape)
+            for dtype, shape, count, offset in specs]
+
+
+def weights_version(arrays) -> str:
+    """Короткий хеш содержимого модели (dtype + форма + байты слоёв) — версия global_weights."""
+    h = hashlib.blake2b(digest_size=8)
+    for a in arrays:
+        a = _contiguous(a)
+        h.update(f"{a.dtype.str}{a.shape};".encode("ascii"))
+        h.update(a.reshape(-1).view(np.uint8))
+    return h.hexdigest()
+
+
+# -------------- кадры WebSocket --------------
+def encode_frame(header: dict, arrays) -> bytes:
+    head_raw = json.dumps(header).encode("utf-8")
+    # добиваем заголовок пробелами (валидный JSON), чтобы контейнер и слои были выровнены в кадре
+    head_raw += b" " * (_align(HEADER_LEN.size + len(head_raw)) - HEADER_LEN.size - len(head_raw))
+    return pack_container(arrays, prefix=HEADER_LEN.pack(len(head_raw)) + head_raw)
+
+
+def split_frame(data: bytes):
+    """Разобрать только заголовок (дёшево, можно на event loop); тело — memoryview без копии."""
+    view = memoryview(data)
+    if len(view) < HEADER_LEN.size:
+        raise FrameError("frame too short")
+    (head_len,) = HEADER_LEN.unpack_from(view)
+    start = HEADER_LEN.size
+    if start + head_len > len(view):
+        raise FrameError("header length exceeds frame size")
+    try:
+        header = json.loads(bytes(view[start:start + head_len]).decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise FrameError(f"invalid header: {e}")
+    if not isinstance(header, dict):
+        raise FrameError("header must be a JSON object")
+    return header, view[start + head_len:]
+
+
+def decode_tensors(layers, body) -> list:
+    """Старый формат тела: слои подряд по описанию ``layers`` из заголовка."""
+    if not isinstance(layers, list) or len(layers) > MAX_LAYERS:
+        raise FrameError("layers must be a list")
+    specs = []
+    offset = 0
+    for i, spec in enumerate(layers):
+        if not isinstance(spec, dict):
+            raise FrameError(f"bad layer spec #{i}")
+        dtype = _layer_dtype(spec, i)
+        shape = _layer_shape(spec, i)
+        count = 1
+        for d in shape:
+            count *= d
+        nbytes = count * dtype.itemsize
+        if offset + nbytes > len(body):
+            raise FrameError(f"layer #{i} exceeds frame body")
+        specs.append((dtype, shape, count, offset))
+        offset += nbytes
+    if offset != len(body):
+        raise FrameError("trailing bytes after last layer")
+    return [np.frombuffer(body, dtype=dtype, count=count, offset=off).reshape(shape)
+            for dtype, shape, count, off in specs]
+
+
+def decode_body(header: dict, body, max_size: int = MAX_INFLATED) -> list:
+    body = inflate_body(header, body, max_size)
+    if header.get("layers") is not None:
+        return decode_tensors(header["layers"], body)
+    return unpack_container(body)
+
+
+def decode_frame(data: bytes):
+    header, body = split_frame(data)
+    return header, decode_body(header, body)
+
+
+def inflate_body(header: dict, body, max_size: int = MAX_INFLATED):
+    """
+    Тело кадра может быть сжато клиентом (``"compression": "zlib"``) — дельты жмутся хорошо.
+    Распаковывается не больше max_size байт; тело, которое раскрылось бы больше, отклоняется.
+    """
+    codec = header.get("compression")
+    if not codec:
+        return body
+    if codec != "zlib":
+        raise FrameError(f"unsupported compression: {codec}")
+    inflater = zlib.decompressobj()
+    try:
+        out = inflater.decompress(body, max_size)
+    except zlib.error as e:
+        raise FrameError(f"bad compressed body: {e}")
+    if inflater.unconsumed_tail:
+        raise FrameError(f"compressed body inflates beyond {max_size} bytes")
+    if not inflater.eof:
+        raise FrameError("bad compressed body: truncated stream")
+    return out
+
+
+# -------------- delta-обновления --------------
+class StaleBaseError(ValueError):
+    """Дельта посчитана не от той глобальной версии, что есть у сервера."""
+
+
+def apply_delta(base, delta) -> list:
+    """Полные веса = глобальная версия клиента + присланная разница (float32)."""
+    if len(base) != len(delta):
+        raise ValueError(f"delta has {len(delta)} layers, base has {len(base)}")
+    out = []
+    for k, (b, d) in enumerate(zip(base, delta)):
+        b = np.asarray(b, dtype=np.float32)
+        d = np.asarray(d)
+        if b.shape != d.shape:
+            raise ValueError(f"delta shape mismatch at layer {k}: {d.shape} != {b.shape}")
+        out.append(b + d.astype(np.float32, copy=False))
+    return out
+
+
+# -------------- top-k разреженные обновления --------------
+def decode_sparse(arrays, shapes) -> list:
+    """
+    Контейнер top-k: на каждый слой пара (плоские индексы, значения) относительно базовой версии.
+    Возвращает [(idx int64, vals float32), ...]; индексы проверяются на границы слоя.
+    """
+    if len(arrays) != 2 * len(shapes):
+        raise ValueError(f"sparse update has {len(arrays)} arrays, expected {2 * len(shapes)}")
+    out = []
+    for k, shape in enumerate(shapes):
+        idx = np.asarray(arrays[2 * k]).reshape(-1)
+        vals = np.asarray(arrays[2 * k + 1]).reshape(-1)
+        if idx.dtype.kind not in "iu" or idx.shape != vals.shape:
+            raise ValueError(f"layer {k}: sparse indices/values mismatch")
+        size = int(np.prod(shape, dtype=np.int64))
+        if idx.size and (int(idx.min()) < 0 or int(idx.max()) >= size):
+            raise ValueError(f"layer {k}: sparse index out of range")
+        out.append((idx.astype(np.int64, copy=False), vals.astype(np.float32, copy=False)))
+    return out
+
+
+def merge_sparse(a, b):
+    """Сумма двух разреженных векторов (idx, vals) с объединением совпадающих индексов."""
+    idx = np.concatenate([a[0], b[0]])
+    vals = np.concatenate([a[1], b[1]])
+    if not idx.size:
+        return idx, vals
+    uniq, inverse = np.unique(idx, return_inverse=True)
+    return uniq, np.bincount(inverse, weights=vals, minlength=uniq.size).astype(np.float32)
+
+
+def topk_split(idx, vals, k):
+    """Разделить разреженный вектор на k наибольших по модулю элементов и остаток."""
+    if vals.size <= k:
+        return (idx, vals), (idx[:0], vals[:0])
+    order = np.argpartition(np.abs(vals), vals.size - k)
+    keep, rest = order[vals.size - k:], order[:vals.size - k]
+    return (idx[keep], vals[keep]), (idx[rest], vals[rest])
+
+
+# -------------- квантизация транспорта --------------
+QUANT_MODES = ("float16", "int8")
+
+
+def quantize(arrays, mode):
+    """
+    float16 — простое приведение типа; int8 — аффинно по слою: q = round(x / scale) + zero_point.
+    Возвращает (массивы, параметры по слоям).
+    """
+    if mode == "float16":
+        return [np.asarray(a, dtype=np.float16) for a in arrays], None
+    if mode != "int8":
+        raise ValueError(f"unsupported quantization: {mode}")
+    out, params = [], []
+    for a in arrays:
+        a = np.asarray(a, dtype=np.float32)
+        # диапазон включает 0, чтобы нули (bias, паддинги) восстанавливались точно
+        lo = min(float(a.min()), 0.0) if a.size else 0.0
+        hi = max(float(a.max()), 0.0) if a.size else 0.0
+        scale = (hi - lo) / 255.0 or 1.0
+        zero_point = int(np.clip(round(-128 - lo / scale), -128, 127))
+        q = np.clip(np.rint(a / scale) + zero_point, -128, 127).astype(np.int8)
+        out.append(q)
+        params.append({"scale": scale, "zero_point": zero_point})
+    return out, params
+
+
+def dequantize(arrays, mode, params=None) -> list:
+    if mode == "float16":
+        return [np.asarray(a).astype(np.float32) for a in arrays]
+    if mode != "int8":
+        raise ValueError(f"unsupported quantization: {mode}")
+    if not isinstance(params, list) or len(params) != len(arrays):
+        raise ValueError("int8 weights need per-layer scale/zero_point")
+    out = []
+    for a, p in zip(arrays, params):
+        scale = np.float32(p["scale"])
+        zero_point = np.float32(p["zero_point"])
+        out.append((np.asarray(a).astype(np.float32) - zero_point) * scale)
+    return out
+
+
+def quantization_error(arrays, mode) -> dict:
+    """Ошибка квантизации модели целиком: относительная L2 и максимальная абсолютная."""
+    q, params = quantize(arrays, mode)
+    restored = dequantize(q, mode, params)
+    num = den = 0.0
+    max_abs = 0.0
+    for a, r in zip(arrays, restored):
+        a = np.asarray(a, dtype=np.float32)
+        diff = a - r
+        num += float(np.dot(diff.ravel(), diff.ravel()))
+        den += float(np.dot(a.ravel(), a.ravel()))
+        if diff.size:
+            max_abs = max(max_abs, float(np.abs(diff).max()))
+    return {"rel_l2": (num ** 0.5) / (den ** 0.5) if den else 0.0, "max_abs": max_abs}
+
+
+# -------------- legacy: pickle(...).hex() внутри JSON --------------
+class _WeightsUnpickler(pickle.Unpickler):
+    """pickle от старых клиентов: разрешены только numpy-массивы, dtype и скаляры."""
+
+    ALLOWED = {
+        ("numpy", "ndarray"), ("numpy", "dtype"),
+        ("numpy.core.multiarray", "_reconstruct"), ("numpy._core.multiarray", "_reconstruct"),
+        ("numpy.core.multiarray", "scalar"), ("numpy._core.multiarray", "scalar"),
+        # протокол 5 (по умолчанию с Python 3.14): буфер массива отдельно от заголовка
+        ("numpy.core.numeric", "_frombuffer"), ("numpy._core.numeric", "_frombuffer"),
+        # протокол 2: bytes кодируются как _codecs.encode(str, "latin1")
+        ("_codecs", "encode"),
+    }
+
+    def find_class(self, module, name):
+        if (module, name) not in self.ALLOWED:
+            raise pickle.UnpicklingError(f"global {module}.{name} is not allowed in weights")
+        return super().find_class(module, name)
+
+
+def safe_unpickle_weights(raw: bytes) -> list:
+    weights = _WeightsUnpickler(io.BytesIO(raw)).load()
+    if not isinstance(weights, (list, tuple)):
+        raise FrameError("weights should be a list of arrays")
+    out = []
+    for i, w in enumerate(weights):
+        a = np.asarray(w)
+        if a.dtype.kind not in "fiub":
+            raise FrameError(f"layer #{i}: non-numeric dtype {a.dtype}")
+        out.append(a)
+    return out
+
+
+def decode_legacy_payload(payload: str) -> list:
+    raw = bytes.fromhex(payload)
+    if is_container(raw):
+        return unpack_container(raw)
+    return safe_unpickle_weights(raw)
+
+
+def encode_legacy_payload(weights) -> str:
+    return pickle.dumps(weights).hex()
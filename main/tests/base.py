@@ -0,0 +1,102 @@
+import asyncio
+import json
+import shutil
+import tempfile
+
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase, override_settings
+
+from main import checkpoints, consumers
+from main.models import Device
+from main.tensors import decode_frame, decode_legacy_payload, encode_frame
+from main.trainstate import trains
+
+
+class ConsumerTestCase(TransactionTestCase):
+    """Обучение через /ws/train_model/ целиком: UI-сокет, устройства, раунды; чекпоинты — во временном каталоге."""
+
+    devices_count = 2
+    settings_overrides = {}
+
+    def setUp(self):
+        self.ckpt_dir = tempfile.mkdtemp()
+        self.override = override_settings(FL_CHECKPOINT_DIR=self.ckpt_dir, **self.settings_overrides)
+        self.override.enable()
+        checkpoints._store = None
+        consumers.TrainModelConsumer.aggregations.clear()
+        consumers.TrainModelConsumer.uploads.items.clear()
+        latency = consumers.TrainModelConsumer.latency
+        for table in (latency.devices, latency.models, latency.rounds):
+            table.clear()
+        trains.items.clear()
+        self.user = User.objects.create(username="fl")
+        self.devices = [Device.objects.create(name=f"d{i}", user=self.user) for i in range(self.devices_count)]
+        self.app = consumers.TrainModelConsumer.as_asgi()
+        self.sockets = []
+
+    def tearDown(self):
+        consumers.TrainModelConsumer.aggregations.clear()
+        trains.items.clear()
+        checkpoints._store = None
+        self.override.disable()
+        shutil.rmtree(self.ckpt_dir, ignore_errors=True)
+
+    async def connect(self, device=None, **hello):
+        ws = WebsocketCommunicator(self.app, "/ws/train_model/")
+        await ws.connect()
+        self.sockets.append(ws)
+        if device is not None:
+            hello.setdefault("capabilities", {"binary_weights": True})
+            await ws.send_to(text_data=json.dumps({"type": "hello", "device_token": device.device_token, **hello}))
+        return ws
+
+    async def connect_all(self, **hello):
+        ui = await self.connect()
+        clients = [await self.connect(d, **hello) for d in self.devices]
+        return ui, clients
+
+    async def start(self, ui, **options):
+        await ui.send_to(text_data=json.dumps({"type": "start_training", "model": "dnn", "rounds": 10, **options}))
+        await asyncio.sleep(0.3)
+        return trains.get(max(trains.items))["id"]
+
+    async def close(self):
+        await asyncio.sleep(0.3)  # фоновая запись чекпоинтов
+        for ws in self.sockets:
+            await ws.disconnect()
+
+    @staticmethod
+    async def drain(ws, timeout=0.3):
+        """
+        Все сообщения, пришедшие на сокет; веса (кадр или legacy payload) — в ключе "_arrays",
+        закрытие сокета сервером — {"type": "_closed", "code": ...}.
+        """
+        out = []
+        while not await ws.receive_nothing(timeout):
+            m = await ws.receive_output(timeout)
+            if m["type"] == "websocket.close":
+                out.append({"type": "_closed", "code": m.get("code")})
+                break
+            if m.get("text") is not None:
+                msg = json.loads(m["text"])
+                if msg.get("payload"):
+                    msg["_arrays"] = decode_legacy_payload(msg["payload"])
+            else:
+                header, arrays = decode_frame(m["bytes"])
+                msg = {**header, "_arrays": arrays, "_binary": True}
+            out.append(msg)
+        return out
+
+    @staticmethod
+    def of_type(messages, kind):
+        return [m for m in messages if m.get("type") == kind]
+
+    @staticmethod
+    def frame(train_id, round_no, arrays, **fields):
+        return encode_frame({"type": "weights", "train_id": train_id, "round": round_no, "num_samples": 1, **fields},
+                            arrays)
+
+    async def send_weights(self, ws, train_id, round_no, arrays, wait=0.2, **fields):
+        await ws.send_to(bytes_data=self.frame(train_id, round_no, arrays, **fields))
+        await asyncio.sleep(wait)
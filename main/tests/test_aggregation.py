@@ -0,0 +1,124 @@
+import asyncio
+import shutil
+import tempfile
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from main.aggregation import MIN_CHUNK, AggregationExecutor, FedAvgAccumulator, _partition
+
+
+class FedAvgTests(SimpleTestCase):
+    def setUp(self):
+        self.executor = AggregationExecutor(workers=1)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_weighted_by_num_samples(self):
+        acc = self.executor.new_accumulator(round_no=3)
+        self.executor.fold_blocking(acc, 1, [np.full(4, 1.0, np.float32), np.zeros((2, 2), np.float32)], 1)
+        self.executor.fold_blocking(acc, 2, [np.full(4, 4.0, np.float32), np.ones((2, 2), np.float32)], 3)
+        out = acc.result()
+        np.testing.assert_allclose(out[0], np.full(4, 3.25))
+        np.testing.assert_allclose(out[1], np.full((2, 2), 0.75))
+        self.assertEqual(out[0].dtype, np.float32)
+        self.assertEqual((len(acc), acc.round_no), (2, 3))
+
+    def test_gateway_partial_sum_counts_its_devices(self):
+        # шлюз присылает сумму n_i * w_i своих устройств (scale=1), знаменатель — их примеры
+        acc = self.executor.new_accumulator()
+        self.executor.fold_blocking(acc, "gw", [np.array([2 * 1.0 + 2 * 3.0])], 4, scale=1.0, members=2)
+        self.executor.fold_blocking(acc, 7, [np.array([6.0])], 4)
+        np.testing.assert_allclose(acc.result()[0], [4.0])
+        self.assertEqual((len(acc), acc.members), (2, 3))
+
+    def test_empty_round_has_no_result(self):
+        self.assertIsNone(FedAvgAccumulator().result())
+
+    def test_shape_mismatch_is_rejected(self):
+        acc = FedAvgAccumulator()
+        acc.add_dense(1, [np.zeros(3)])
+        with self.assertRaises(ValueError):
+            acc.add_dense(2, [np.zeros(4)])
+        with self.assertRaises(ValueError):
+            acc.add_dense(2, [np.zeros(3), np.zeros(1)])
+        self.assertEqual(len(acc), 1)
+
+
+class SparseFoldTests(SimpleTestCase):
+    def test_sparse_update_is_added_to_base(self):
+        acc = FedAvgAccumulator()
+        base = [np.array([1.0, 1.0, 1.0], np.float32)]
+        acc.add_sparse(1, [(3,)], [(np.array([0]), np.array([2.0], np.float32))], num_samples=1)
+        acc.add_dense(2, [np.array([3.0, 3.0, 3.0])], num_samples=1)
+        # клиент 1 = база + [2, 0, 0] = [3, 1, 1], клиент 2 = [3, 3, 3]
+        np.testing.assert_allclose(acc.result(base)[0], [3.0, 2.0, 2.0])
+        with self.assertRaises(ValueError):
+            acc.result()
+
+
+class ExecutorTests(SimpleTestCase):
+    def test_partition_covers_every_element_once(self):
+        sizes = [3 * MIN_CHUNK + 5, 7, MIN_CHUNK]
+        groups = _partition(sizes, 4)
+        self.assertLessEqual(len(groups), 4)
+        seen = [np.zeros(s, int) for s in sizes]
+        for items in groups:
+            for k, start, stop in items:
+                seen[k][start:stop] += 1
+        for s in seen:
+            self.assertTrue((s == 1).all())
+
+    def test_small_model_is_one_task(self):
+        self.assertEqual(_partition([10, 20], 8), [[(0, 0, 10), (1, 0, 20)]])
+
+    def _fold_two(self, mode):
+        executor = AggregationExecutor(workers=3, mode=mode)
+        self.addCleanup(executor.shutdown)
+        acc = executor.new_accumulator()
+        self.addCleanup(acc.release)
+        big = 2 * MIN_CHUNK + 11
+        executor.fold_blocking(acc, 1, [np.arange(big, dtype=np.float32), np.ones((3, 2), np.float32)], 1)
+        asyncio.run(executor.fold(acc, 2, [np.full(big, 2.0, np.float32), np.zeros((3, 2), np.float32)], 3))
+        return acc.result()
+
+    def test_thread_pool_fold(self):
+        out = self._fold_two("thread")
+        np.testing.assert_allclose(out[0], (np.arange(2 * MIN_CHUNK + 11) + 6.0) / 4)
+        np.testing.assert_allclose(out[1], np.full((3, 2), 0.25))
+
+    def test_process_pool_fold_in_shared_memory(self):
+        out = self._fold_two("process")
+        np.testing.assert_allclose(out[0], (np.arange(2 * MIN_CHUNK + 11) + 6.0) / 4)
+        np.testing.assert_allclose(out[1], np.full((3, 2), 0.25))
+
+
+class SpoolTests(SimpleTestCase):
+    def setUp(self):
+        self.spool = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool, True)
+
+    def test_spooled_round_survives_restart(self):
+        acc = FedAvgAccumulator(spool=self.spool, round_no=5)
+        acc.tags["relative"] = True
+        acc.add_dense(1, [np.array([2.0, 4.0])], num_samples=2)
+        acc.add_dense((3, 4), [np.array([5.0, 1.0])], num_samples=1)
+        acc.release(keep_spool=True)
+
+        restored = FedAvgAccumulator.recover(self.spool)
+        self.assertEqual(restored.round_no, 5)
+        self.assertEqual(restored.tags, {"relative": True})
+        self.assertEqual(restored.contributors, {1, (3, 4)})
+        np.testing.assert_allclose(restored.result()[0], [3.0, 3.0])
+        restored.release()
+
+    def test_interrupted_fold_is_not_recovered(self):
+        acc = FedAvgAccumulator(spool=self.spool)
+        acc.add_dense(1, [np.ones(2)])
+        acc.begin(2)  # упали посреди сложения
+        acc.release(keep_spool=True)
+        self.assertIsNone(FedAvgAccumulator.recover(self.spool))
+
+    def test_empty_spool_has_nothing_to_recover(self):
+        self.assertIsNone(FedAvgAccumulator.recover(self.spool))
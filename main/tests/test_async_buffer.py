@@ -0,0 +1,120 @@
+import asyncio
+import json
+import shutil
+import tempfile
+
+import numpy as np
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase, override_settings
+
+from main import checkpoints, consumers
+from main.models import Device
+from main.tensors import decode_frame, encode_frame
+from main.trainstate import trains
+
+
+class AsyncBufferTests(TransactionTestCase):
+    """Асинхронный режим end-to-end: клиенты шлют обновления, сервер рассылает версии по K в буфере."""
+
+    def setUp(self):
+        self.ckpt_dir = tempfile.mkdtemp()
+        self.override = override_settings(FL_CHECKPOINT_DIR=self.ckpt_dir, FL_ASYNC_STALENESS_ALPHA=0.5)
+        self.override.enable()
+        checkpoints._store = None
+        consumers.TrainModelConsumer.aggregations.clear()
+        trains.items.clear()
+        user = User.objects.create(username="fl")
+        self.devices = [Device.objects.create(name=f"d{i}", user=user) for i in range(3)]
+        self.app = consumers.TrainModelConsumer.as_asgi()
+
+    def tearDown(self):
+        consumers.TrainModelConsumer.aggregations.clear()
+        trains.items.clear()
+        checkpoints._store = None
+        self.override.disable()
+        shutil.rmtree(self.ckpt_dir, ignore_errors=True)
+
+    async def _connect(self):
+        ui = WebsocketCommunicator(self.app, "/ws/train_model/")
+        await ui.connect()
+        clients = []
+        for d in self.devices:
+            c = WebsocketCommunicator(self.app, "/ws/train_model/")
+            await c.connect()
+            await c.send_to(text_data=json.dumps({
+                "type": "hello", "device_token": d.device_token, "capabilities": {"binary_weights": True},
+            }))
+            clients.append(c)
+        return ui, clients
+
+    async def _start(self, ui, clients, k):
+        await ui.send_to(text_data=json.dumps({
+            "type": "start_training", "model": "asy", "rounds": 10, "mode": "async", "buffer_k": k,
+        }))
+        await asyncio.sleep(0.3)
+        for c in [ui, *clients]:
+            await self._drain(c)
+        return trains.get(max(trains.items))["id"]
+
+    async def _drain(self, c, timeout=0.3):
+        out = []
+        while not await c.receive_nothing(timeout):
+            m = await c.receive_output(timeout)
+            if m.get("text") is not None:
+                out.append(json.loads(m["text"]))
+            else:
+                header, arrays = decode_frame(m["bytes"])
+                out.append({**header, "_arrays": arrays})
+        return out
+
+    async def _send(self, client, train_id, base_round, value):
+        await client.send_to(bytes_data=encode_frame(
+            {"type": "weights", "train_id": train_id, "round": base_round, "base_round": base_round, "num_samples": 1},
+            [np.full(3, value, np.float32)],
+        ))
+        await asyncio.sleep(0.3)
+
+    async def _versions(self, client):
+        return {m["round"]: float(m["_arrays"][0][0]) for m in await self._drain(client)
+                if m.get("type") == "global_weights"}
+
+    async def _close(self, ui, clients):
+        await asyncio.sleep(0.3)  # фоновая запись чекпоинтов
+        for c in [ui, *clients]:
+            await c.disconnect()
+
+    async def test_stale_update_moves_global_less_than_fresh(self):
+        ui, clients = await self._connect()
+        train_id = await self._start(ui, clients, k=1)
+
+        await self._send(clients[0], train_id, 0, 2.0)
+        v1 = (await self._versions(clients[0]))[1]
+        self.assertAlmostEqual(v1, 2.0)
+
+        await self._send(clients[0], train_id, 1, v1 + 4.0)  # свежая дельта +4
+        v2 = (await self._versions(clients[0]))[2]
+        await self._send(clients[1], train_id, 1, v1 + 4.0)  # та же дельта, но от версии 1 (устарелость 1)
+        v3 = (await self._versions(clients[0]))[3]
+
+        self.assertAlmostEqual(v2 - v1, 4.0, places=5)
+        self.assertAlmostEqual(v3 - v2, 4.0 * 2 ** -0.5, places=5)
+        self.assertLess(v3 - v2, v2 - v1)
+        await self._close(ui, clients)
+
+    async def test_update_trained_before_first_version_does_not_wedge_buffer(self):
+        ui, clients = await self._connect()
+        train_id = await self._start(ui, clients, k=2)
+
+        await self._send(clients[0], train_id, 0, 2.0)
+        await self._send(clients[1], train_id, 0, 4.0)
+        await self._send(clients[2], train_id, 0, 5.0)  # пришло после первой версии — пойдёт дельтой к ней
+        self.assertEqual(await self._versions(clients[0]), {1: 3.0})
+
+        await self._send(clients[0], train_id, 1, 5.0)
+        replies = await self._drain(clients[0])
+        self.assertNotIn("stale_update", [m.get("type") for m in replies])
+        versions = {m["round"]: float(m["_arrays"][0][0]) for m in replies if m.get("type") == "global_weights"}
+        self.assertIn(2, versions)
+        self.assertGreater(versions[2], 3.0)
+        await self._close(ui, clients)
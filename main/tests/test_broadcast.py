@@ -0,0 +1,53 @@
+from django.test import SimpleTestCase
+
+from main.broadcast import Frame, fan_out, fan_out_variants
+
+
+class FakeSocket:
+    def __init__(self, kind="text", broken=False):
+        self.kind = kind
+        self.broken = broken
+        self.sent = []
+
+    async def send(self, text_data=None, bytes_data=None):
+        if self.broken:
+            raise ConnectionError("socket closed")
+        self.sent.append(text_data if text_data is not None else bytes_data)
+
+
+class FrameTests(SimpleTestCase):
+    def test_needs_exactly_one_payload(self):
+        with self.assertRaises(ValueError):
+            Frame()
+        with self.assertRaises(ValueError):
+            Frame(text_data="a", bytes_data=b"b")
+
+    def test_is_immutable(self):
+        frame = Frame.from_message({"type": "x"})
+        with self.assertRaises(AttributeError):
+            frame.text_data = "{}"
+
+
+class FanOutTests(SimpleTestCase):
+    async def test_same_buffer_to_everyone_and_broken_sockets_skipped(self):
+        sockets = [FakeSocket(), FakeSocket(broken=True), FakeSocket()]
+        frame = Frame.from_message({"type": "round", "n": 1})
+        self.assertEqual(await fan_out(sockets, frame), 2)
+        self.assertIs(sockets[0].sent[0], sockets[2].sent[0])
+        self.assertEqual(sockets[1].sent, [])
+
+    async def test_variants_are_encoded_once_per_group(self):
+        sockets = [FakeSocket("text"), FakeSocket("bytes"), FakeSocket("text"), FakeSocket("skip")]
+        encoded = []
+
+        async def encode(kind):
+            encoded.append(kind)
+            if kind == "skip":
+                return None
+            return Frame(bytes_data=b"\x01") if kind == "bytes" else Frame(text_data="{}")
+
+        sent = await fan_out_variants(sockets, lambda s: s.kind, encode)
+        self.assertEqual(sorted(encoded), ["bytes", "skip", "text"])
+        self.assertEqual(sent, 3)
+        self.assertEqual([s.sent for s in sockets], [["{}"], [b"\x01"], ["{}"], []])
+        self.assertIs(sockets[0].sent[0], sockets[2].sent[0])
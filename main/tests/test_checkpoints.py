@@ -0,0 +1,145 @@
+import shutil
+import tempfile
+
+import numpy as np
+from django.test import SimpleTestCase, TestCase
+
+from main import checkpoints
+from main.checkpoints import CheckpointStore, retained_rounds
+from main.models import Checkpoint, Train
+
+
+def _rounds(n, seed=0):
+    """n «раундов» модели: каждый — небольшая поправка к предыдущему."""
+    rng = np.random.default_rng(seed)
+    model = [rng.standard_normal((64, 32)).astype(np.float32), rng.standard_normal(32).astype(np.float32)]
+    out = []
+    for _ in range(n):
+        model = [a + 1e-3 * rng.standard_normal(a.shape).astype(np.float32) for a in model]
+        out.append(model)
+    return out
+
+
+class CheckpointStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+
+    def test_keyframe_round_trip(self):
+        store = CheckpointStore(self.root, cache_size=0)
+        model = _rounds(1)[0]
+        h, size, base = store.put(model)
+        self.assertIsNone(base)
+        self.assertTrue(store.exists(h))
+        self.assertGreaterEqual(size, sum(a.nbytes for a in model))
+        for a, b in zip(store.load(h), model):
+            self.assertEqual(a.dtype, np.float32)
+            np.testing.assert_array_equal(a, b)
+
+    def test_delta_chain_round_trip(self):
+        store = CheckpointStore(self.root, cache_size=4)
+        models = _rounds(4)
+        hashes, base = [], None
+        for model in models:
+            h, size, used_base = store.put(model, base=base)
+            self.assertEqual(used_base, base)
+            hashes.append(h)
+            base = h
+        self.assertIsNone(store.base_of(hashes[0]))
+        self.assertEqual(store.base_of(hashes[3]), hashes[2])
+
+        # без кеша: восстановление по цепочке дельт от ключевого кадра
+        cold = CheckpointStore(self.root, cache_size=0)
+        for h, model in zip(hashes, models):
+            for a, b in zip(cold.load(h), model):
+                np.testing.assert_array_equal(a, b)
+
+    def test_delta_is_smaller_than_keyframe(self):
+        store = CheckpointStore(self.root)
+        first, second = _rounds(2)
+        h0, key_size, _ = store.put(first)
+        _, delta_size, base = store.put(second, base=h0)
+        self.assertEqual(base, h0)
+        self.assertLess(delta_size, key_size)
+
+    def test_base_of_other_shape_gives_keyframe(self):
+        store = CheckpointStore(self.root)
+        h0, _, _ = store.put([np.zeros(3, np.float32)])
+        _, _, base = store.put([np.ones(5, np.float32)], base=h0)
+        self.assertIsNone(base)
+
+    def test_same_content_is_stored_once(self):
+        store = CheckpointStore(self.root)
+        model = _rounds(1)[0]
+        self.assertEqual(store.put(model)[0], store.put([a.copy() for a in model])[0])
+
+
+class RetainedRoundsTests(SimpleTestCase):
+    rows = [(r, 0.5) for r in range(1, 11)] + [(11, None)]
+
+    def test_keep_last_zero_keeps_everything(self):
+        self.assertEqual(retained_rounds(self.rows, 0, 5, True), set(range(1, 12)))
+
+    def test_last_every_best_and_current(self):
+        rows = [(r, 0.9 if r == 3 else 0.5) for r in range(1, 11)]
+        self.assertEqual(retained_rounds(rows, 2, 5, True, current=1), {1, 3, 5, 9, 10})
+
+
+class CheckpointPruneTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        checkpoints._store = CheckpointStore(self.root, cache_size=0)
+        self.addCleanup(setattr, checkpoints, "_store", None)
+        self.store = checkpoints._store
+        self.train = Train.objects.create(model_name="dnn")
+
+    def _save(self, models, keyframe_every=1):
+        rows, base = [], None
+        for r, model in enumerate(models):
+            h, size, base_hash = self.store.put(model, base=None if r % keyframe_every == 0 else base)
+            rows.append(Checkpoint.objects.create(
+                train=self.train, round_number=r + 1, content_hash=h, base_hash=base_hash or "", size=size))
+            base = h
+        return rows
+
+    def test_prune_removes_rows_and_files(self):
+        models = _rounds(4)
+        rows = self._save(models)
+        self.train.checkpoint = rows[-1]
+        self.train.save()
+
+        dropped = Checkpoint.prune(self.train, keep_last=2, keep_every=0, keep_best=False)
+
+        kept = set(Checkpoint.objects.filter(train=self.train).values_list("round_number", flat=True))
+        self.assertEqual((kept, dropped), ({3, 4}, 2))
+        for row in rows[:2]:
+            self.assertFalse(self.store.exists(row.content_hash))
+        for a, b in zip(self.train.get_global_weights(), models[-1]):
+            np.testing.assert_array_equal(a, b)
+
+    def test_prune_keeps_delta_bases(self):
+        models = _rounds(6)
+        rows = self._save(models, keyframe_every=3)  # 1 — ключевой кадр, 2-3 дельты; 4 — ключевой, 5-6 дельты
+        self.train.checkpoint = rows[-1]
+        self.train.save()
+
+        dropped = Checkpoint.prune(self.train, keep_last=1, keep_every=0, keep_best=False)
+
+        kept = set(Checkpoint.objects.filter(train=self.train).values_list("round_number", flat=True))
+        self.assertEqual(kept, {4, 5, 6})  # раунд 6 и его цепочка до ключевого кадра
+        self.assertEqual(dropped, 3)
+        for row in rows[:3]:
+            self.assertFalse(self.store.exists(row.content_hash))
+        for a, b in zip(self.train.get_global_weights(), models[-1]):
+            np.testing.assert_array_equal(a, b)
+
+    def test_delete_unreferenced_keeps_live_base(self):
+        rows = self._save(_rounds(2), keyframe_every=2)
+        rows[0].delete()
+        Checkpoint.delete_unreferenced([rows[0].content_hash])
+        self.assertTrue(self.store.exists(rows[0].content_hash))  # база живой дельты раунда 2
+        rows[1].delete()
+        Checkpoint.delete_unreferenced([rows[1].content_hash])
+        self.assertFalse(self.store.exists(rows[1].content_hash))
+        self.assertFalse(self.store.exists(rows[0].content_hash))
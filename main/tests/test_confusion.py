@@ -0,0 +1,30 @@
+from django.test import SimpleTestCase
+
+from main.confusion import ConfusionAccumulator
+
+
+class ConfusionAccumulatorTests(SimpleTestCase):
+    def test_sums_confusion_and_support(self):
+        acc = ConfusionAccumulator()
+        acc.add({"confusion": [[1, 0], [1, 2]], "support": [1, 3], "classes": ["a", "b"]}, 1)
+        acc.add({"confusion": [[2, 0], [0, 1]], "support": [2, 1]}, 2)
+        self.assertEqual(acc.result(), {"confusion": [[3, 0], [1, 3]], "support": [3, 4], "classes": ["a", "b"]})
+
+    def test_same_result_is_added_once(self):
+        acc = ConfusionAccumulator()
+        acc.add({"confusion": [[1]]}, 7)
+        acc.add({"confusion": [[1]]}, 7)
+        self.assertEqual(acc.result()["confusion"], [[1.0]])
+
+    def test_malformed_matrix_is_skipped(self):
+        acc = ConfusionAccumulator()
+        acc.add({"confusion": [[1, 0], [0, 1]]})
+        acc.add({"confusion": [[1, 0, 0]]})
+        acc.add({"confusion": "oops"})
+        acc.add(None)
+        self.assertEqual(acc.result()["confusion"], [[1, 0], [0, 1]])
+
+    def test_no_matrices_gives_none(self):
+        acc = ConfusionAccumulator()
+        acc.add({"accuracy": 0.5})
+        self.assertIsNone(acc.result())
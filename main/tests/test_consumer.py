@@ -0,0 +1,397 @@
+import asyncio
+import json
+import pickle
+import shutil
+import struct
+import tempfile
+import zlib
+from unittest import mock
+
+import numpy as np
+
+from main.consumers import TrainModelConsumer
+from main.models import Train
+from main.tensors import dequantize, pack_container, quantize
+from main.trainstate import trains
+
+from .base import ConsumerTestCase
+
+
+class WeightFramesTests(ConsumerTestCase):
+    async def test_binary_and_legacy_clients_share_a_round(self):
+        ui = await self.connect()
+        binary = await self.connect(self.devices[0])
+        legacy = await self.connect(self.devices[1], capabilities={})
+        train_id = await self.start(ui)
+        for ws in (ui, binary, legacy):
+            await self.drain(ws)
+
+        await self.send_weights(binary, train_id, 0, [np.full((2, 2), 1.0, np.float32)])
+        await legacy.send_to(text_data=json.dumps({
+            "type": "weights", "train_id": train_id, "round": 0, "num_samples": 1,
+            "payload": pickle.dumps([np.full((2, 2), 3.0, np.float32)]).hex(),
+        }))
+
+        got_binary = self.of_type(await self.drain(binary), "global_weights")
+        got_legacy = self.of_type(await self.drain(legacy), "global_weights")
+        self.assertTrue(got_binary[0]["_binary"])
+        self.assertNotIn("_binary", got_legacy[0])
+        for msg in (got_binary[0], got_legacy[0]):
+            self.assertEqual(msg["round"], 1)
+            np.testing.assert_array_equal(msg["_arrays"][0], np.full((2, 2), 2.0))
+        await self.close()
+
+    async def test_malformed_frame_closes_socket(self):
+        ws = await self.connect(self.devices[0])
+        await self.drain(ws)
+        await ws.send_to(bytes_data=b"\x00\x00\x00\x40{")
+        self.assertEqual(self.of_type(await self.drain(ws), "_closed"), [{"type": "_closed", "code": 4003}])
+        await self.close()
+
+
+
+class Float32WeightsTests(ConsumerTestCase):
+    async def test_global_weights_stay_float32(self):
+        ui, (a, b) = await self.connect_all()
+        train_id = await self.start(ui)
+        await self.send_weights(a, train_id, 0, [np.full((2, 3), 1.0, np.float32)])
+        await self.send_weights(b, train_id, 0, [np.full((2, 3), 2.0, np.float32)])
+        got = self.of_type(await self.drain(a), "global_weights")[0]["_arrays"]
+        self.assertEqual(got[0].dtype, np.float32)
+        await self.close()
+
+        train = await Train.objects.select_related("checkpoint").aget(pk=train_id)
+        self.assertIsNone(train.global_weights)
+        stored = train.get_global_weights()
+        self.assertEqual(stored[0].dtype, np.float32)
+        np.testing.assert_array_equal(stored[0], np.full((2, 3), 1.5))
+
+    async def test_weights_as_lists_for_old_clients(self):
+        ui, (a, b) = await self.connect_all()
+        train_id = await self.start(ui)
+        await self.send_weights(a, train_id, 0, [np.full(2, 1.0, np.float32)])
+        await self.send_weights(b, train_id, 0, [np.full(2, 3.0, np.float32)])
+        await b.disconnect()
+        old = await self.connect(self.devices[1], capabilities={"weights_as_lists": True})
+        await self.start(ui)
+        msg = self.of_type(await self.drain(old), "global_weights")[0]
+        self.assertEqual(pickle.loads(bytes.fromhex(msg["payload"])), [[2.0, 2.0]])
+        await self.close()
+
+
+def _compressed_frame(header, arrays):
+    head = json.dumps(header).encode()
+    return struct.pack(">I", len(head)) + head + zlib.compress(pack_container(arrays))
+
+
+class DeltaUploadTests(ConsumerTestCase):
+    async def test_delta_against_current_version(self):
+        ui, (a, b) = await self.connect_all()
+        train_id = await self.start(ui)
+        await self.send_weights(a, train_id, 0, [np.full(3, 1.0, np.float32)])
+        await self.send_weights(b, train_id, 0, [np.full(3, 3.0, np.float32)])
+        for ws in (ui, a, b):
+            await self.drain(ws)
+
+        # сжатая дельта +1 к версии 1 (= 2) и дельта от несуществующей версии 0
+        await a.send_to(bytes_data=_compressed_frame(
+            {"type": "weights", "train_id": train_id, "round": 1, "num_samples": 1,
+             "encoding": "delta", "base_round": 1, "compression": "zlib"},
+            [np.full(3, 1.0, np.float32)]))
+        await self.send_weights(b, train_id, 1, [np.full(3, 5.0, np.float32)], encoding="delta", base_round=0)
+        self.assertEqual(len(self.of_type(await self.drain(b), "resend_full")), 1)
+
+        await self.send_weights(b, train_id, 1, [np.full(3, 4.0, np.float32)])
+        version = self.of_type(await self.drain(a), "global_weights")[0]
+        self.assertEqual(version["round"], 2)
+        np.testing.assert_allclose(version["_arrays"][0], np.full(3, 3.5))
+        await self.close()
+
+
+class QuantizedTransportTests(ConsumerTestCase):
+    async def test_int8_both_ways(self):
+        ui = await self.connect()
+        a = await self.connect(self.devices[0], capabilities={"binary_weights": True, "quantization": ["int8"]})
+        b = await self.connect(self.devices[1])
+        train_id = await self.start(ui)
+        for ws in (ui, a, b):
+            await self.drain(ws)
+
+        layer = np.linspace(-1.0, 1.0, 16, dtype=np.float32)
+        q, params = quantize([layer], "int8")
+        await self.send_weights(a, train_id, 0, q, quantization="int8", quant=params)
+        await self.send_weights(b, train_id, 0, [layer])
+
+        got_a = self.of_type(await self.drain(a), "global_weights")[0]
+        got_b = self.of_type(await self.drain(b), "global_weights")[0]
+        self.assertEqual(got_a["quantization"], "int8")
+        self.assertEqual(got_a["_arrays"][0].dtype, np.int8)
+        self.assertNotIn("quantization", got_b)
+        restored = dequantize(got_a["_arrays"], "int8", got_a["quant"])[0]
+        np.testing.assert_allclose(restored, got_b["_arrays"][0], atol=params[0]["scale"] * 2)
+        np.testing.assert_allclose(got_b["_arrays"][0], layer, atol=params[0]["scale"])
+        await self.close()
+
+
+def _chunk_frame(upload_id, offset, chunk):
+    head = json.dumps({"type": "upload_chunk", "upload_id": upload_id, "offset": offset}).encode()
+    return struct.pack(">I", len(head)) + head + chunk
+
+
+class ChunkedUploadTests(ConsumerTestCase):
+    async def test_upload_resumes_after_reconnect(self):
+        ui, (a, b) = await self.connect_all()
+        train_id = await self.start(ui)
+        for ws in (ui, a, b):
+            await self.drain(ws)
+        body = pack_container([np.full(64, 1.0, np.float32)])
+        begin = {"type": "upload_begin", "upload_id": "u1", "total_size": len(body), "crc32": zlib.crc32(body),
+                 "train_id": train_id, "round": 0, "num_samples": 1}
+
+        await a.send_to(text_data=json.dumps(begin))
+        await a.send_to(bytes_data=_chunk_frame("u1", 0, body[:100]))
+        acks = self.of_type(await self.drain(a), "upload_ack")
+        self.assertEqual([m["offset"] for m in acks], [0, 100])
+        await a.disconnect()
+
+        a = await self.connect(self.devices[0])
+        await self.drain(a)
+        await a.send_to(text_data=json.dumps(begin))
+        self.assertEqual(self.of_type(await self.drain(a), "upload_ack")[0]["offset"], 100)
+        await a.send_to(bytes_data=_chunk_frame("u1", 300, body[300:]))
+        self.assertEqual(self.of_type(await self.drain(a), "upload_error")[0]["offset"], 100)
+        await a.send_to(bytes_data=_chunk_frame("u1", 100, body[100:]))
+        await a.send_to(text_data=json.dumps({"type": "upload_commit", "upload_id": "u1"}))
+        self.assertEqual(len(self.of_type(await self.drain(a), "upload_done")), 1)
+
+        await self.send_weights(b, train_id, 0, [np.full(64, 3.0, np.float32)])
+        version = self.of_type(await self.drain(b), "global_weights")[0]
+        np.testing.assert_allclose(version["_arrays"][0], np.full(64, 2.0))
+        await self.close()
+
+    async def test_crc_mismatch_is_rejected(self):
+        ui, (a, _) = await self.connect_all()
+        train_id = await self.start(ui)
+        await self.drain(a)
+        body = pack_container([np.ones(4, np.float32)])
+        await a.send_to(text_data=json.dumps({"type": "upload_begin", "upload_id": "u2", "total_size": len(body),
+                                              "crc32": zlib.crc32(body) ^ 1, "train_id": train_id, "round": 0}))
+        await a.send_to(bytes_data=_chunk_frame("u2", 0, body))
+        await a.send_to(text_data=json.dumps({"type": "upload_commit", "upload_id": "u2"}))
+        errors = self.of_type(await self.drain(a), "upload_error")
+        self.assertEqual([e["message"] for e in errors], ["crc32 mismatch"])
+        await self.close()
+
+
+class SkipIfCurrentTests(ConsumerTestCase):
+    async def test_restart_sends_weights_only_to_clients_without_the_version(self):
+        ui, (a, b) = await self.connect_all()
+        train_id = await self.start(ui)
+        await self.send_weights(a, train_id, 0, [np.full(3, 1.0, np.float32)])
+        await self.send_weights(b, train_id, 0, [np.full(3, 3.0, np.float32)])
+        version = self.of_type(await self.drain(a), "global_weights")[0]["version"]
+        await self.drain(ui)
+
+        # b переподключился и сообщает старую версию, a держит текущую
+        await b.disconnect()
+        b = await self.connect(self.devices[1], weights_version="stale")
+        await self.start(ui)
+        got_a, got_b = await self.drain(a), await self.drain(b)
+        self.assertEqual(self.of_type(got_a, "global_weights"), [])
+        self.assertEqual(self.of_type(got_a, "weights_current")[0]["version"], version)
+        self.assertEqual(self.of_type(got_b, "global_weights")[0]["version"], version)
+        self.assertEqual(self.of_type(got_b, "weights_current"), [])
+        await self.close()
+
+
+class TopKTests(ConsumerTestCase):
+    async def _sparse(self, ws, train_id, round_no, idx, vals):
+        await self.send_weights(ws, train_id, round_no, [np.array(idx, np.int32), np.array(vals, np.float16)],
+                                encoding="topk", base_round=round_no)
+
+    async def test_server_keeps_residual_for_next_round(self):
+        ui, (a, b) = await self.connect_all()
+        train_id = await self.start(ui, topk=0.25)  # слой из 4 -> k = 1
+        await self.send_weights(a, train_id, 0, [np.zeros(4, np.float32)])
+        await self.send_weights(b, train_id, 0, [np.zeros(4, np.float32)])
+
+        await self._sparse(a, train_id, 1, [0, 1], [4.0, 2.0])  # в раунд идёт 4.0, 2.0 — в остаток
+        await self._sparse(b, train_id, 1, [3], [0.0])
+        await self._sparse(a, train_id, 2, [2], [1.0])  # остаток 2.0 больше нового 1.0
+        await self._sparse(b, train_id, 2, [3], [0.0])
+
+        versions = {m["round"]: m["_arrays"][0] for m in self.of_type(await self.drain(a), "global_weights")}
+        np.testing.assert_allclose(versions[2], [2.0, 0.0, 0.0, 0.0])
+        np.testing.assert_allclose(versions[3], [2.0, 1.0, 0.0, 0.0])
+        await self.close()
+
+
+class GatewayTests(ConsumerTestCase):
+    async def test_partial_sum_weighs_gateway_devices(self):
+        ui, (gw, dev) = await self.connect_all()
+        train_id = await self.start(ui)
+        # у шлюза два устройства по 2 примера с весами 1 и 3
+        await self.send_weights(gw, train_id, 0, [np.full(2, 2 * 1.0 + 2 * 3.0, np.float32)],
+                                partial="sum", num_samples=4, members=["a", "b"])
+        await self.send_weights(dev, train_id, 0, [np.full(2, 6.0, np.float32)], num_samples=4)
+        got = self.of_type(await self.drain(dev), "global_weights")
+        np.testing.assert_allclose(got[0]["_arrays"][0], [4.0, 4.0])
+        await self.close()
+
+    async def test_topk_partial_is_rejected(self):
+        ui, (gw, dev) = await self.connect_all()
+        train_id = await self.start(ui)
+        await self.drain(gw)
+        await self.send_weights(gw, train_id, 0, [np.ones(2, np.float32)], partial="sum", encoding="topk", num_samples=2)
+        errors = self.of_type(await self.drain(gw), "error")
+        self.assertIn("Invalid partial update", errors[0]["message"])
+        await self.close()
+
+
+class SamplingTests(ConsumerTestCase):
+    devices_count = 4
+
+    async def test_round_closes_on_target_and_idle_device_is_discarded(self):
+        ui, clients = await self.connect_all()
+        train_id = await self.start(ui, fraction=0.5, overselect=0.5)  # target 2, выбрано 3 из 4
+        inbox = [await self.drain(ws) for ws in clients]
+        starts = {ws: self.of_type(got, "start_training") for ws, got in zip(clients, inbox)}
+        chosen = [ws for ws in clients if starts[ws]]
+        idle = [ws for ws, got in zip(clients, inbox) if self.of_type(got, "round_idle")]
+        self.assertEqual((len(chosen), len(idle)), (3, 1))
+        self.assertTrue(all(starts[ws][0]["selected"] for ws in chosen))
+
+        await self.send_weights(idle[0], train_id, 0, [np.full(2, 9.0, np.float32)])
+        discarded = self.of_type(await self.drain(idle[0]), "update_discarded")
+        self.assertEqual(discarded[0]["reason"], "not_selected")
+
+        await self.send_weights(chosen[0], train_id, 0, [np.full(2, 1.0, np.float32)])
+        await self.send_weights(chosen[1], train_id, 0, [np.full(2, 3.0, np.float32)])
+        got = self.of_type(await self.drain(chosen[2]), "global_weights")
+        self.assertEqual(got[0]["round"], 1)
+        np.testing.assert_allclose(got[0]["_arrays"][0], [2.0, 2.0])
+        await self.close()
+
+
+class SpoolRecoveryTests(ConsumerTestCase):
+    async def test_round_resumes_after_restart(self):
+        spool = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool, True)
+        with self.settings(FL_ROUND_SPOOL_DIR=spool):
+            ui, (a, b) = await self.connect_all()
+            train_id = await self.start(ui)
+            await self.send_weights(a, train_id, 0, [np.full(2, 1.0, np.float32)])
+
+            # рестарт процесса: состояние раунда в памяти потеряно, сумма осталась в spool
+            TrainModelConsumer.aggregations.clear()
+            trains.items.clear()
+            await self.send_weights(b, train_id, 0, [np.full(2, 3.0, np.float32)])
+            got = self.of_type(await self.drain(b), "global_weights")
+            np.testing.assert_allclose(got[0]["_arrays"][0], [2.0, 2.0])
+            await self.close()
+
+
+class TrainStateRoutingTests(ConsumerTestCase):
+    async def test_cache_follows_rounds_and_reloads_on_miss(self):
+        ui, (a, b) = await self.connect_all()
+        train_id = await self.start(ui)
+        await self.send_weights(a, train_id, 0, [np.full(2, 1.0, np.float32)])
+        await self.send_weights(b, train_id, 0, [np.full(2, 3.0, np.float32)])
+        self.assertEqual(trains.get(train_id)["round_count"], 1)
+
+        # промах (другой процесс, сброс) — состояние читается из БД
+        trains.items.clear()
+        await self.send_weights(a, train_id, 1, [np.full(2, 1.0, np.float32)])
+        self.assertEqual(trains.get(train_id)["round_count"], 1)
+        await self.send_weights(b, train_id, 1, [np.full(2, 3.0, np.float32)])
+        self.assertEqual(trains.get(train_id)["round_count"], 2)
+        self.assertEqual((await Train.objects.aget(pk=train_id)).round_count, 2)
+        await self.close()
+
+
+class ConfusionTests(ConsumerTestCase):
+    async def test_ui_gets_running_matrix_and_round_total(self):
+        ui, (a, b) = await self.connect_all()
+        train_id = await self.start(ui)
+        await self.drain(ui)
+        await self.send_weights(a, train_id, 0, [np.ones(2, np.float32)],
+                                metrics={"accuracy": 0.5, "confusion": [[1, 0], [1, 2]], "classes": [0, 1]})
+        matrices = self.of_type(await self.drain(ui), "confusion_matrix")
+        self.assertEqual(matrices[-1]["matrix"], [[1, 0], [1, 2]])
+
+        await self.send_weights(b, train_id, 0, [np.ones(2, np.float32)],
+                                metrics={"accuracy": 1.0, "confusion": [[2, 0], [0, 1]], "classes": [0, 1]})
+        got = await self.drain(ui)
+        self.assertEqual(self.of_type(got, "confusion_matrix")[-1]["matrix"], [[3, 0], [1, 3]])
+        self.assertEqual(self.of_type(await self.drain(a), "global_weights")[0]["confusion"], [[3, 0], [1, 3]])
+        await self.close()
+
+
+class RoundClockTests(ConsumerTestCase):
+    async def test_next_round_clock_starts_before_announce(self):
+        ui, (a, b) = await self.connect_all()
+        train_id = await self.start(ui)
+        st = TrainModelConsumer.aggregations[train_id]
+        first_start = st["round_started"]
+        seen = []
+        announce = TrainModelConsumer.announce_round
+
+        async def spy(consumer, message):
+            # что видит клиент, ответивший сразу на start_training следующего раунда
+            seen.append((message["round"], st["round_started"], st["round_deadline"], st["timeout_task"]))
+            await announce(consumer, message)
+
+        with mock.patch.object(TrainModelConsumer, "announce_round", spy):
+            await self.send_weights(a, train_id, 0, [np.ones(2, np.float32)])
+            await self.send_weights(b, train_id, 0, [np.ones(2, np.float32)])
+        (round_no, started, deadline, timer), = seen
+        self.assertEqual(round_no, 1)
+        self.assertGreater(started, first_start)
+        self.assertGreater(deadline, started)
+        self.assertFalse(timer.done())
+        self.assertEqual(st["round_started"], started)  # после рассылки часы не переставляются
+        await self.close()
+
+
+class RoundCloseTests(ConsumerTestCase):
+    devices_count = 3
+
+    async def test_weighted_average_and_late_upload(self):
+        ui, (a, b, c) = await self.connect_all()
+        train_id = await self.start(ui)
+        await self.send_weights(a, train_id, 0, [np.full(2, 1.0, np.float32)], num_samples=1)
+        await self.send_weights(a, train_id, 0, [np.full(2, 9.0, np.float32)], num_samples=1)  # дубль не считается
+        await self.send_weights(b, train_id, 0, [np.full(2, 2.0, np.float32)], num_samples=2)
+        await self.send_weights(c, train_id, 0, [np.full(2, 4.0, np.float32)], num_samples=1)
+        version = self.of_type(await self.drain(a), "global_weights")[0]
+        np.testing.assert_allclose(version["_arrays"][0], np.full(2, 9.0 / 4))
+
+        await self.send_weights(c, train_id, 0, [np.full(2, 4.0, np.float32)])
+        discarded = self.of_type(await self.drain(c), "update_discarded")
+        self.assertEqual(discarded[0]["reason"], "round_closed")
+        await self.close()
+
+    async def test_round_is_aggregated_once(self):
+        ui, (a, b, c) = await self.connect_all()
+        train_id = await self.start(ui)
+        await self.send_weights(a, train_id, 0, [np.full(2, 1.0, np.float32)])
+        await self.send_weights(b, train_id, 0, [np.full(2, 3.0, np.float32)])
+        st = TrainModelConsumer.aggregations[train_id]
+        owner = next(x for x in TrainModelConsumer.connected_clients
+                     if getattr(x, "device", None) and x.device.id == self.devices[1].id)
+
+        # дедлайн прошёл: раунд 0 закрывают и таймаут, и загрузка, решившая «пора» ещё до него
+        st["round_deadline"] = asyncio.get_running_loop().time() - 1
+        await asyncio.gather(owner._timeout_trigger_shared(train_id, 0), owner._timeout_trigger_shared(train_id, 0))
+        await owner.aggregate_and_broadcast_all(0, {"time_expired": True})
+        await asyncio.sleep(0.3)
+        rounds = [m["round"] for m in self.of_type(await self.drain(c), "global_weights")]
+        self.assertEqual(rounds, [1])
+        self.assertEqual(st["round_acc"].round_no, 1)
+
+        # следующий раунд принимается и закрывается как обычно
+        for ws in (a, b, c):
+            await self.send_weights(ws, train_id, 1, [np.full(2, 5.0, np.float32)])
+        rounds = [m["round"] for m in self.of_type(await self.drain(c), "global_weights")]
+        self.assertEqual(rounds, [2])
+        await self.close()
@@ -0,0 +1,23 @@
+from django.test import SimpleTestCase
+
+from main.latency import LatencyTracker
+
+
+class LatencyTrackerTests(SimpleTestCase):
+    def test_min_samples_counts_real_observations(self):
+        tracker = LatencyTracker(decay=0.95, min_samples=3)
+        tracker.observe("m", 1, 2.0, round_no=0)
+        tracker.observe("m", 1, 2.0, round_no=1)
+        self.assertEqual(tracker.expected("m", 1, 0.9), (None, None))
+        tracker.observe("m", 1, 2.0, round_no=2)
+        value, source = tracker.expected("m", 1, 0.9)
+        self.assertEqual(source, "device")
+        self.assertGreaterEqual(value, 2.0)
+
+    def test_one_sample_per_device_and_round(self):
+        tracker = LatencyTracker(min_samples=2)
+        self.assertTrue(tracker.observe("m", 1, 1.0, round_no=5))
+        self.assertFalse(tracker.observe("m", 1, 9.0, round_no=5))
+        self.assertTrue(tracker.observe("m", 2, 1.0, round_no=5))
+        self.assertEqual(tracker.devices[("m", 1)].samples, 1)
+        self.assertEqual(tracker.models["m"].samples, 2)
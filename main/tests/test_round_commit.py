@@ -0,0 +1,42 @@
+import datetime
+
+from django.test import TestCase
+from django.utils.timezone import now
+
+from main.consumers import _reconcile_round, _trains
+from main.models import Checkpoint, Train
+
+
+class RoundCommitRecoveryTests(TestCase):
+    def setUp(self):
+        self.train = Train.objects.create(model_name="dnn", round_count=3)
+        self.ckpt = Checkpoint.objects.create(train=self.train, round_number=3, content_hash="a" * 32)
+        Train.objects.filter(pk=self.train.pk).update(checkpoint=self.ckpt)
+
+    def _commit(self, round_count, ago, **fields):
+        # раунд зафиксирован ``ago`` секунд назад
+        Train.objects.filter(pk=self.train.pk).update(
+            round_count=round_count, updated_at=now() - datetime.timedelta(seconds=ago), **fields)
+
+    def test_consistent_pointer_is_left_alone(self):
+        obj = _reconcile_round(_trains().get(pk=self.train.pk))
+        self.assertEqual(obj.round_count, 3)
+
+    def test_round_without_checkpoint_is_rolled_back(self):
+        # раунд 4 зафиксирован давно, но процесс упал до записи его чекпоинта
+        self._commit(4, ago=3600)
+        obj = _reconcile_round(_trains().get(pk=self.train.pk))
+        self.assertEqual(obj.round_count, 3)
+        self.assertEqual(Train.objects.get(pk=self.train.pk).round_count, 3)
+
+    def test_fresh_commit_is_not_rolled_back(self):
+        # чекпоинт раунда 4 может ещё писать другой процесс
+        self._commit(4, ago=1)
+        obj = _reconcile_round(_trains().get(pk=self.train.pk))
+        self.assertEqual(obj.round_count, 4)
+        self.assertEqual(Train.objects.get(pk=self.train.pk).round_count, 4)
+
+    def test_legacy_weights_without_checkpoint_are_trusted(self):
+        self._commit(7, ago=3600, checkpoint=None, global_weights=[[1.0]])
+        obj = _reconcile_round(_trains().get(pk=self.train.pk))
+        self.assertEqual(obj.round_count, 7)
@@ -0,0 +1,54 @@
+import io
+import json
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+
+from main.models import Device, LocalData, RoundResult, RoundSummary, Train
+
+
+class RoundSummaryTests(TestCase):
+    def setUp(self):
+        user = User.objects.create(username="fl")
+        self.train = Train.objects.create(model_name="dnn")
+        self.devices = [Device.objects.create(name=f"d{i}", user=user) for i in range(2)]
+
+    def result(self, device, round_number, **metrics):
+        RoundResult.objects.create(train=self.train, device=device, round_number=round_number,
+                                   local_data=LocalData.objects.create(device=device), result=metrics)
+
+    def test_compute_stats_and_confusion(self):
+        self.result(self.devices[0], 0, accuracy=0.5, loss=2.0, confusion=[[1, 0], [1, 2]], support=[1, 3], classes=[0, 1])
+        self.result(self.devices[1], 0, val_accuracy=0.75, val_loss=1.0, confusion=[[2, 0], [0, 1]], support=[2, 1], classes=[0, 1])
+
+        summary = RoundSummary.build(self.train.id, 0)
+        self.assertEqual(summary.participants, 2)
+        self.assertEqual((summary.acc_mean, summary.acc_min, summary.acc_max), (0.625, 0.5, 0.75))
+        self.assertEqual((summary.loss_mean, summary.loss_min, summary.loss_max), (1.5, 1.0, 2.0))
+        self.assertEqual(RoundSummary.objects.get().get_confusion(),
+                         {"confusion": [[3, 0], [1, 3]], "support": [3, 4], "classes": [0, 1]})
+
+    def test_old_string_results_and_missing_metrics(self):
+        self.result(self.devices[0], 1)
+        RoundResult.objects.filter(round_number=1).update(result=json.dumps({"acc": 0.25}))
+        self.result(self.devices[1], 1, note="no metrics")
+        summary = RoundSummary.compute(self.train.id, 1)
+        self.assertEqual((summary.participants, summary.acc_mean, summary.loss_mean), (2, 0.25, None))
+        self.assertIsNone(summary.get_confusion())
+
+    def test_build_is_an_upsert(self):
+        self.result(self.devices[0], 0, accuracy=0.5)
+        RoundSummary.build(self.train.id, 0)
+        self.result(self.devices[1], 0, accuracy=1.0)
+        RoundSummary.build(self.train.id, 0)
+        self.assertEqual(list(RoundSummary.objects.values_list("participants", "acc_mean")), [(2, 0.75)])
+
+    def test_backfill_builds_only_missing(self):
+        for rn in range(3):
+            self.result(self.devices[0], rn, accuracy=0.1 * (rn + 1))
+        RoundSummary.build(self.train.id, 0)
+        out = io.StringIO()
+        call_command("backfill_round_summaries", stdout=out)
+        self.assertIn("built 2, skipped 1", out.getvalue())
+        self.assertEqual(list(RoundSummary.objects.filter(train=self.train).values_list("round_number", flat=True)), [0, 1, 2])
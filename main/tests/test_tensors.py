@@ -0,0 +1,183 @@
+import os
+import pickle
+import zlib
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from main.tensors import (
+    FrameError, apply_delta, decode_body, decode_frame, decode_legacy_payload, decode_sparse, dequantize, encode_frame,
+    inflate_body, merge_sparse, pack_container, quantization_error, quantize, safe_unpickle_weights, split_frame,
+    topk_split, unpack_container, weights_version,
+)
+
+
+def _model():
+    rng = np.random.default_rng(0)
+    return [rng.standard_normal((3, 4)).astype(np.float32), rng.standard_normal(5).astype(np.float32)]
+
+
+class FrameTests(SimpleTestCase):
+    def test_frame_round_trip(self):
+        header, arrays = decode_frame(encode_frame({"type": "weights", "round": 2}, _model()))
+        self.assertEqual(header["round"], 2)
+        for a, b in zip(arrays, _model()):
+            np.testing.assert_array_equal(a, b)
+
+    def test_layers_are_aligned_views(self):
+        _, arrays = decode_frame(encode_frame({"type": "weights"}, _model()))
+        self.assertFalse(arrays[0].flags.owndata)
+        self.assertEqual(arrays[0].ctypes.data % 4, 0)
+
+    def test_container_round_trip_keeps_dtype_and_shape(self):
+        arrays = [np.arange(6, dtype=np.int8).reshape(2, 3), np.ones(3, np.float16)]
+        out = unpack_container(pack_container(arrays))
+        self.assertEqual([(a.dtype, a.shape) for a in out], [(np.int8, (2, 3)), (np.float16, (3,))])
+
+    def test_malformed_frames(self):
+        with self.assertRaises(FrameError):
+            split_frame(b"\x00\x00")
+        with self.assertRaises(FrameError):
+            split_frame(b"\x00\x00\x00\x10{}")
+        with self.assertRaises(FrameError):
+            split_frame(b"\x00\x00\x00\x02[]")
+        with self.assertRaises(ValueError):
+            unpack_container(pack_container(_model())[:-4])
+
+
+class DeltaTests(SimpleTestCase):
+    def test_delta_restores_full_weights(self):
+        base = _model()
+        delta = [np.full_like(a, 0.5) for a in base]
+        for w, b in zip(apply_delta(base, delta), base):
+            np.testing.assert_allclose(w, b + 0.5)
+
+    def test_delta_shape_mismatch(self):
+        with self.assertRaises(ValueError):
+            apply_delta(_model(), [np.zeros((4, 3)), np.zeros(5)])
+        with self.assertRaises(ValueError):
+            apply_delta(_model(), [np.zeros((3, 4))])
+
+    def test_compressed_body(self):
+        model = _model()
+        body = zlib.compress(pack_container(model))
+        np.testing.assert_array_equal(decode_body({"compression": "zlib"}, body)[1], model[1])
+        with self.assertRaises(FrameError):
+            decode_body({"compression": "lz4"}, body)
+        with self.assertRaises(FrameError):
+            decode_body({"compression": "zlib"}, b"not zlib")
+
+    def test_compressed_body_size_is_bounded(self):
+        bomb = zlib.compress(bytes(1 << 20))  # ~1 КБ -> 1 МБ
+        self.assertEqual(len(inflate_body({"compression": "zlib"}, bomb, 1 << 20)), 1 << 20)
+        with self.assertRaises(FrameError):
+            inflate_body({"compression": "zlib"}, bomb, 64 * 1024)
+        with self.assertRaises(FrameError):
+            inflate_body({"compression": "zlib"}, bomb[:-8])
+
+
+class QuantizationTests(SimpleTestCase):
+    def test_float16_round_trip(self):
+        model = _model()
+        q, params = quantize(model, "float16")
+        self.assertIsNone(params)
+        for a, r in zip(model, dequantize(q, "float16")):
+            np.testing.assert_allclose(a, r, atol=1e-3)
+
+    def test_int8_error_within_one_step(self):
+        model = _model()
+        q, params = quantize(model, "int8")
+        self.assertTrue(all(a.dtype == np.int8 for a in q))
+        for a, r, p in zip(model, dequantize(q, "int8", params), params):
+            self.assertLessEqual(float(np.abs(a - r).max()), p["scale"])
+
+    def test_int8_keeps_zeros_exact(self):
+        layer = np.array([0.0, 0.3, -1.2, 0.0], np.float32)
+        q, params = quantize([layer], "int8")
+        restored = dequantize(q, "int8", params)[0]
+        self.assertEqual(restored[0], 0.0)
+        self.assertEqual(restored[3], 0.0)
+
+    def test_int8_requires_params(self):
+        q, _ = quantize(_model(), "int8")
+        with self.assertRaises(ValueError):
+            dequantize(q, "int8")
+        with self.assertRaises(ValueError):
+            quantize(_model(), "int4")
+
+    def test_error_report(self):
+        err = quantization_error(_model(), "int8")
+        self.assertLess(err["rel_l2"], 0.02)
+        self.assertGreater(err["max_abs"], 0.0)
+
+
+class LegacyPickleTests(SimpleTestCase):
+    def test_all_pickle_protocols_are_accepted(self):
+        model = _model()
+        for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+            with self.subTest(protocol=protocol):
+                out = decode_legacy_payload(pickle.dumps(model, protocol=protocol).hex())
+                for a, b in zip(out, model):
+                    np.testing.assert_array_equal(a, b)
+
+    def test_protocol_5_uses_frombuffer(self):
+        raw = pickle.dumps([np.ones(3, np.float32)], protocol=5)
+        self.assertIn(b"_frombuffer", raw)
+        np.testing.assert_array_equal(safe_unpickle_weights(raw)[0], np.ones(3))
+
+    def test_arbitrary_globals_are_rejected(self):
+        class Evil:
+            def __reduce__(self):
+                return os.system, ("true",)
+
+        with self.assertRaises(pickle.UnpicklingError):
+            safe_unpickle_weights(pickle.dumps([Evil()]))
+
+    def test_non_numeric_arrays_are_rejected(self):
+        with self.assertRaises(FrameError):
+            safe_unpickle_weights(pickle.dumps([np.array(["a", "b"])]))
+        with self.assertRaises(FrameError):
+            safe_unpickle_weights(pickle.dumps({"w": np.ones(2)}))
+
+    def test_container_payload(self):
+        model = _model()
+        np.testing.assert_array_equal(decode_legacy_payload(pack_container(model).hex())[0], model[0])
+
+
+class VersionTests(SimpleTestCase):
+    def test_version_depends_on_content_dtype_and_shape(self):
+        model = _model()
+        version = weights_version(model)
+        self.assertEqual(version, weights_version([a.copy() for a in model]))
+        self.assertNotEqual(version, weights_version([model[0] + 1, model[1]]))
+        self.assertNotEqual(version, weights_version([model[0].astype(np.float64), model[1]]))
+        self.assertNotEqual(version, weights_version([model[0].reshape(4, 3), model[1]]))
+
+
+class SparseTests(SimpleTestCase):
+    def test_decode_sparse_checks_bounds(self):
+        shapes = [(2, 3)]
+        out = decode_sparse([np.array([0, 5], np.int32), np.array([1.0, 2.0])], shapes)
+        self.assertEqual(out[0][0].dtype, np.int64)
+        self.assertEqual(out[0][1].dtype, np.float32)
+        with self.assertRaises(ValueError):
+            decode_sparse([np.array([6]), np.array([1.0])], shapes)
+        with self.assertRaises(ValueError):
+            decode_sparse([np.array([0.0]), np.array([1.0])], shapes)
+        with self.assertRaises(ValueError):
+            decode_sparse([np.array([0])], shapes)
+
+    def test_topk_split_and_merge_are_lossless(self):
+        idx = np.arange(6, dtype=np.int64)
+        vals = np.array([0.1, -3.0, 0.2, 2.0, -0.3, 1.0], np.float32)
+        (top_idx, top_vals), rest = topk_split(idx, vals, 2)
+        self.assertEqual(set(top_idx.tolist()), {1, 3})
+        merged_idx, merged_vals = merge_sparse((top_idx, top_vals), rest)
+        dense = np.zeros(6, np.float32)
+        dense[merged_idx] = merged_vals
+        np.testing.assert_allclose(dense, vals)
+
+    def test_merge_sums_shared_indices(self):
+        idx, vals = merge_sparse((np.array([1, 2]), np.array([1.0, 1.0])), (np.array([2]), np.array([0.5])))
+        self.assertEqual(idx.tolist(), [1, 2])
+        np.testing.assert_allclose(vals, [1.0, 1.5])
@@ -0,0 +1,25 @@
+from django.test import SimpleTestCase
+
+from main.trainstate import TrainStateCache
+
+
+class TrainStateCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = TrainStateCache()
+        self.cache.put({"id": 5, "round_count": 0, "model_name": "dnn"})
+
+    def test_get_accepts_string_ids(self):
+        self.assertEqual(self.cache.get("5")["round_count"], 0)
+        self.assertIsNone(self.cache.get("x"))
+        self.assertIsNone(self.cache.get(None))
+
+    def test_update_publishes_a_new_snapshot(self):
+        before = self.cache.get(5)
+        after = self.cache.update(5, round_count=1)
+        self.assertEqual((before["round_count"], after["round_count"]), (0, 1))
+        self.assertIs(self.cache.get(5), after)
+        self.assertIsNone(self.cache.update(6, round_count=1))
+
+    def test_invalidate(self):
+        self.cache.invalidate("5")
+        self.assertIsNone(self.cache.get(5))
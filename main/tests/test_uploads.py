@@ -0,0 +1,56 @@
+import zlib
+
+from django.test import SimpleTestCase
+
+from main.uploads import ChunkedUpload, UploadError, UploadRegistry
+
+
+class ChunkedUploadTests(SimpleTestCase):
+    def test_chunks_in_order_and_repeats_acknowledged(self):
+        upload = ChunkedUpload("u", 1, {}, 6)
+        self.assertEqual(upload.write(0, b"abc"), 3)
+        self.assertEqual(upload.write(0, b"abc"), 3)  # повтор после потерянного ack
+        with self.assertRaises(UploadError):
+            upload.write(4, b"ef")
+        with self.assertRaises(UploadError):
+            upload.write(3, b"defg")
+        with self.assertRaises(UploadError):
+            upload.body()
+        upload.write(3, b"def")
+        self.assertEqual(bytes(upload.body()), b"abcdef")
+
+    def test_crc32_is_checked(self):
+        good = ChunkedUpload("u", 1, {}, 3, crc32=zlib.crc32(b"abc"))
+        good.write(0, b"abc")
+        self.assertEqual(bytes(good.body()), b"abc")
+        bad = ChunkedUpload("u", 1, {}, 3, crc32=zlib.crc32(b"abd"))
+        bad.write(0, b"abc")
+        with self.assertRaises(UploadError):
+            bad.body()
+
+
+class UploadRegistryTests(SimpleTestCase):
+    def test_begin_again_resumes(self):
+        registry = UploadRegistry(max_bytes=100, ttl=60)
+        first = registry.begin(1, "u", {}, 10)
+        first.write(0, b"12345")
+        self.assertIs(registry.begin(1, "u", {}, 10), first)
+        self.assertEqual(registry.begin(1, "u", {}, 12).received, 0)  # другой размер — новая загрузка
+
+    def test_memory_budget(self):
+        registry = UploadRegistry(max_bytes=10, ttl=60)
+        registry.begin(1, "a", {}, 8)
+        with self.assertRaises(UploadError):
+            registry.begin(2, "b", {}, 4)
+        registry.pop(1, "a")
+        registry.begin(2, "b", {}, 4)
+        with self.assertRaises(UploadError):
+            registry.begin(3, "c", {}, 0)
+
+    def test_stale_uploads_expire(self):
+        registry = UploadRegistry(max_bytes=10, ttl=0)
+        registry.begin(1, "a", {}, 8)
+        registry.begin(2, "b", {}, 8)
+        self.assertEqual(list(registry.items), [(2, "b")])
+        with self.assertRaises(UploadError):
+            registry.get(1, "a")
@@ -0,0 +1,74 @@
+import json
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from main.models import AggregetedData, Device, LocalData, RoundResult, RoundSummary, Train
+
+
+class LegacyWeightsTests(TestCase):
+    """HTTP-путь /save_local_weights/: бегущая сумма по LocalData дня, замена вклада устройства."""
+
+    def setUp(self):
+        user = User.objects.create(username="fl")
+        self.devices = [Device.objects.create(name=f"d{i}", user=user) for i in range(3)]
+
+    def post(self, device, weight):
+        r = self.client.post("/save_local_weights/", content_type="application/json",
+                             data=json.dumps({"device_token": device.device_token, "weight": weight}))
+        self.assertEqual(r.status_code, 200, r.content)
+        return r.json()
+
+    def test_running_mean_and_overwrite(self):
+        self.post(self.devices[0], [[1, 1], [2]])
+        self.assertEqual(self.post(self.devices[1], [[3, 3], [4]])["global_data"], [[2, 2], [3]])
+        # d0 перезаписывает свою LocalData: старый вклад вычитается, а не добавляется второй раз
+        self.assertEqual(self.post(self.devices[0], [[5, 5], [6]])["global_data"], [[4, 4], [5]])
+
+        agg = AggregetedData.objects.get()
+        self.assertEqual((agg.running_count, len(agg.folded)), (2, 2))
+        self.assertEqual(self.client.get("/get_global_weights/").json()["weights"], [[4, 4], [5]])
+
+    def test_row_without_running_sum_is_rebuilt_once(self):
+        self.post(self.devices[0], [[5, 5], [6]])
+        self.post(self.devices[1], [[3, 3], [4]])
+        # строка «до миграции»: суммы нет — пересчёт по всем LocalData, дальше снова инкрементально
+        AggregetedData.objects.update(running_sum=None)
+        self.assertEqual(self.post(self.devices[2], [[1, 1], [2]])["global_data"], [[3, 3], [4]])
+        self.assertEqual(AggregetedData.objects.get().running_count, 3)
+
+    def test_upload_log_has_no_token_or_weights(self):
+        with self.assertLogs("main.views", "INFO") as logs:
+            self.post(self.devices[0], [[1.25, 1.25], [2.5]])
+        text = "\n".join(logs.output)
+        self.assertIn(f"device: {self.devices[0].id}, layers: 2", text)
+        self.assertNotIn(self.devices[0].device_token, text)
+        self.assertNotIn("1.25", text)
+
+    def test_layer_shape_mismatch_is_rejected(self):
+        self.post(self.devices[0], [[1, 1], [2]])
+        r = self.client.post("/save_local_weights/", content_type="application/json",
+                             data=json.dumps({"device_token": self.devices[1].device_token, "weight": [[1, 1, 1], [2]]}))
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(AggregetedData.objects.get().get_data(), [[1, 1], [2]])
+
+
+class TrainRoundsTests(TestCase):
+    def setUp(self):
+        user = User.objects.create(username="fl")
+        self.client.force_login(user)
+        self.device = Device.objects.create(name="d0", user=user)
+        self.train = Train.objects.create(model_name="dnn")
+
+    def result(self, round_number, accuracy):
+        RoundResult.objects.create(train=self.train, device=self.device, round_number=round_number,
+                                   local_data=LocalData.objects.create(device=self.device), result={"accuracy": accuracy})
+
+    def test_rounds_without_summary_are_computed(self):
+        # раунд 0 — до backfill, раунд 1 — сводка есть, раунд 2 — ещё идёт
+        for rn, accuracy in enumerate([0.25, 0.5, 0.75]):
+            self.result(rn, accuracy)
+        RoundSummary.build(self.train.id, 1)
+        r = self.client.get("/training/rounds/", {"train_id": self.train.id}).json()
+        self.assertEqual((r["rounds"], r["accuracies"]), ([0, 1, 2], [0.25, 0.5, 0.75]))
+        self.assertEqual(RoundSummary.objects.count(), 1)  # чтение сводок не сохраняет
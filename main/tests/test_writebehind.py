@@ -0,0 +1,88 @@
+import asyncio
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase
+from django.utils.timezone import now
+
+from main.models import Device, PredictResult
+from main.writebehind import PresenceBuffer, WriteBehindBuffer
+
+
+class WriteBehindBufferTests(TransactionTestCase):
+    def setUp(self):
+        self.device = Device.objects.create(name="d0", user=User.objects.create(username="fl"))
+
+    def row(self, i):
+        return PredictResult(device=self.device, results={"i": i})
+
+    async def test_full_batch_is_written_at_once(self):
+        buf = WriteBehindBuffer(PredictResult, max_rows=3, max_delay=60)
+        for i in range(3):
+            buf.add(self.row(i))
+        await asyncio.sleep(0.1)
+        self.assertEqual(await PredictResult.objects.acount(), 3)
+        self.assertEqual((buf.flushes, buf.flushed, buf.depth), (1, 3, 0))
+
+    async def test_partial_batch_is_written_after_delay(self):
+        buf = WriteBehindBuffer(PredictResult, max_rows=100, max_delay=0.05)
+        buf.add(self.row(0))
+        buf.add(self.row(1))
+        self.assertEqual(await PredictResult.objects.acount(), 0)
+        await asyncio.sleep(0.2)
+        self.assertEqual(await PredictResult.objects.acount(), 2)
+        self.assertEqual(buf.flushes, 1)
+
+    async def test_failed_batch_is_requeued_up_to_max_queue(self):
+        buf = WriteBehindBuffer(PredictResult, max_rows=10, max_delay=60, max_queue=2)
+        for i in range(3):
+            buf.pending.append(self.row(i))
+        with mock.patch.object(buf, "_write", side_effect=RuntimeError("db is down")):
+            await buf.flush()
+        self.assertEqual((buf.failures, buf.dropped, len(buf.pending)), (1, 1, 2))
+        await buf.flush()
+        self.assertEqual(await PredictResult.objects.acount(), 2)
+        buf._timer.cancel()
+
+    def test_drain_sync_writes_the_rest(self):
+        buf = WriteBehindBuffer(PredictResult)
+        buf.pending.extend(self.row(i) for i in range(4))
+        buf.drain_sync()
+        self.assertEqual((PredictResult.objects.count(), buf.depth, buf.stats()["flushed"]), (4, 0, 4))
+
+
+class PresenceBufferTests(TransactionTestCase):
+    def setUp(self):
+        user = User.objects.create(username="fl")
+        self.devices = [Device.objects.create(name=f"d{i}", user=user, is_online=False) for i in range(2)]
+
+    async def test_touches_are_coalesced_into_one_bulk_update(self):
+        buf = PresenceBuffer(interval=0.05)
+        for _ in range(5):
+            for device in self.devices:
+                buf.touch(device)
+        self.assertTrue(self.devices[0].is_online)  # объект — сразу, БД — на сбросе
+        self.assertEqual(await Device.objects.filter(is_online=True).acount(), 0)
+        await asyncio.sleep(0.2)
+        self.assertEqual(await Device.objects.filter(is_online=True).acount(), 2)
+        self.assertEqual((buf.flushes, buf.written), (1, 2))
+        stored = await Device.objects.aget(pk=self.devices[1].pk)
+        self.assertEqual(stored.last_seen, self.devices[1].last_seen)
+
+    async def test_failed_flush_keeps_marks(self):
+        buf = PresenceBuffer(interval=60)
+        buf.touch(self.devices[0])
+        buf._timer.cancel()
+        with mock.patch.object(PresenceBuffer, "_write", side_effect=RuntimeError("db is down")):
+            await buf.flush()
+        self.assertEqual(list(buf.seen), [self.devices[0].id])
+        buf._timer.cancel()
+        await buf.flush()
+        self.assertTrue((await Device.objects.aget(pk=self.devices[0].pk)).is_online)
+
+    def test_drain_sync(self):
+        buf = PresenceBuffer()
+        buf.seen[self.devices[0].id] = now()
+        buf.drain_sync()
+        self.assertTrue(Device.objects.get(pk=self.devices[0].pk).is_online)
+        self.assertEqual(buf.stats()["pending_devices"], 0)
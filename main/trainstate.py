@@ -0,0 +1,45 @@
+# trainstate.py
+"""
+Кеш состояния Train в памяти процесса: id, round_count, max_rounds, model_name, версия глобальной
+модели и прочие поля _train_state. Сообщение weights маршрутизируется по нему без запроса к БД.
+
+Писатель — сам процесс: консьюмер кладёт состояние при старте/агрегации/завершении,
+delete_train сбрасывает запись. Значения — готовые dict, которые не меняются на месте:
+обновление всегда кладёт новый dict, поэтому у читателей согласованный снимок.
+Кеш локален для процесса: при нескольких воркерах Train меняет тот, кто ведёт обучение.
+"""
+import threading
+
+
+class TrainStateCache:
+    def __init__(self):
+        self.items = {}  # train_id -> dict состояния
+        self._lock = threading.Lock()
+
+    def get(self, train_id):
+        try:
+            return self.items.get(int(train_id))
+        except (TypeError, ValueError):
+            return None
+
+    def put(self, state):
+        if state is not None:
+            with self._lock:
+                self.items[state["id"]] = state
+        return state
+
+    def update(self, train_id, **fields):
+        """Новый снимок с изменёнными полями; без записи — None (прочитается из БД при промахе)."""
+        with self._lock:
+            state = self.items.get(train_id)
+            if state is None:
+                return None
+            state = self.items[train_id] = {**state, **fields}
+        return state
+
+    def invalidate(self, train_id):
+        with self._lock:
+            self.items.pop(int(train_id), None)
+
+
+trains = TrainStateCache()
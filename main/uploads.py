@@ -0,0 +1,100 @@
+# uploads.py
+"""
+Чанковая загрузка весов: upload_begin -> upload_chunk (offset) x N -> upload_commit.
+
+Буфер выделяется один раз под заявленный размер, чанки пишутся в него по смещению,
+после commit тензоры читаются из него же (np.frombuffer), без промежуточных копий.
+Незавершённая загрузка живёт ``ttl`` секунд и продолжается с последнего подтверждённого offset.
+"""
+import time
+import zlib
+
+
+class UploadError(ValueError):
+    pass
+
+
+class ChunkedUpload:
+    __slots__ = ("upload_id", "device_id", "header", "buffer", "received", "crc32", "touched")
+
+    def __init__(self, upload_id, device_id, header: dict, total_size: int, crc32=None):
+        self.upload_id = upload_id
+        self.device_id = device_id
+        self.header = header
+        self.buffer = bytearray(total_size)
+        self.received = 0
+        self.crc32 = crc32
+        self.touched = time.monotonic()
+
+    @property
+    def total_size(self):
+        return len(self.buffer)
+
+    @property
+    def complete(self):
+        return self.received == len(self.buffer)
+
+    def write(self, offset: int, chunk) -> int:
+        """Принимаем только продолжение с ``received``; повтор уже принятого — молча подтверждаем."""
+        self.touched = time.monotonic()
+        n = len(chunk)
+        if offset + n <= self.received:
+            return self.received
+        if offset != self.received:
+            raise UploadError(f"expected offset {self.received}, got {offset}")
+        if offset + n > len(self.buffer):
+            raise UploadError("chunk exceeds declared size")
+        self.buffer[offset:offset + n] = chunk
+        self.received += n
+        return self.received
+
+    def body(self):
+        if not self.complete:
+            raise UploadError(f"upload incomplete: {self.received}/{len(self.buffer)}")
+        view = memoryview(self.buffer)
+        if self.crc32 is not None and (zlib.crc32(view) & 0xFFFFFFFF) != int(self.crc32):
+            raise UploadError("crc32 mismatch")
+        return view
+
+
+class UploadRegistry:
+    """Незавершённые загрузки процесса по (device_id, upload_id) с ограничением суммарной памяти."""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.items = {}
+
+    def reserved(self):
+        return sum(u.total_size for u in self.items.values())
+
+    def expire(self):
+        deadline = time.monotonic() - self.ttl
+        for key, u in list(self.items.items()):
+            if u.touched < deadline:
+                self.items.pop(key, None)
+
+    def begin(self, device_id, upload_id, header, total_size, crc32=None) -> ChunkedUpload:
+        self.expire()
+        key = (device_id, upload_id)
+        current = self.items.get(key)
+        if current is not None and current.total_size == total_size:
+            current.touched = time.monotonic()
+            return current  # resume
+        self.items.pop(key, None)
+        if total_size <= 0:
+            raise UploadError("total_size must be positive")
+        if self.reserved() + total_size > self.max_bytes:
+            raise UploadError("upload memory budget exceeded, retry later")
+        upload = ChunkedUpload(upload_id, device_id, header, total_size, crc32)
+        self.items[key] = upload
+        return upload
+
+    def get(self, device_id, upload_id) -> ChunkedUpload:
+        upload = self.items.get((device_id, upload_id))
+        if upload is None:
+            raise UploadError("unknown upload_id")
+        return upload
+
+    def pop(self, device_id, upload_id):
+        return self.items.pop((device_id, upload_id), None)
@@ -22,6 +22,7 @@ urlpatterns = [
     path('dashboard/device/<str:token>/', dashboard_for_device, name='dashboard_device'),
     path('check_predict_status/', check_predict_status, name='check_predict_status'),
     path('save_predict_results/', save_predict_results, name='save_predict_results'),
+    path('predict_buffer/', prediction_buffer_stats, name='prediction_buffer_stats'),
 
     # Profile and device edit
     path('profile/', profile, name='profile'),
@@ -32,5 +33,6 @@ urlpatterns = [
     path('training/confusion/', get_confusion_data, name='get_confusion_data'),
     path('training/trains/', list_trains, name='list_trains'),
     path('training/rounds/', get_train_rounds, name='get_train_rounds'),
+    path('training/quantization/', get_quantization_report, name='get_quantization_report'),
     path('training/delete/', delete_train, name='delete_train'),
 ]
@@ -10,7 +10,9 @@ from django.views.generic import ListView
 from django.shortcuts import render, redirect, get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-from .models import Device, LocalData, AggregetedData, RoundResult, PredictResult, Customer, Train
+from .models import Device, LocalData, AggregetedData, RoundResult, PredictResult, Customer, Train, Checkpoint, RoundSummary
+from .trainstate import trains
+from .writebehind import get_prediction_buffer, get_presence_buffer
 from .forms import DeviceForm, CustomerForm, UserRegisterForm, LoginForm, UserUpdateForm
 from django.core.paginator import Paginator
 from django.contrib.auth import authenticate, login, logout
@@ -18,6 +20,7 @@ from django.contrib.auth.forms import PasswordChangeForm
 from django.contrib.auth import update_session_auth_hash
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_POST
+from django.db import transaction
 
 
 logger = logging.getLogger(__name__)
@@ -140,6 +143,15 @@ def save_predict_results(request):
         # Ошибка, если метод запроса не POST
         return JsonResponse({'status': 'error', 'message': 'Only POST method is allowed'}, status=405)
     
+@login_required(login_url='login')
+def prediction_buffer_stats(request):
+    """
+    Отложенная запись этого процесса: очередь PredictResult (глубина, число/длительность сбросов,
+    потери) и пакетные отметки присутствия устройств (presence).
+    """
+    return JsonResponse({'success': True, **get_prediction_buffer().stats(), 'presence': get_presence_buffer().stats()})
+
+
 def check_predict_status(request):
     if request.method == 'GET':
         # Здесь можно добавить логику определения статуса
@@ -318,11 +330,74 @@ class AcceptWeightsView(View):
         if "get_global_weights" in request.path:
             try:
                 global_data = AggregetedData.objects.get(created_at=datetime.date.today())
-                return JsonResponse({'status': 'ok', 'weights': global_data.data}, status=200)
+                return JsonResponse({'status': 'ok', 'weights': global_data.get_data()}, status=200)
             except AggregetedData.DoesNotExist:
                 return JsonResponse({'status': 'error', 'message': 'Global weights not found'}, status=404)
         return JsonResponse({'status': 'error'}, status=400)
 
+    def post(self, request):
+        try:
+            data = json.loads(request.body)
+        except json.JSONDecodeError:
+            logger.info(f"Request path: {request.path}, invalid JSON")
+            return JsonResponse({'status': 'error', 'message': 'Invalid JSON'}, status=400)
+
+        if "save_local_weights" in request.path:
+            device_token = data.get('device_token')
+            weight = data.get('weight')
+            # ip = data.get('ip')
+            # port = data.get('port') 
+            round_data = {
+                'val_loss': data.get('val_loss', 1),
+                'val_accuracy': data.get('val_acc', 0),
+                'round_idx': data.get('round_idx', 0),
+            }
+  
+            if not device_token:
+                return JsonResponse({'status': 'error', 'message': 'Not all required fields are filled'}, status=400)
+
+            if isinstance(weight, str):
+                try:
+                    weight = json.loads(weight)  # <-- Распарсим JSON, если пришла строка
+                except json.JSONDecodeError:
+                    return JsonResponse({'status': 'error', 'message': 'Invalid weight format'}, status=400)
+            if not isinstance(weight, list) or not weight:
+                return JsonResponse({'status': 'error', 'message': 'Invalid weight format'}, status=400)
+
+            try:
+                weights = [np.asarray(w, dtype=np.float32) for w in weight]
+                device = Device.objects.get(device_token=device_token)
+                # токен и сами веса в лог не пишем
+                logger.info(f"Request path: {request.path}, device: {device.id}, layers: {len(weights)}")
+                with transaction.atomic():
+                    local_data, local_data_created = LocalData.objects.get_or_create(device=device, created_at=datetime.date.today())
+                    global_data, _ = AggregetedData.objects.select_for_update().get_or_create(created_at=datetime.date.today())
+                    # прежний вклад этой LocalData в бегущую сумму — вычтем его при замене
+                    previous = None
+                    if local_data.pk in (global_data.folded or []):
+                        try:
+                            previous = local_data.get_weights()
+                        except Exception:
+                            previous = None
+                    local_data.set_weights(weights)
+                    local_data.save()
+                    global_data.local_datas.add(local_data)
+                    global_data.fold_local_data(local_data, weights, previous)
+                    global_data.save()
+
+                round_result = RoundResult.objects.create(
+                    device=device, 
+                    local_data=local_data, 
+                    round_number=round_data.get('round_idx', 0), 
+                    result=round_data
+                )
+
+                return JsonResponse({'status': 'ok', 'local_data_created': local_data_created, 'global_data': global_data.get_data()}, status=200)
+            except Exception as e:
+                logger.error(f"Error saving weights: {e}")
+                return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+        return JsonResponse({'status': 'error'}, status=400)
+
 
 @login_required(login_url='login')
 def profile(request):
@@ -476,44 +551,19 @@ def get_confusion_data(request):
     except Exception:
         return JsonResponse({'success': False, 'error': 'train_id and round are required'}, status=400)
 
-    from .models import RoundResult
-    qs = RoundResult.objects.filter(train_id=train_id, round_number=round_no)
-    confusion_sum = None
-    support_sum = None
-    classes = None
-    import json as _json
-    try:
-        import numpy as _np
-    except Exception:
-        _np = None
-
-    for r in qs:
-        m = r.result or {}
-        if isinstance(m, str):
-            try:
-                m = _json.loads(m)
-            except Exception:
-                m = {}
-        conf = m.get('confusion')
-        supp = m.get('support')
-        cls = m.get('classes')
-        if conf is not None and _np is not None:
-            arr = _np.array(conf, dtype=float)
-            confusion_sum = arr if confusion_sum is None else (confusion_sum + arr)
-        if supp is not None and _np is not None:
-            arrs = _np.array(supp, dtype=float)
-            support_sum = arrs if support_sum is None else (support_sum + arrs)
-        if cls is not None and classes is None:
-            classes = cls
-
-    if confusion_sum is None:
+    # сводка пишется при агрегации; для ещё идущего раунда считаем по RoundResult без сохранения
+    summary = RoundSummary.objects.filter(train_id=train_id, round_number=round_no).only('confusion', 'classes').first()
+    if summary is None:
+        summary = RoundSummary.compute(train_id, round_no)
+    data = summary.get_confusion()
+    if data is None:
         return JsonResponse({'success': False, 'error': 'no data'}, status=404)
 
     return JsonResponse({
         'success': True,
-        'confusion': confusion_sum.tolist(),
-        'support': support_sum.tolist() if support_sum is not None else None,
-        'classes': classes,
+        'confusion': data['confusion'],
+        'support': data['support'],
+        'classes': data['classes'],
         'train_id': train_id,
         'round': round_no,
     })
@@ -521,13 +571,13 @@ def get_confusion_data(request):
 
 @login_required(login_url='login')
 def list_trains(request):
-    trains = (
+    train_qs = (
         Train.objects.all().order_by('-date', '-created_at')
         .values('id', 'date', 'model_name', 'round_count', 'max_rounds', 'epochs', 'is_active', 'ready')
     )
     return JsonResponse({
         'success': True,
-        'items': list(trains),
+        'items': list(train_qs),
     })
 
 
@@ -538,12 +588,35 @@ def get_train_rounds(request):
     except Exception:
         return JsonResponse({'success': False, 'error': 'train_id is required'}, status=400)
 
-    # Собираем среднюю точность по каждому раунду
-    qs = RoundResult.objects.filter(train_id=train_id)
-    acc_sum = {}
-    acc_cnt = {}
-    for r in qs:
-        rn = r.round_number
+    # Средняя точность по каждому раунду — из сводок раундов (RoundSummary); раунды без сводки
+    # (идущий раунд, история до backfill_round_summaries) считаем по RoundResult без сохранения
+    summaries = dict(RoundSummary.objects.filter(train_id=train_id).values_list('round_number', 'acc_mean'))
+    missing = set(
+        RoundResult.objects.filter(train_id=train_id).exclude(round_number__in=list(summaries))
+        .order_by().values_list('round_number', flat=True).distinct()
+    )
+    for rn in missing:
+        summaries[rn] = RoundSummary.compute(train_id, rn).acc_mean
+    acc = {rn: value for rn, value in summaries.items() if value is not None}
+    if not acc:
+        return JsonResponse({'success': True, 'rounds': [], 'accuracies': []})
+
+    rounds = list(range(0, max(acc) + 1))
+    accuracies = [acc.get(rn) for rn in rounds]
+
+    return JsonResponse({'success': True, 'rounds': rounds, 'accuracies': accuracies, 'train_id': train_id})
+
+
+@login_required(login_url='login')
+def get_quantization_report(request):
+    """Средняя accuracy клиентов по раундам в разрезе режима транспорта весов (float32/float16/int8)."""
+    try:
+        train_id = int(request.GET.get('train_id'))
+    except Exception:
+        return JsonResponse({'success': False, 'error': 'train_id is required'}, status=400)
+
+    per_round = {}
+    for r in RoundResult.objects.filter(train_id=train_id).only('round_number', 'result'):
         m = r.result or {}
         if isinstance(m, str):
             try:
@@ -551,23 +624,20 @@ def get_train_rounds(request):
             except Exception:
                 m = {}
         val = m.get('accuracy') or m.get('val_accuracy') or m.get('acc')
-        if isinstance(val, (int, float)):
-            acc_sum[rn] = acc_sum.get(rn, 0.0) + float(val)
-            acc_cnt[rn] = acc_cnt.get(rn, 0) + 1
-
-    if not acc_sum:
-        return JsonResponse({'success': True, 'rounds': [], 'accuracies': []})
-
-    max_round = max(acc_sum.keys())
-    rounds = list(range(0, max_round + 1))
-    accuracies = []
-    for rn in rounds:
-        if rn in acc_sum and acc_cnt.get(rn):
-            accuracies.append(acc_sum[rn] / acc_cnt[rn])
-        else:
-            accuracies.append(None)
-
-    return JsonResponse({'success': True, 'rounds': rounds, 'accuracies': accuracies, 'train_id': train_id})
+        if not isinstance(val, (int, float)):
+            continue
+        mode = m.get('transport') or 'float32'
+        acc = per_round.setdefault(r.round_number, {}).setdefault(mode, [0.0, 0])
+        acc[0] += float(val)
+        acc[1] += 1
+
+    rounds = []
+    for rn in sorted(per_round):
+        rounds.append({
+            'round': rn,
+            'modes': {mode: {'avg_accuracy': s / n, 'clients': n} for mode, (s, n) in per_round[rn].items()},
+        })
+    return JsonResponse({'success': True, 'train_id': train_id, 'rounds': rounds})
 
 
 @login_required(login_url='login')
@@ -591,7 +661,10 @@ def delete_train(request):
     #     return JsonResponse({'success': False, 'error': 'Нельзя удалить активную сессию. Остановите обучение и попробуйте снова.'}, status=400)
 
     deleted_id = train.id
+    hashes = list(train.checkpoints.values_list('content_hash', flat=True))
     train.delete()
+    trains.invalidate(deleted_id)
+    Checkpoint.delete_unreferenced(hashes)
     return JsonResponse({'success': True, 'train_id': deleted_id})
 
 @require_POST
@@ -647,61 +720,3 @@ def auth_landing(request):
 def logout_view(request):
     logout(request)
     return redirect('login')
-
-    def post(self, request):
-        logger.info(f"Request path: {request.path}")
-
-        try:
-            data = json.loads(request.body)
-            logger.info(f"Received data: {data}")
-        except json.JSONDecodeError:
-            return JsonResponse({'status': 'error', 'message': 'Invalid JSON'}, status=400)
-
-        if "save_local_weights" in request.path:
-            device_token = data.get('device_token')
-            weight = data.get('weight')
-            # ip = data.get('ip')
-            # port = data.get('port') 
-            round_data = {
-                'val_loss': data.get('val_loss', 1),
-                'val_accuracy': data.get('val_acc', 0),
-                'round_idx': data.get('round_idx', 0),
-            }
-  
-            if not device_token:
-                return JsonResponse({'status': 'error', 'message': 'Not all required fields are filled'}, status=400)
-
-            # Если weight — это массив NumPy, конвертируем в list
-            if isinstance(weight, np.ndarray):
-                weight = weight.tolist()
-
-            logger.info(f"Weight after conversion: {weight}")
-
-            try:
-                device = Device.objects.get(device_token=device_token)
-                local_data, local_data_created = LocalData.objects.get_or_create(device=device, created_at=datetime.date.today())
-                if isinstance(weight, str):  
-                    try:
-                        weight = json.loads(weight)  # <-- Распарсим JSON, если пришла строка
-                    except json.JSONDecodeError:
-                        return JsonResponse({'status': 'error', 'message': 'Invalid weight format'}, status=400)
-
-                local_data.data = weight  # Теперь это точно JSON-совместимый list
-                local_data.save()
-
-                global_data, _ = AggregetedData.objects.get_or_create(created_at=datetime.date.today())
-                global_data.local_datas.add(local_data)
-                global_data.save(aggregate=True)
-
-                round_result = RoundResult.objects.create(
-                    device=device, 
-                    local_data=local_data, 
-                    round_number=round_data.get('round_idx', 0), 
-                    result=round_data
-                )
-
-                return JsonResponse({'status': 'ok', 'local_data_created': local_data_created, 'global_data': global_data.data}, status=200)
-            except Exception as e:
-                logger.error(f"Error saving weights: {e}")
-                return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
-        return JsonResponse({'status': 'error'}, status=400)
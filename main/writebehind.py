@@ -0,0 +1,216 @@
+# writebehind.py
+"""
+Отложенная пакетная запись строк (write-behind): консьюмер кладёт несохранённый объект модели
+в буфер процесса и сразу отвечает клиенту; буфер пишет накопленное одним bulk_create,
+когда набралось max_rows строк или прошло max_delay секунд с первой строки пакета.
+
+Сбросы идут по одному (SQLite — один писатель), неудачный пакет возвращается в очередь,
+пока она не длиннее max_queue (сверх — строки отбрасываются и считаются в dropped).
+При остановке процесса остаток дописывается синхронно (atexit).
+
+PresenceBuffer — то же для last_seen/is_online устройств: отметки копятся в памяти (последняя
+на устройство) и раз в interval секунд пишутся одним bulk_update, так что число записей
+зависит от числа активных устройств, а не от частоты их сообщений.
+"""
+import asyncio
+import atexit
+import logging
+import time
+
+from channels.db import database_sync_to_async
+from django.utils.timezone import now
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    def __init__(self, model, max_rows: int = 500, max_delay: float = 0.2, max_queue: int = 50000):
+        self.model = model
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self.pending = []
+        self.in_flight = 0
+        self._timer = None
+        self._flushing = None  # asyncio.Lock, создаётся в цикле событий консьюмеров
+        self._tasks = set()
+        # метрики
+        self.flushed = 0
+        self.flushes = 0
+        self.failures = 0
+        self.dropped = 0
+        self.last_flush_ms = None
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    @property
+    def depth(self) -> int:
+        """Строк в очереди, включая пишущийся сейчас пакет."""
+        return len(self.pending) + self.in_flight
+
+    def add(self, obj):
+        """Поставить строку в очередь; не ждёт записи."""
+        self.pending.append(obj)
+        if len(self.pending) >= self.max_rows:
+            self._spawn(self.flush())
+        elif self._timer is None or self._timer.done():
+            self._timer = self._spawn(self._flush_later())
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)  # держим ссылку, пока задача не завершится
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        await self.flush()
+
+    async def flush(self):
+        if self._flushing is None:
+            self._flushing = asyncio.Lock()
+        async with self._flushing:
+            while self.pending:
+                rows, self.pending = self.pending[:self.max_rows], self.pending[self.max_rows:]
+                self.in_flight = len(rows)
+                t0 = time.perf_counter()
+                try:
+                    await database_sync_to_async(self._write)(rows)
+                except Exception:
+                    logger.exception("Write-behind flush of %d %s rows failed", len(rows), self.model.__name__)
+                    self.failures += 1
+                    self._requeue(rows)
+                    self._timer = self._spawn(self._flush_later())  # повтор через max_delay
+                    return
+                finally:
+                    self.in_flight = 0
+                self._record(rows, time.perf_counter() - t0)
+
+    def _write(self, rows):
+        self.model.objects.bulk_create(rows, batch_size=self.max_rows)
+
+    def _requeue(self, rows):
+        room = max(0, self.max_queue - len(self.pending))
+        self.dropped += max(0, len(rows) - room)
+        self.pending[:0] = rows[:room]
+
+    def _record(self, rows, seconds):
+        ms = seconds * 1000.0
+        self.flushed += len(rows)
+        self.flushes += 1
+        self.last_flush_ms = ms
+        self.max_flush_ms = max(self.max_flush_ms, ms)
+        self.total_flush_ms += ms
+
+    def drain_sync(self):
+        """Дописать очередь синхронно — при остановке процесса, когда цикла событий уже нет."""
+        rows, self.pending = self.pending, []
+        if not rows:
+            return
+        try:
+            self._write(rows)
+            self._record(rows, 0.0)
+        except Exception:
+            logger.exception("Write-behind drain of %d %s rows failed", len(rows), self.model.__name__)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.depth,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "dropped": self.dropped,
+            "last_flush_ms": self.last_flush_ms,
+            "avg_flush_ms": self.total_flush_ms / self.flushes if self.flushes else None,
+            "max_flush_ms": self.max_flush_ms,
+        }
+
+
+class PresenceBuffer:
+    def __init__(self, interval: float = 5.0):
+        self.interval = interval
+        self.seen = {}  # device_id -> время последнего сообщения
+        self._timer = None
+        # метрики
+        self.flushes = 0
+        self.written = 0
+        self.last_flush_ms = None
+
+    def touch(self, device):
+        """Отметить устройство онлайн: объект обновляется сразу, БД — на ближайшем сбросе."""
+        device.last_seen = now()
+        device.is_online = True
+        self.seen[device.id] = device.last_seen
+        if self._timer is None or self._timer.done():
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+
+    async def flush(self):
+        batch, self.seen = self.seen, {}
+        if not batch:
+            return
+        t0 = time.perf_counter()
+        try:
+            await database_sync_to_async(self._write)(batch)
+        except Exception:
+            logger.exception("Presence flush of %d devices failed", len(batch))
+            for device_id, ts in batch.items():
+                self.seen.setdefault(device_id, ts)  # более свежая отметка важнее
+            self._timer = asyncio.ensure_future(self._flush_later())
+            return
+        self.flushes += 1
+        self.written += len(batch)
+        self.last_flush_ms = (time.perf_counter() - t0) * 1000.0
+
+    @staticmethod
+    def _write(batch):
+        from .models import Device
+        rows = [Device(id=device_id, last_seen=ts, is_online=True) for device_id, ts in batch.items()]
+        Device.objects.bulk_update(rows, ["last_seen", "is_online"], batch_size=500)
+
+    def drain_sync(self):
+        batch, self.seen = self.seen, {}
+        if batch:
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception("Presence drain of %d devices failed", len(batch))
+
+    def stats(self) -> dict:
+        return {
+            "pending_devices": len(self.seen),
+            "flushes": self.flushes,
+            "written": self.written,
+            "last_flush_ms": self.last_flush_ms,
+        }
+
+
+_predictions = None
+_presence = None
+
+
+def get_prediction_buffer() -> WriteBehindBuffer:
+    global _predictions
+    if _predictions is None:
+        from django.conf import settings
+        from .models import PredictResult
+        _predictions = WriteBehindBuffer(
+            PredictResult,
+            max_rows=getattr(settings, "FL_PREDICT_BATCH_ROWS", 500),
+            max_delay=getattr(settings, "FL_PREDICT_FLUSH_MS", 200) / 1000.0,
+            max_queue=getattr(settings, "FL_PREDICT_MAX_QUEUE", 50000),
+        )
+        atexit.register(_predictions.drain_sync)
+    return _predictions
+
+
+def get_presence_buffer() -> PresenceBuffer:
+    global _presence
+    if _presence is None:
+        from django.conf import settings
+        _presence = PresenceBuffer(interval=getattr(settings, "FL_PRESENCE_FLUSH_SEC", 5.0))
+        atexit.register(_presence.drain_sync)
+    return _presence
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 from pathlib import Path
 import os
+import sys
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -182,4 +183,85 @@ LOGGING = {
     },
 }
 
-ASGI_APPLICATION = 'project.asgi.application'
\ No newline at end of file
+# Тесты в рабочий лог не пишут: там токены устройств и содержимое загрузок
+if len(sys.argv) > 1 and sys.argv[1] == 'test':
+    LOGGING['handlers']['file'] = {'class': 'logging.NullHandler'}
+
+ASGI_APPLICATION = 'project.asgi.application'
+
+
+# Federated learning (ws/train_model/)
+# Квантизация global_weights по модели: None | "float16" | "int8".
+# Модель без записи получает первый режим из capabilities.quantization клиента.
+FL_WEIGHTS_QUANTIZATION = {}
+
+# Чанковые загрузки весов: суммарный бюджет памяти процесса и время жизни незавершённой загрузки.
+FL_UPLOAD_MAX_BYTES = int(os.getenv('FL_UPLOAD_MAX_BYTES', 512 * 1024 * 1024))
+FL_UPLOAD_TTL_SEC = int(os.getenv('FL_UPLOAD_TTL_SEC', 600))
+
+# Доля элементов слоя в top-k режиме обновлений (например 0.01); None — плотные веса.
+# Может быть задана в сообщении start_training (поле "topk").
+FL_TOPK_FRACTION = os.getenv('FL_TOPK_FRACTION') or None
+
+# Тип потокового аккумулятора FedAvg: 'float64' (точнее) или 'float32' (вдвое меньше памяти).
+FL_ACCUMULATOR_DTYPE = os.getenv('FL_ACCUMULATOR_DTYPE', 'float64')
+
+# Пул агрегации: число воркеров (пусто — по числу ядер) и режим 'thread' | 'process'.
+# В режиме 'process' суммы раунда и входящие обновления лежат в shared memory.
+FL_AGG_WORKERS = int(os.getenv('FL_AGG_WORKERS', '0')) or None
+FL_AGG_MODE = os.getenv('FL_AGG_MODE', 'thread')
+
+# Режим обучения по умолчанию: 'sync' — раунды с барьером, 'async' — буферизованная асинхронная агрегация
+# (start_training может переопределить полем "mode"). В async новая версия выходит после K обновлений,
+# вклад каждого умножается на (1 + устарелость) ** -ALPHA; обновления старше MAX_STALENESS версий отклоняются.
+FL_TRAINING_MODE = os.getenv('FL_TRAINING_MODE', 'sync')
+FL_ASYNC_BUFFER_K = int(os.getenv('FL_ASYNC_BUFFER_K', '3'))
+FL_ASYNC_STALENESS_ALPHA = float(os.getenv('FL_ASYNC_STALENESS_ALPHA', '0.5'))
+FL_ASYNC_MAX_STALENESS = int(os.getenv('FL_ASYNC_MAX_STALENESS', '8'))
+
+# Дедлайн раунда: FL_DEADLINE_PERCENTILE задержки «рассылка -> загрузка» ожидаемых участников
+# * (1 + FL_DEADLINE_MARGIN) + FL_DEADLINE_MARGIN_SEC, в пределах [MIN, MAX]. Пока истории меньше
+# FL_LATENCY_MIN_SAMPLES загрузок — FL_AGG_TIMEOUT_SEC. FL_LATENCY_DECAY — забывание старых замеров.
+FL_AGG_TIMEOUT_SEC = float(os.getenv('FL_AGG_TIMEOUT_SEC', '20'))
+FL_DEADLINE_PERCENTILE = float(os.getenv('FL_DEADLINE_PERCENTILE', '0.9'))
+FL_DEADLINE_MARGIN = float(os.getenv('FL_DEADLINE_MARGIN', '0.25'))
+FL_DEADLINE_MARGIN_SEC = float(os.getenv('FL_DEADLINE_MARGIN_SEC', '1.0'))
+FL_DEADLINE_MIN_SEC = float(os.getenv('FL_DEADLINE_MIN_SEC', '2'))
+FL_DEADLINE_MAX_SEC = float(os.getenv('FL_DEADLINE_MAX_SEC', '600'))
+FL_LATENCY_MIN_SAMPLES = int(os.getenv('FL_LATENCY_MIN_SAMPLES', '3'))
+FL_LATENCY_DECAY = float(os.getenv('FL_LATENCY_DECAY', '0.95'))
+
+# Выборка участников раунда: доля подключённых устройств (1.0 — все), запас сверху
+# и стратегия 'random' | 'capacity' (чаще берём устройства с меньшей задержкой).
+# Раунд закрывается на ceil(FRACTION * N) обновлениях; опоздавшие отбрасываются.
+FL_PARTICIPATION_FRACTION = float(os.getenv('FL_PARTICIPATION_FRACTION', '1.0'))
+FL_PARTICIPATION_OVERSELECT = float(os.getenv('FL_PARTICIPATION_OVERSELECT', '0.3'))
+FL_PARTICIPATION_SAMPLING = os.getenv('FL_PARTICIPATION_SAMPLING', 'random')
+
+# Каталог spool раундов: суммы FedAvg в memory-mapped файле на train/раунд + meta.json.
+# Пусто — буфер только в памяти процесса; иначе незавершённый раунд переживает рестарт daphne.
+FL_ROUND_SPOOL_DIR = os.getenv('FL_ROUND_SPOOL_DIR') or None
+
+# Чекпоинты глобальной модели по раундам: файлы по хешу содержимого в FL_CHECKPOINT_DIR,
+# индекс — таблица Checkpoint. Храним последние KEEP_LAST (0 — всю историю), каждый KEEP_EVERY-й
+# и лучший по accuracy. Между ключевыми кадрами (каждый KEYFRAME_EVERY-й раунд) пишутся сжатые
+# XOR-дельты к предыдущему раунду; FL_CHECKPOINT_CACHE — сколько собранных раундов держать в памяти.
+FL_CHECKPOINT_DIR = os.getenv('FL_CHECKPOINT_DIR') or os.path.join(BASE_DIR, 'checkpoints')
+FL_CHECKPOINT_KEEP_LAST = int(os.getenv('FL_CHECKPOINT_KEEP_LAST', '0'))
+FL_CHECKPOINT_KEEP_EVERY = int(os.getenv('FL_CHECKPOINT_KEEP_EVERY', '10'))
+FL_CHECKPOINT_KEEP_BEST = os.getenv('FL_CHECKPOINT_KEEP_BEST', '1') not in ('0', 'false', 'False')
+FL_CHECKPOINT_KEYFRAME_EVERY = int(os.getenv('FL_CHECKPOINT_KEYFRAME_EVERY', '10'))
+FL_CHECKPOINT_CACHE = int(os.getenv('FL_CHECKPOINT_CACHE', '4'))
+# Раунд зафиксирован, а чекпоинта нет: счётчик откатывается к раунду весов, только если фиксации
+# больше FL_ROUND_COMMIT_GRACE_SEC секунд — раньше чекпоинт может ещё писать другой процесс.
+FL_ROUND_COMMIT_GRACE_SEC = float(os.getenv('FL_ROUND_COMMIT_GRACE_SEC', '600'))
+
+# Запись PredictResult из websocket пакетами (write-behind): bulk_create по FL_PREDICT_BATCH_ROWS
+# строк или через FL_PREDICT_FLUSH_MS мс; очередь сверх FL_PREDICT_MAX_QUEUE при сбоях БД отбрасывается.
+FL_PREDICT_BATCH_ROWS = int(os.getenv('FL_PREDICT_BATCH_ROWS', '500'))
+FL_PREDICT_FLUSH_MS = float(os.getenv('FL_PREDICT_FLUSH_MS', '200'))
+FL_PREDICT_MAX_QUEUE = int(os.getenv('FL_PREDICT_MAX_QUEUE', '50000'))
+
+# last_seen/is_online устройств из websocket пишутся одним bulk_update раз в FL_PRESENCE_FLUSH_SEC
+# (должно быть заметно меньше 60 с — порога «офлайн» в Device.update_status).
+FL_PRESENCE_FLUSH_SEC = float(os.getenv('FL_PRESENCE_FLUSH_SEC', '5'))